@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Fishnet entry point
+Single command for the exporter and its tools, which only imports what the
+chosen mode uses: the collection engine for every exporter mode, Flask and
+the central server only when metrics_server.mode is 'central', tabulate and
+colorama only for the CLI.
+- python fishnet.py [run]      exporter, standalone, client or central as set by metrics_server
+- python fishnet.py standalone exporter exposing its own metrics only, metrics_server is ignored
+- python fishnet.py cli [...]  status of the Fishnet servers on the command line
+"""
+
+import os
+import sys
+import argparse
+
+COMMANDS = ('run', 'standalone', 'cli')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fishnet exporter and tools')
+    parser.add_argument('-c', '--config', help='Configuration file (default: $FISHNET_CONFIG)')
+    parser.add_argument('command', nargs='?', default='run', choices=COMMANDS, help='What to run (default: run)')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the CLI')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.config:
+        # Read by fishnet_config when it is first imported, below
+        os.environ['FISHNET_CONFIG'] = os.path.abspath(args.config)
+
+    if args.command == 'cli':
+        import fishnet_cli
+        sys.argv = [f'{sys.argv[0]} cli'] + args.args
+        fishnet_cli.main()
+        return
+    if args.args:
+        sys.exit(f"unexpected arguments: {' '.join(args.args)}")
+    if args.command == 'standalone':
+        import fishnet_exporter
+        fishnet_exporter.main()
+    else:
+        import fishnet_exporter_modified
+        fishnet_exporter_modified.main()
+
+
+if __name__ == '__main__':
+    main()
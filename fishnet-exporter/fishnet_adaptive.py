@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Fishnet adaptive polling
+Policy consulted by the scheduler for the next deadline of every server.
+A circuit breaker opens after a few consecutive failed polls: the server is
+then left alone for an exponentially growing backoff and polled again as a
+probe with a short timeout, which closes the breaker on success or reopens
+it for twice as long. While the breaker is closed, the interval follows the
+activity of the instance: it is halved, down to a lower bound, when its
+queue depth or analyses per second change fast between two polls, and
+stretched, up to an upper bound, while they stay stable. Disabled by
+default: it is opt-in under exporter.adaptive.
+"""
+
+import time
+import logging
+import threading
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_BREAKER_STATE = Gauge('fishnet_breaker_state', 'Circuit breaker of the instance (0 closed, 1 open, 2 half-open)', ['instance'])
+FISHNET_BREAKER_TRANSITIONS = Counter('fishnet_breaker_transitions_total', 'Changes of state of the circuit breaker', ['instance', 'state'])
+FISHNET_BREAKER_PROBES = Counter('fishnet_breaker_probes_total', 'Probes of an instance whose breaker is open', ['instance', 'result'])
+FISHNET_EFFECTIVE_INTERVAL = Gauge('fishnet_effective_interval_seconds', 'Seconds until the next poll of the instance, as decided by the adaptive policy', ['instance'])
+FISHNET_ACTIVITY_CHANGE = Gauge('fishnet_activity_change_rate', 'Relative change per minute of the queue depth or analyses per second between the last two polls', ['instance'])
+
+# Defaults for the 'exporter.adaptive' section of the configuration
+DEFAULT_ADAPTIVE_CONFIG = {
+    'enabled': False,
+    'min_interval': 15,
+    'max_interval': 300,
+    'fast_change': 0.2,
+    'stable_change': 0.02,
+    'tighten_factor': 0.5,
+    'relax_factor': 1.5,
+    'failure_threshold': 3,
+    'max_backoff': 1800,
+    'probe_timeout': 3
+}
+
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+STATE_NAMES = {CLOSED: 'closed', OPEN: 'open', HALF_OPEN: 'half_open'}
+
+
+def activity(data):
+    """Total queue depth and analyses per second of a status payload"""
+    queue = data.get('queue', {})
+    depth = sum(value for value in queue.values() if isinstance(value, (int, float)))
+    return depth, data.get('performance', {}).get('analyses_per_second', 0) or 0
+
+
+def relative_change(previous, current):
+    return abs(current - previous) / max(abs(previous), 1.0)
+
+
+class ServerPolicy:
+    """Breaker and cadence of one server"""
+
+    __slots__ = ('state', 'failures', 'backoff', 'interval', 'activity', 'polled_at')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.backoff = None
+        # Effective interval while closed, None until the activity has been measured
+        self.interval = None
+        self.activity = None
+        self.polled_at = None
+
+
+class AdaptivePolicy:
+    """Per-server circuit breakers and adaptive intervals"""
+
+    def __init__(self):
+        self._config = dict(DEFAULT_ADAPTIVE_CONFIG)
+        self._servers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, adaptive_config):
+        config = dict(DEFAULT_ADAPTIVE_CONFIG, **(adaptive_config or {}))
+        if config != self._config:
+            with self._lock:
+                self._config = config
+                if not config['enabled']:
+                    for name in list(self._servers):
+                        del self._servers[name]
+                        for gauge in (FISHNET_BREAKER_STATE, FISHNET_EFFECTIVE_INTERVAL, FISHNET_ACTIVITY_CHANGE):
+                            try:
+                                gauge.remove(name)
+                            except KeyError:
+                                pass
+
+    def _server(self, name):
+        policy = self._servers.get(name)
+        if policy is None:
+            policy = self._servers[name] = ServerPolicy()
+            FISHNET_BREAKER_STATE.labels(instance=name).set(CLOSED)
+        return policy
+
+    def _transition(self, name, policy, state):
+        if policy.state == state:
+            return
+        policy.state = state
+        FISHNET_BREAKER_STATE.labels(instance=name).set(state)
+        FISHNET_BREAKER_TRANSITIONS.labels(instance=name, state=STATE_NAMES[state]).inc()
+
+    def poll_timeout(self, name, timeout):
+        """Timeout of the poll about to start, short when it probes a server whose breaker is open"""
+        if not self._config['enabled']:
+            return timeout
+        with self._lock:
+            policy = self._servers.get(name)
+            if policy is None or policy.state == CLOSED:
+                return timeout
+            self._transition(name, policy, HALF_OPEN)
+            logger.info(f"Probing {name} after {policy.failures} failed poll(s)")
+            return min(timeout, self._config['probe_timeout'])
+
+    def succeeded(self, name, data=None, now=None):
+        """A poll answered, with its payload or None when it was unchanged"""
+        if not self._config['enabled']:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            policy = self._server(name)
+            if policy.state != CLOSED:
+                FISHNET_BREAKER_PROBES.labels(instance=name, result='success').inc()
+                logger.info(f"{name} answered again, closing its circuit breaker")
+                self._transition(name, policy, CLOSED)
+            policy.failures = 0
+            policy.backoff = None
+
+            current = activity(data) if data is not None else policy.activity
+            if current is None:
+                return
+            if policy.activity is not None and policy.polled_at is not None and now > policy.polled_at:
+                # Per minute, so that a shorter interval does not read as a calmer instance
+                change = max(
+                    relative_change(policy.activity[0], current[0]),
+                    relative_change(policy.activity[1], current[1])
+                ) * 60 / (now - policy.polled_at)
+                FISHNET_ACTIVITY_CHANGE.labels(instance=name).set(change)
+                self._adjust(policy, change)
+            policy.activity = current
+            policy.polled_at = now
+
+    def _adjust(self, policy, change):
+        config = self._config
+        if policy.interval is None:
+            return
+        if change >= config['fast_change']:
+            policy.interval *= config['tighten_factor']
+        elif change <= config['stable_change']:
+            policy.interval *= config['relax_factor']
+
+    def failed(self, name):
+        """A poll failed, timed out or was answered with an error"""
+        if not self._config['enabled']:
+            return
+        config = self._config
+        with self._lock:
+            policy = self._server(name)
+            policy.failures += 1
+            # The activity measured before the outage says nothing about the next polls
+            policy.activity = None
+            if policy.state == HALF_OPEN:
+                FISHNET_BREAKER_PROBES.labels(instance=name, result='failure').inc()
+                policy.backoff = min((policy.backoff or config['min_interval']) * 2, config['max_backoff'])
+                self._transition(name, policy, OPEN)
+                logger.warning(f"Probe of {name} failed, next one in {policy.backoff:.0f}s")
+            elif policy.state == CLOSED and policy.failures >= config['failure_threshold']:
+                policy.backoff = None
+                self._transition(name, policy, OPEN)
+
+    def interval(self, name, base):
+        """Seconds until the next poll of a server whose configured interval is 'base'"""
+        config = self._config
+        if not config['enabled']:
+            FISHNET_EFFECTIVE_INTERVAL.labels(instance=name).set(base)
+            return base
+        # A configured interval outside the bounds widens them
+        low = min(config['min_interval'], base)
+        high = max(config['max_interval'], base)
+        with self._lock:
+            policy = self._server(name)
+            if policy.state == CLOSED:
+                policy.interval = min(high, max(low, policy.interval or base))
+                interval = policy.interval
+            else:
+                if policy.backoff is None:
+                    policy.backoff = min(base * 2, config['max_backoff'])
+                    logger.warning(
+                        f"{name} failed {policy.failures} polls in a row, opening its circuit breaker for {policy.backoff:.0f}s"
+                    )
+                interval = policy.backoff
+        FISHNET_EFFECTIVE_INTERVAL.labels(instance=name).set(interval)
+        return interval
+
+    def forget(self, name):
+        """Drop the state of a server removed from the configuration"""
+        with self._lock:
+            self._servers.pop(name, None)
+            for gauge in (FISHNET_BREAKER_STATE, FISHNET_EFFECTIVE_INTERVAL, FISHNET_ACTIVITY_CHANGE):
+                try:
+                    gauge.remove(name)
+                except KeyError:
+                    pass
+
+
+ADAPTIVE_POLICY = AdaptivePolicy()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Fishnet exporter benchmark
+Drives the collection engine, the /metrics rendering, the client push path
+and the central /metrics/push endpoint against fishnet_mock_server.py, for
+several fleet sizes, and reports cycle time, CPU and memory per 1k clients.
+It also checks that a malformed push is refused without breaking /metrics.
+Each size runs in its own process so that its memory and CPU are measured
+in isolation. Use --json to keep the results for regression comparisons.
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+import yaml
+from tabulate import tabulate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def rss_bytes():
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak instead of current outside Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def timed(func, *args, **kwargs):
+    """Run func, returns (result, wall seconds, CPU seconds)"""
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(args):
+    port = free_port()
+    command = [
+        sys.executable, os.path.join(HERE, 'fishnet_mock_server.py'),
+        '--port', str(port), '--latency', str(args.latency), '--churn', str(args.churn), '--seed', '1'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{url}/?clients=1', timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("mock status server did not start")
+
+
+def run_size(args):
+    """Benchmark one fleet size in this process, returns the measurements"""
+    servers = [
+        {'name': f'bench-{i}', 'url': f'{args.mock_url}/server{i}?clients={args.run_size}'}
+        for i in range(args.servers)
+    ]
+    config = {
+        'servers': servers,
+        'exporter': {
+            'port': 0,
+            'scrape_interval': 60,
+            'server_timeout': 60,
+            'cycle_timeout': 120,
+            'json_backend': args.json_backend,
+            'collection_mode': args.collection_mode,
+            # Every run starts cold, and leaves no state file in the tree
+            'warm_start': {'enabled': False}
+        },
+        'metrics_server': {
+            'enabled': True,
+            'mode': 'central',
+            'ingest': {'max_series_per_source': 10 * args.run_size + 1000}
+        }
+    }
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as file:
+        yaml.safe_dump(config, file)
+    os.environ['FISHNET_CONFIG'] = file.name
+    atexit.register(os.unlink, file.name)
+
+    rss_start = rss_bytes()
+    # Imported late so that FISHNET_CONFIG points to the benchmark configuration
+    from prometheus_client import generate_latest
+    from fishnet_collector import collect_servers
+    from fishnet_snapshot import SNAPSHOT_REGISTRY
+    from fishnet_push import PushEncoder
+    import fishnet_exporter_modified as exporter
+    logging.getLogger('fishnet-exporter').setLevel(logging.WARNING)
+    config = exporter.load_config()
+    rss_imported = rss_bytes()
+
+    results = {'clients': args.run_size * args.servers}
+    _, results['first_cycle_s'], results['first_cycle_cpu_s'] = timed(collect_servers, config)
+
+    walls, cpus = [], []
+    for _ in range(args.cycles):
+        _, wall, cpu = timed(collect_servers, config)
+        walls.append(wall)
+        cpus.append(cpu)
+    results['cycle_s'] = sum(walls) / len(walls)
+    results['cycle_cpu_s'] = sum(cpus) / len(cpus)
+
+    # Scrapes as served by the exporter, the repeated one is the usual case between two cycles
+    def scrape():
+        return SNAPSHOT_REGISTRY.render() or generate_latest(SNAPSHOT_REGISTRY)
+
+    output, results['scrape_s'], _ = timed(scrape)
+    results['scrape_bytes'] = len(output)
+    _, results['scrape_repeat_s'], _ = timed(scrape)
+
+    # Client push path and central ingestion, full snapshot then delta
+    client = exporter.get_app().test_client()
+    encoder = PushEncoder()
+    for kind in ('full', 'delta'):
+        if kind == 'delta':
+            collect_servers(config)
+        (body, headers, state), results[f'push_{kind}_encode_s'], _ = timed(encoder.encode, SNAPSHOT_REGISTRY, None, 'bench')
+        response, results[f'push_{kind}_receive_s'], _ = timed(client.post, '/metrics/push', data=body, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"central server answered HTTP {response.status_code} to the {kind} push")
+        encoder.acknowledge(state, response)
+        results[f'push_{kind}_bytes'] = len(body)
+
+    # Central /metrics with the pushed snapshot, the repeated scrape reuses its rendering
+    _, results['central_scrape_s'], _ = timed(client.get, '/metrics')
+    _, results['central_scrape_repeat_s'], _ = timed(client.get, '/metrics')
+
+    # A malformed push is refused, and the central /metrics stays scrapable
+    bogus = json.dumps({'v': 1, 'full': True, 'families': {'fishnet_bogus': ['bogus', 'h']}, 'series': [['fishnet_bogus', 'fishnet_bogus', {}, 1]]})
+    response = client.post('/metrics/push', data=bogus, headers={'Content-Type': 'application/vnd.fishnet.push+json', 'X-Fishnet-Source': 'bogus'})
+    if response.status_code != 400:
+        raise RuntimeError(f"central server answered HTTP {response.status_code} to a malformed push")
+    if client.get('/metrics').status_code != 200:
+        raise RuntimeError("central /metrics failed after a malformed push")
+
+    results['rss_bytes'] = rss_bytes() - rss_imported
+    results['rss_import_bytes'] = rss_imported - rss_start
+    return results
+
+
+def per_1k(results, key):
+    return results[key] / max(results['clients'] / 1000.0, 0.001)
+
+
+def print_report(all_results):
+    rows = []
+    for r in all_results:
+        rows.append([
+            r['clients'],
+            f"{r['first_cycle_s'] * 1000:.0f}",
+            f"{r['cycle_s'] * 1000:.0f}",
+            f"{per_1k(r, 'cycle_s') * 1000:.1f}",
+            f"{per_1k(r, 'cycle_cpu_s') * 1000:.1f}",
+            f"{per_1k(r, 'rss_bytes') / 1024 / 1024:.2f}",
+            f"{r['scrape_s'] * 1000:.0f}",
+            f"{r['scrape_repeat_s'] * 1000:.0f}",
+            f"{r['scrape_bytes'] / 1024:.0f}",
+            f"{r['push_full_bytes'] / 1024:.0f}",
+            f"{r['push_full_receive_s'] * 1000:.0f}",
+            f"{r['push_delta_bytes'] / 1024:.0f}",
+            f"{r['push_delta_receive_s'] * 1000:.0f}",
+            f"{r['central_scrape_s'] * 1000:.0f}",
+            f"{r['central_scrape_repeat_s'] * 1000:.0f}"
+        ])
+    headers = [
+        'clients', 'first cycle ms', 'cycle ms', 'cycle ms/1k', 'cycle CPU ms/1k', 'RSS MB/1k',
+        'scrape ms', 'repeat scrape ms', 'scrape KB', 'full push KB', 'full ingest ms', 'delta push KB', 'delta ingest ms',
+        'central scrape ms', 'repeat central ms'
+    ]
+    print(tabulate(rows, headers=headers, tablefmt='simple'))
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Fishnet exporter against the mock status server')
+    parser.add_argument('--sizes', type=parse_sizes, default=[1000, 5000, 10000], help='Comma separated numbers of clients per server')
+    parser.add_argument('--servers', type=int, default=1, help='Number of mocked Fishnet servers')
+    parser.add_argument('--cycles', type=int, default=5, help='Measured collection cycles per size')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency of the mock server, in milliseconds')
+    parser.add_argument('--churn', type=float, default=0.01, help='Fraction of the clients replaced on every poll')
+    parser.add_argument('--json-backend', choices=['auto', 'orjson', 'lazy', 'stdlib'], default='auto', help='Decoder of the status payloads')
+    parser.add_argument('--collection-mode', choices=['gauges', 'snapshot'], default='gauges', help='Collection mode of the exporter')
+    parser.add_argument('--mock-url', default=None, help='Use an already running mock server')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--run-size', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size is not None:
+        print(json.dumps(run_size(args)))
+        return
+
+    mock = None
+    if args.mock_url is None:
+        mock, args.mock_url = start_mock_server(args)
+    try:
+        all_results = []
+        for size in args.sizes:
+            command = [
+                sys.executable, os.path.abspath(__file__), '--run-size', str(size), '--servers', str(args.servers),
+                '--cycles', str(args.cycles), '--json-backend', args.json_backend, '--collection-mode', args.collection_mode,
+                '--mock-url', args.mock_url
+            ]
+            output = subprocess.run(command, cwd=HERE, check=True, stdout=subprocess.PIPE, text=True).stdout
+            all_results.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        print_report(all_results)
+
+
+if __name__ == '__main__':
+    main()
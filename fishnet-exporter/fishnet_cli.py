@@ -1,25 +1,43 @@
 #!/usr/bin/env python3
 """
 Fishnet CLI Status Tool
-Ce script permet de consulter l'état des serveurs Fishnet en ligne de commande
+Ce script permet de consulter l'état des serveurs Fishnet en ligne de commande.
+Les serveurs sont interrogés en parallèle, les réponses peuvent être gardées
+en cache quelques secondes (--cache-ttl), et --watch rafraîchit l'affichage
+en continu avec le nombre de jobs complétés depuis le rafraîchissement précédent.
 """
 
 import argparse
+import hashlib
+import io
 import yaml
 import json
-import requests
 import os
 import sys
-from tabulate import tabulate
-from colorama import Fore, Style, init
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import redirect_stdout
+from fishnet_http import build_session
 
-# Initialisation de colorama
-init()
+# Importés après l'analyse des arguments par load_ui(), pour que --help et --json démarrent vite
+tabulate = None
+Fore = Style = None
 
-def load_config():
+# Fichier de configuration par défaut, surchargé par FISHNET_CONFIG ou --config
+DEFAULT_CONFIG_PATH = os.environ.get('FISHNET_CONFIG') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'fishnet_config.yaml'
+)
+
+def load_ui(tables=True):
+    """Importe colorama, et tabulate si des tableaux seront affichés"""
+    global tabulate, Fore, Style
+    from colorama import Fore, Style, init
+    init()
+    if tables:
+        from tabulate import tabulate
+
+def load_config(config_path=DEFAULT_CONFIG_PATH):
     """Charge la configuration depuis le fichier YAML"""
-    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
-                               'config', 'fishnet_config.yaml')
     try:
         with open(config_path, 'r') as file:
             return yaml.safe_load(file)
@@ -27,29 +45,104 @@ def load_config():
         print(f"{Fore.RED}Erreur lors du chargement de la configuration: {e}{Style.RESET_ALL}")
         return None
 
-def get_server_status(server):
-    """Récupère le statut d'un serveur Fishnet"""
-    server_name = server['name']
-    server_url = server['url']
-    api_key = server.get('key', '')
+# Session du CLI, sans nouvelles tentatives : --timeout borne la durée totale
+NO_RETRIES = {'retries': 0, 'connect_retries': 0, 'read_retries': 0}
+_session = None
+
+def get_session(http_config=None):
+    """Session HTTP du CLI, construite au premier appel depuis la section exporter.http"""
+    global _session
+    if _session is None:
+        http_config = dict(http_config or {}, **NO_RETRIES)
+        http_config['hosts'] = {prefix: dict(overrides or {}, **NO_RETRIES) for prefix, overrides in (http_config.get('hosts') or {}).items()}
+        _session = build_session(http_config)
+    return _session
+
+# Cache local des réponses, activé avec --cache-ttl
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'fishnet-cli')
+
+def cache_path(server):
+    """Fichier de cache d'un serveur, nommé d'après son URL et sa clé sans les révéler"""
+    digest = hashlib.sha256(f"{server['url']}\0{server.get('key') or ''}".encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f'{digest[:32]}.json')
+
+def read_cache(server, ttl):
+    """Réponse en cache d'un serveur si elle a moins de ttl secondes"""
+    path = cache_path(server)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, 'rb') as file:
+            return json.loads(file.read())
+    except (OSError, ValueError):
+        return None
+
+def write_cache(server, body):
+    """Garde la réponse brute d'un serveur, lisible par l'utilisateur seul"""
+    path = cache_path(server)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(f'{path}.{os.getpid()}', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(body)
+        os.replace(f'{path}.{os.getpid()}', path)
+    except OSError:
+        pass
+
+def fetch_server_status(server, http_config=None, timeout=10, cache_ttl=0, deadline=None):
+    """Récupère le statut d'un serveur Fishnet avant deadline (time.monotonic()), renvoie (données, message d'erreur)"""
+    if cache_ttl > 0:
+        data = read_cache(server, cache_ttl)
+        if data is not None:
+            return data, None
     
-    print(f"{Fore.BLUE}Interrogation du serveur {server_name}...{Style.RESET_ALL}")
+    if deadline is not None:
+        # Une requête restée en file d'attente n'a droit qu'au temps restant
+        timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            return None, f"Délai dépassé pour {server['name']}"
     
+    api_key = server.get('key', '')
     try:
         headers = {}
         if api_key:
             headers['Authorization'] = f'Bearer {api_key}'
             
-        response = requests.get(server_url, headers=headers, timeout=10)
+        response = get_session(http_config).get(server['url'], headers=headers, timeout=timeout)
         
         if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"{Fore.RED}Erreur HTTP {response.status_code} pour {server_name}{Style.RESET_ALL}")
-            return None
+            data = response.json()
+            if cache_ttl > 0:
+                write_cache(server, response.content)
+            return data, None
+        return None, f"Erreur HTTP {response.status_code} pour {server['name']}"
     except Exception as e:
-        print(f"{Fore.RED}Erreur de connexion à {server_name}: {e}{Style.RESET_ALL}")
-        return None
+        return None, f"Erreur de connexion à {server['name']}: {e}"
+
+def get_server_status(server, http_config=None):
+    """Récupère le statut d'un serveur Fishnet"""
+    print(f"{Fore.BLUE}Interrogation du serveur {server['name']}...{Style.RESET_ALL}")
+    data, error = fetch_server_status(server, http_config)
+    if error:
+        print(f"{Fore.RED}{error}{Style.RESET_ALL}")
+    return data
+
+def fetch_all(executor, servers, http_config=None, timeout=15, cache_ttl=0):
+    """Interroge tous les serveurs en parallèle dans la limite de timeout secondes, renvoie {nom: (données, erreur)}"""
+    deadline = time.monotonic() + timeout
+    futures = {
+        server['name']: executor.submit(fetch_server_status, server, http_config, timeout, cache_ttl, deadline)
+        for server in servers
+    }
+    wait(futures.values(), timeout=max(0, deadline - time.monotonic()))
+    results = {}
+    for name, future in futures.items():
+        if future.done():
+            results[name] = future.result()
+        else:
+            future.cancel()
+            results[name] = (None, f"Délai de {timeout} s dépassé pour {name}")
+    return results
 
 def format_nodes_info(data):
     """Affiche les informations sur les nœuds connectés"""
@@ -160,13 +253,116 @@ def display_server_status(server_name, data):
     format_client_info(data)
     format_jobs_info(data)
 
+def format_jobs_delta(previous, data, elapsed):
+    """Affiche les jobs complétés depuis le rafraîchissement précédent"""
+    print(f"\n{Fore.GREEN}=== Jobs complétés sur les {elapsed:.0f} dernières secondes ==={Style.RESET_ALL}")
+    completed = data.get('jobs', {}).get('completed', {})
+    before = (previous or {}).get('jobs', {}).get('completed', {})
+    
+    table_data = []
+    for job_type, count in completed.items():
+        if job_type not in before:
+            table_data.append([job_type, count, '-', '-'])
+            continue
+        # Un total qui diminue signale un redémarrage du serveur
+        delta = count - before[job_type] if count >= before[job_type] else count
+        table_data.append([job_type, count, f"+{delta}", f"{delta * 60.0 / elapsed:.1f}" if elapsed > 0 else '-'])
+    
+    print(tabulate(table_data, headers=["Type", "Total", "Écart", "Par minute"], tablefmt="simple"))
+
+def render(function, *args):
+    """Texte produit par une fonction d'affichage"""
+    output = io.StringIO()
+    with redirect_stdout(output):
+        function(*args)
+    return output.getvalue()
+
+class WatchView:
+    """Affichage de --watch, qui ne recalcule que les sections dont les données ont changé"""
+    
+    SECTIONS = [
+        (format_nodes_info, lambda data: data.get('nodes')),
+        (format_queue_info, lambda data: data.get('queue')),
+        (format_performance_info, lambda data: data.get('performance')),
+        (format_client_info, lambda data: data.get('clients')),
+        (format_jobs_info, lambda data: data.get('jobs'))
+    ]
+    
+    def __init__(self):
+        # (serveur, section) -> (données de la section, texte affiché)
+        self._rendered = {}
+        self._previous = {}
+    
+    def server_text(self, name, data, error, elapsed):
+        lines = [
+            f"\n{Fore.GREEN}{'=' * 50}{Style.RESET_ALL}",
+            f"{Fore.GREEN}Statut du serveur: {Fore.YELLOW}{name}{Style.RESET_ALL}",
+            f"{Fore.GREEN}{'=' * 50}{Style.RESET_ALL}"
+        ]
+        if data is None:
+            lines.append(f"{Fore.RED}{error or 'Aucune donnée disponible pour ce serveur'}{Style.RESET_ALL}")
+            return '\n'.join(lines) + '\n'
+        
+        text = '\n'.join(lines) + '\n'
+        for function, section in self.SECTIONS:
+            key = (name, function.__name__)
+            value = section(data)
+            cached = self._rendered.get(key)
+            if cached is None or cached[0] != value:
+                cached = (value, render(function, data))
+                self._rendered[key] = cached
+            text += cached[1]
+        if name in self._previous:
+            text += render(format_jobs_delta, self._previous[name], data, elapsed)
+        self._previous[name] = data
+        return text
+    
+    def draw(self, results, elapsed):
+        header = f"{Style.BRIGHT}Fishnet - {time.strftime('%H:%M:%S')} - Ctrl+C pour quitter{Style.RESET_ALL}\n"
+        frame = header + ''.join(self.server_text(name, data, error, elapsed) for name, (data, error) in results.items())
+        # Réécrit l'écran en place, ligne par ligne, sans l'effacer d'abord
+        lines = frame.split('\n')
+        sys.stdout.write('\033[H' + '\n'.join(line + '\033[K' for line in lines) + '\033[J')
+        sys.stdout.flush()
+
+def watch(servers, http_config, interval, timeout):
+    """Rafraîchit le statut des serveurs toutes les interval secondes"""
+    view = WatchView()
+    # La session partagée garde les connexions ouvertes d'un rafraîchissement à l'autre
+    executor = ThreadPoolExecutor(max_workers=min(32, len(servers)))
+    sys.stdout.write('\033[2J')
+    last = None
+    try:
+        while True:
+            started = time.monotonic()
+            results = fetch_all(executor, servers, http_config, timeout)
+            view.draw(results, started - last if last is not None else 0)
+            last = started
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print()
+
+def exit_now(code=0):
+    """Quitte sans attendre les requêtes abandonnées après le délai, que l'interpréteur joindrait sinon"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
 def main():
     parser = argparse.ArgumentParser(description='Outil CLI pour visualiser le statut des serveurs Fishnet')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG_PATH, help='Fichier de configuration')
     parser.add_argument('-s', '--server', help='Nom du serveur spécifique à vérifier')
     parser.add_argument('-j', '--json', action='store_true', help='Afficher la sortie au format JSON brut')
+    parser.add_argument('-t', '--timeout', type=float, default=15, help='Délai maximal pour interroger tous les serveurs, en secondes')
+    parser.add_argument('--cache-ttl', type=float, default=0, help='Réutiliser les réponses de moins de N secondes (désactivé par défaut)')
+    parser.add_argument('-w', '--watch', action='store_true', help='Rafraîchir l\'affichage en continu')
+    parser.add_argument('-i', '--interval', type=float, default=5, help='Intervalle de rafraîchissement de --watch, en secondes')
     args = parser.parse_args()
+    if args.watch and args.json:
+        parser.error("--watch et --json ne peuvent pas être combinés")
+    load_ui(tables=not args.json)
     
-    config = load_config()
+    config = load_config(args.config)
     if not config:
         sys.exit(1)
     
@@ -177,31 +373,31 @@ def main():
     
     if args.server:
         # Vérifier un serveur spécifique
-        server_found = False
-        for server in servers:
-            if server['name'] == args.server:
-                server_found = True
-                data = get_server_status(server)
-                
-                if args.json and data:
-                    print(json.dumps(data, indent=4))
-                else:
-                    display_server_status(server['name'], data)
-                break
-        
-        if not server_found:
+        servers = [server for server in servers if server['name'] == args.server]
+        if not servers:
             print(f"{Fore.RED}Serveur '{args.server}' non trouvé dans la configuration{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}Serveurs disponibles: {', '.join([s['name'] for s in servers])}{Style.RESET_ALL}")
-    else:
-        # Vérifier tous les serveurs
-        for server in servers:
-            data = get_server_status(server)
-            
-            if args.json and data:
-                print(f"\n{Fore.YELLOW}{server['name']}:{Style.RESET_ALL}")
-                print(json.dumps(data, indent=4))
-            else:
-                display_server_status(server['name'], data)
+            print(f"{Fore.YELLOW}Serveurs disponibles: {', '.join([s['name'] for s in config['servers']])}{Style.RESET_ALL}")
+            return
+    
+    http_config = config.get('exporter', {}).get('http')
+    if args.watch:
+        watch(servers, http_config, args.interval, args.timeout)
+        exit_now()
+    
+    print(f"{Fore.BLUE}Interrogation de {len(servers)} serveur(s)...{Style.RESET_ALL}")
+    executor = ThreadPoolExecutor(max_workers=min(32, len(servers)))
+    results = fetch_all(executor, servers, http_config, args.timeout, args.cache_ttl)
+    
+    for name, (data, error) in results.items():
+        if error:
+            print(f"{Fore.RED}{error}{Style.RESET_ALL}")
+        if args.json and data:
+            if not args.server:
+                print(f"\n{Fore.YELLOW}{name}:{Style.RESET_ALL}")
+            print(json.dumps(data, indent=4))
+        else:
+            display_server_status(name, data)
+    exit_now()
 
 if __name__ == '__main__':
     main()
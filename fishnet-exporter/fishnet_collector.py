@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Fishnet collection engine
+Shared by fishnet_exporter.py and fishnet_exporter_modified.py. Polls every
+configured Fishnet status endpoint concurrently on a bounded worker pool, with
+a per-server deadline and a global cycle deadline, and records the results in
+the Prometheus metrics defined below, or in the immutable snapshots of
+fishnet_snapshot.py when exporter.collection_mode is 'snapshot'.
+"""
+
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from prometheus_client import Gauge, Counter, REGISTRY
+from fishnet_http import get_session
+from fishnet_state import UPSTREAM_STATE
+from fishnet_series import SeriesTracker, DEFAULT_SERIES_CONFIG
+from fishnet_profiling import stage, observe_payload
+from fishnet_decode import decode_status, section_fingerprint, DEFAULT_JSON_BACKEND
+from fishnet_snapshot import SNAPSHOT
+from fishnet_stats import WINDOW_STATS
+from fishnet_adaptive import ADAPTIVE_POLICY
+from fishnet_warmstart import WarmStart
+
+logger = logging.getLogger('fishnet-exporter')
+
+# Prometheus metrics
+FISHNET_UP = Gauge('fishnet_up', 'Status of Fishnet instance', ['instance'])
+FISHNET_NODES = Gauge('fishnet_nodes_total', 'Number of connected nodes', ['instance'])
+FISHNET_JOBS_QUEUED = Gauge('fishnet_jobs_queued', 'Number of jobs in queue', ['instance', 'job_type'])
+FISHNET_JOBS_COMPLETED = Counter('fishnet_jobs_completed_total', 'Total number of completed jobs', ['instance', 'job_type'])
+FISHNET_JOBS_REJECTED = Counter('fishnet_jobs_rejected_total', 'Total number of rejected jobs', ['instance', 'job_type'])
+FISHNET_CLIENT_VERSION = Gauge('fishnet_client_version', 'Version information for each client', ['instance', 'client_id', 'version'])
+FISHNET_ANALYSES_SECOND = Gauge('fishnet_analyses_per_second', 'Analyses per second', ['instance'])
+FISHNET_MOVE_TIME = Gauge('fishnet_move_time_ms', 'Average time per move in milliseconds', ['instance', 'depth'])
+FISHNET_CLIENT_VERSIONS = Gauge('fishnet_client_versions', 'Number of connected clients per version', ['instance', 'version'])
+
+# Served by the snapshot collector instead in snapshot mode
+FISHNET_GAUGE_METRICS = (
+    FISHNET_UP, FISHNET_NODES, FISHNET_JOBS_QUEUED, FISHNET_JOBS_COMPLETED, FISHNET_JOBS_REJECTED,
+    FISHNET_CLIENT_VERSION, FISHNET_ANALYSES_SECOND, FISHNET_MOVE_TIME, FISHNET_CLIENT_VERSIONS
+)
+
+# Collection engine metrics
+FISHNET_COLLECT_DURATION = Gauge('fishnet_collect_duration_seconds', 'Duration of the last status poll per server', ['instance'])
+FISHNET_COLLECT_TIMEOUTS = Counter('fishnet_collect_timeouts_total', 'Status polls abandoned after a deadline', ['instance', 'deadline'])
+FISHNET_CYCLE_DURATION = Gauge('fishnet_collect_cycle_duration_seconds', 'Duration of the last full collection cycle')
+FISHNET_COLLECT_SKIPPED = Counter('fishnet_collect_skipped_total', 'Polls whose payload was not processed because it did not change', ['instance', 'reason'])
+
+# Defaults for the 'exporter' section of the configuration
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_SERVER_TIMEOUT = 10
+DEFAULT_CYCLE_TIMEOUT = 30
+DEFAULT_CONDITIONAL_REQUESTS = True
+DEFAULT_COLLECTION_MODE = 'gauges'
+
+# Lifecycle of the series whose label sets churn with the connected clients
+CLIENT_VERSION_SERIES = SeriesTracker(FISHNET_CLIENT_VERSION, 'fishnet_client_version')
+CLIENT_VERSIONS_SERIES = SeriesTracker(FISHNET_CLIENT_VERSIONS, 'fishnet_client_versions', evict_after=1)
+MOVE_TIME_SERIES = SeriesTracker(FISHNET_MOVE_TIME, 'fishnet_move_time_ms')
+_series_config = dict(DEFAULT_SERIES_CONFIG)
+
+_executor = None
+_executor_size = 0
+_executor_lock = threading.Lock()
+
+_collection_mode = None
+_collection_mode_lock = threading.Lock()
+
+
+def get_executor(max_workers):
+    """Return the shared worker pool, resizing it when the configuration changes"""
+    global _executor, _executor_size
+    with _executor_lock:
+        if _executor is None or _executor_size != max_workers:
+            if _executor is not None:
+                # Running polls finish on their own; they are bounded by their timeout
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fishnet-poll')
+            _executor_size = max_workers
+        return _executor
+
+
+def configure_series(series_config):
+    """Apply the 'exporter.series' section to the series trackers"""
+    global _series_config
+    _series_config = dict(DEFAULT_SERIES_CONFIG, **(series_config or {}))
+    evict_after = _series_config['evict_after_cycles']
+    max_series = _series_config['max_series'] or {}
+    for tracker in (CLIENT_VERSION_SERIES, MOVE_TIME_SERIES):
+        tracker.configure(evict_after, max_series.get(tracker.name))
+
+
+def fetch_server_status(session, server, timeout, started, json_backend=DEFAULT_JSON_BACKEND, conditional=DEFAULT_CONDITIONAL_REQUESTS):
+    """Fetch the status payload of a single Fishnet server, returns (status_code, data, validators)"""
+    server_name = server['name']
+    started[server_name] = time.monotonic()
+    api_key = server.get('key', '')
+
+    headers = {}
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    previous = UPSTREAM_STATE.validators(server_name) if conditional else {}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+
+    with stage('fetch'):
+        response = session.get(server['url'], headers=headers, timeout=timeout)
+    observe_payload('upstream', len(response.content))
+    # Unchanged payloads, answered 304 or identical to the last processed body, come back as 304
+    if response.status_code == 304 and previous:
+        FISHNET_COLLECT_SKIPPED.labels(instance=server_name, reason='not_modified').inc()
+        return 304, None, None
+    if response.status_code != 200:
+        return response.status_code, None, None
+
+    validators = None
+    if conditional:
+        # Servers without ETag/Last-Modified still get their unchanged bodies skipped
+        body_hash = hashlib.blake2b(response.content, digest_size=16).digest()
+        if body_hash == previous.get('body_hash'):
+            FISHNET_COLLECT_SKIPPED.labels(instance=server_name, reason='unchanged_body').inc()
+            return 304, None, None
+        validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'body_hash': body_hash
+        }
+    with stage('decode'):
+        return response.status_code, decode_status(response.content, json_backend), validators
+
+
+def record_server_metrics(server_name, data):
+    """Record the metrics of a successfully polled server"""
+    FISHNET_UP.labels(instance=server_name).set(1)
+    UPSTREAM_STATE.update_payload(server_name, data)
+
+    # Parse and record metrics
+    FISHNET_NODES.labels(instance=server_name).set(data.get('nodes', 0))
+
+    # Queue stats
+    queue = data.get('queue', {})
+    if UPSTREAM_STATE.section_changed(server_name, 'queue', queue):
+        for job_type, count in queue.items():
+            FISHNET_JOBS_QUEUED.labels(instance=server_name, job_type=job_type).set(count)
+
+    # Job stats - the API returns cumulative totals, counters only get the delta
+    jobs = data.get('jobs', {})
+    if UPSTREAM_STATE.section_changed(server_name, 'jobs', jobs):
+        for kind, counter in (('completed', FISHNET_JOBS_COMPLETED), ('rejected', FISHNET_JOBS_REJECTED)):
+            for job_type, count in jobs.get(kind, {}).items():
+                delta = UPSTREAM_STATE.counter_delta(server_name, kind, job_type, count)
+                child = counter.labels(instance=server_name, job_type=job_type)
+                if delta > 0:
+                    child.inc(delta)
+
+    # Client versions, capped per metric; absent clients are evicted.
+    # With the lazy decoder, clients are decoded one by one as they are recorded
+    clients = data.get('clients', {})
+    if UPSTREAM_STATE.section_changed(server_name, 'clients', section_fingerprint(clients)):
+        versions = {}
+        for client_id, info in clients.items():
+            version = info.get('version', 'unknown')
+            versions[version] = versions.get(version, 0) + 1
+            labels = (server_name, client_id, version)
+            if CLIENT_VERSION_SERIES.touch(labels):
+                FISHNET_CLIENT_VERSION.labels(*labels).set(1)
+        CLIENT_VERSION_SERIES.end_cycle(server_name)
+
+        # Aggregate counts per version, complete even past the per-client cap
+        if _series_config['rollup_client_versions']:
+            for version, count in versions.items():
+                CLIENT_VERSIONS_SERIES.touch((server_name, version))
+                FISHNET_CLIENT_VERSIONS.labels(instance=server_name, version=version).set(count)
+            CLIENT_VERSIONS_SERIES.end_cycle(server_name)
+
+    # Performance metrics
+    performance = data.get('performance', {})
+    FISHNET_ANALYSES_SECOND.labels(instance=server_name).set(
+        performance.get('analyses_per_second', 0)
+    )
+
+    # Move time at different depths
+    move_time = performance.get('move_time', {})
+    if UPSTREAM_STATE.section_changed(server_name, 'move_time', move_time):
+        for depth, time_ms in move_time.items():
+            if MOVE_TIME_SERIES.touch((server_name, depth)):
+                FISHNET_MOVE_TIME.labels(instance=server_name, depth=depth).set(time_ms)
+        MOVE_TIME_SERIES.end_cycle(server_name)
+
+
+def record_server_down(server_name):
+    """Record a failed poll; the series of a server down for too long are evicted"""
+    FISHNET_UP.labels(instance=server_name).set(0)
+    UPSTREAM_STATE.invalidate_validators(server_name)
+    # Re-apply evicted sections on recovery, even if they did not change
+    if CLIENT_VERSION_SERIES.end_cycle(server_name):
+        CLIENT_VERSIONS_SERIES.forget(server_name)
+        UPSTREAM_STATE.invalidate_section(server_name, 'clients')
+    if MOVE_TIME_SERIES.end_cycle(server_name):
+        UPSTREAM_STATE.invalidate_section(server_name, 'move_time')
+
+
+def record_server_unchanged(server_name):
+    """Record a poll whose payload did not change since the last processed one"""
+    # Nothing to update; the series trackers do not advance either
+    FISHNET_UP.labels(instance=server_name).set(1)
+
+
+def get_recorders(exporter_config):
+    """Return the (record, record_down, record_unchanged) functions of the collection mode"""
+    global _collection_mode
+    mode = exporter_config.get('collection_mode', DEFAULT_COLLECTION_MODE)
+    with _collection_mode_lock:
+        if _collection_mode is None:
+            # The mode is fixed by the first cycle, switching needs a restart
+            _collection_mode = mode
+            if mode == 'snapshot':
+                for metric in FISHNET_GAUGE_METRICS:
+                    REGISTRY.unregister(metric)
+                SNAPSHOT.enabled = True
+                logger.info("Collecting in snapshot mode")
+        elif mode != _collection_mode:
+            logger.warning(f"collection_mode changed to {mode}, restart the exporter to apply it")
+
+    if _collection_mode == 'snapshot':
+        SNAPSHOT.configure(exporter_config.get('series'))
+        return SNAPSHOT.record, SNAPSHOT.record_down, SNAPSHOT.record_unchanged
+    return record_server_metrics, record_server_down, record_server_unchanged
+
+
+def capture_state():
+    """Collector state saved for a warm start: exported series and last upstream counters"""
+    counters = [[instance, kind, job_type, value] for (instance, kind, job_type), value in UPSTREAM_STATE.counters().items()]
+    state = {'mode': _collection_mode, 'counters': counters}
+    if _collection_mode == 'snapshot':
+        state['snapshot'] = SNAPSHOT.entries()
+        return state
+    state['series'] = series = {}
+    for metric in FISHNET_GAUGE_METRICS:
+        for family in metric.collect():
+            series[family.name] = [
+                (sample.labels, sample.value) for sample in family.samples
+                # Counters are restored from their total, their creation time is new
+                if family.type != 'counter' or sample.name.endswith('_total')
+            ]
+    return state
+
+
+def restore_state(state, instances):
+    """Apply the part of a state saved by capture_state() about the given instances, returns the restored ones"""
+    if state.get('mode') != _collection_mode:
+        logger.info(f"Warm-start state was saved in {state.get('mode')} mode, not restoring it")
+        return []
+    UPSTREAM_STATE.restore_counters({
+        (instance, kind, job_type): value
+        for instance, kind, job_type, value in state['counters'] if instance in instances
+    })
+    if _collection_mode == 'snapshot':
+        return SNAPSHOT.restore({instance: entry for instance, entry in state['snapshot'].items() if instance in instances})
+
+    metrics = {family.name: metric for metric in FISHNET_GAUGE_METRICS for family in metric.collect()}
+    trackers = {tracker.name: tracker for tracker in (CLIENT_VERSION_SERIES, CLIENT_VERSIONS_SERIES, MOVE_TIME_SERIES)}
+    restored = set()
+    for name, samples in state['series'].items():
+        metric = metrics.get(name)
+        if metric is None:
+            continue
+        tracker = trackers.get(name)
+        for labels, value in samples:
+            if labels.get('instance') not in instances:
+                continue
+            # Restored per-client series age out like polled ones, within the same caps
+            if tracker is not None and not tracker.touch(tuple(labels.values())):
+                continue
+            child = metric.labels(**labels)
+            if isinstance(metric, Counter):
+                child.inc(value)
+            else:
+                child.set(value)
+            restored.add(labels['instance'])
+    return sorted(restored)
+
+
+# Saved state of the collector, restored by the first cycle
+WARM_START = WarmStart(capture_state, restore_state)
+
+
+def collect_servers(config, on_done=None):
+    """Poll all configured servers concurrently and record their metrics, calling on_done(name) as each one ends"""
+    exporter_config = config.get('exporter', {})
+    max_workers = exporter_config.get('max_workers', DEFAULT_MAX_WORKERS)
+    default_timeout = exporter_config.get('server_timeout', DEFAULT_SERVER_TIMEOUT)
+    cycle_timeout = exporter_config.get('cycle_timeout', DEFAULT_CYCLE_TIMEOUT)
+    json_backend = exporter_config.get('json_backend', DEFAULT_JSON_BACKEND)
+    conditional = exporter_config.get('conditional_requests', DEFAULT_CONDITIONAL_REQUESTS)
+
+    servers = config.get('servers', [])
+    if not servers:
+        return
+
+    configure_series(exporter_config.get('series'))
+    record, record_down, record_unchanged = get_recorders(exporter_config)
+    WINDOW_STATS.configure(exporter_config.get('stats'))
+    WARM_START.configure(exporter_config.get('warm_start'))
+    # Once the collection mode is known, before anything is polled
+    WARM_START.load(server['name'] for server in servers)
+    cycle_start = time.monotonic()
+    cycle_deadline = cycle_start + cycle_timeout
+    started = {}
+    pending = {}
+    executor = get_executor(max_workers)
+    session = get_session(exporter_config.get('http'))
+    for server in servers:
+        timeout = ADAPTIVE_POLICY.poll_timeout(server['name'], server.get('timeout', default_timeout))
+        future = executor.submit(fetch_server_status, session, server, timeout, started, json_backend, conditional)
+        pending[future] = (server['name'], timeout)
+
+    while pending:
+        now = time.monotonic()
+        # Wake up at the earliest per-server deadline, or at the cycle deadline
+        next_deadline = cycle_deadline
+        for future, (server_name, timeout) in pending.items():
+            if server_name in started:
+                next_deadline = min(next_deadline, started[server_name] + timeout)
+
+        done, _ = wait(pending, timeout=max(0, next_deadline - now), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            server_name, _ = pending.pop(future)
+            FISHNET_COLLECT_DURATION.labels(instance=server_name).set(
+                time.monotonic() - started.get(server_name, cycle_start)
+            )
+            try:
+                status_code, data, validators = future.result()
+                if status_code == 200:
+                    with stage('record'):
+                        record(server_name, data)
+                        WINDOW_STATS.observe(server_name, data)
+                        ADAPTIVE_POLICY.succeeded(server_name, data)
+                    # Only a fully processed payload may be skipped next time
+                    if validators is not None:
+                        UPSTREAM_STATE.update_validators(server_name, validators)
+                    logger.info(f"Successfully collected metrics from {server_name}")
+                elif status_code == 304:
+                    record_unchanged(server_name)
+                    WINDOW_STATS.observe_unchanged(server_name)
+                    ADAPTIVE_POLICY.succeeded(server_name)
+                    logger.info(f"Metrics of {server_name} unchanged since the last poll")
+                else:
+                    record_down(server_name)
+                    WINDOW_STATS.observe_down(server_name)
+                    ADAPTIVE_POLICY.failed(server_name)
+                    logger.warning(f"Failed to collect metrics from {server_name}: HTTP {status_code}")
+            except Exception as e:
+                record_down(server_name)
+                WINDOW_STATS.observe_down(server_name)
+                ADAPTIVE_POLICY.failed(server_name)
+                logger.error(f"Error collecting metrics from {server_name}: {e}")
+            WARM_START.polled(server_name)
+            if on_done is not None:
+                on_done(server_name)
+
+        now = time.monotonic()
+        for future, (server_name, timeout) in list(pending.items()):
+            if now >= cycle_deadline:
+                deadline = 'cycle'
+            elif server_name in started and now >= started[server_name] + timeout:
+                deadline = 'server'
+            else:
+                continue
+            # The poll keeps running in the pool until its own timeout, its result is ignored
+            pending.pop(future)
+            future.cancel()
+            record_down(server_name)
+            WINDOW_STATS.observe_down(server_name)
+            ADAPTIVE_POLICY.failed(server_name)
+            FISHNET_COLLECT_TIMEOUTS.labels(instance=server_name, deadline=deadline).inc()
+            FISHNET_COLLECT_DURATION.labels(instance=server_name).set(now - started.get(server_name, cycle_start))
+            logger.error(f"Error collecting metrics from {server_name}: {deadline} deadline exceeded")
+            WARM_START.polled(server_name)
+            if on_done is not None:
+                on_done(server_name)
+
+    FISHNET_CYCLE_DURATION.set(time.monotonic() - cycle_start)
+    WARM_START.save()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Fishnet configuration store
+Keeps the parsed and validated YAML configuration in memory. The file is only
+re-read when its modification time changes or when the process receives
+SIGHUP; an invalid file is rejected and the last good configuration is kept.
+"""
+
+import os
+import copy
+import signal
+import logging
+import threading
+import time
+import yaml
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger('fishnet-exporter')
+
+CONFIG_PATH = os.environ.get('FISHNET_CONFIG', '/app/config/fishnet_config.yaml')
+
+FISHNET_CONFIG_RELOADS = Counter('fishnet_config_reloads_total', 'Configuration reloads', ['result'])
+FISHNET_CONFIG_LAST_RELOAD = Gauge('fishnet_config_last_reload_timestamp_seconds', 'Time of the last successful configuration reload')
+
+# Expected type for each known key; nested dicts describe sub-sections
+SERVER_SCHEMA = {
+    'name': str,
+    'url': str,
+    'key': (str, type(None)),
+    'timeout': (int, float),
+    'interval': (int, float)
+}
+
+SCHEMA = {
+    'servers': list,
+    'exporter': {
+        'port': int,
+        'scrape_interval': (int, float),
+        'max_workers': int,
+        'server_timeout': (int, float),
+        'cycle_timeout': (int, float),
+        'http': dict,
+        'series': dict,
+        'profiling': dict,
+        'json_backend': str,
+        'conditional_requests': bool,
+        'collection_mode': str,
+        'stats': dict,
+        'warm_start': dict,
+        'adaptive': dict
+    },
+    'metrics_server': {
+        'enabled': bool,
+        'mode': str,
+        'central_url': str,
+        'central_urls': list,
+        'shard': dict,
+        'spool': dict,
+        'auth_key': (str, type(None)),
+        'client_id': (str, type(None)),
+        'ingest': dict,
+        'push': dict,
+        'output': str,
+        'remote_write': dict,
+        'server': dict
+    }
+}
+
+METRICS_SERVER_MODES = ('central', 'client')
+OUTPUTS = ('push', 'remote_write')
+# 'stream' is kept as the former name of 'lazy'
+JSON_BACKENDS = ('auto', 'orjson', 'lazy', 'stream', 'stdlib')
+COLLECTION_MODES = ('gauges', 'snapshot')
+
+
+class ConfigError(ValueError):
+    """Raised when the configuration file does not match the schema"""
+
+
+def _check_section(section, schema, path, errors):
+    if not isinstance(section, dict):
+        errors.append(f"{path}: expected a mapping")
+        return
+    for key, expected in schema.items():
+        if key not in section:
+            continue
+        value = section[key]
+        if isinstance(expected, dict):
+            _check_section(value, expected, f"{path}.{key}", errors)
+        elif isinstance(value, bool) and expected in (int, (int, float)):
+            errors.append(f"{path}.{key}: expected a number, got a boolean")
+        elif not isinstance(value, expected):
+            errors.append(f"{path}.{key}: unexpected type {type(value).__name__}")
+
+
+def validate_config(config):
+    """Validate a parsed configuration, raises ConfigError listing every problem"""
+    errors = []
+    if not isinstance(config, dict):
+        raise ConfigError("configuration root must be a mapping")
+
+    _check_section(config, SCHEMA, 'config', errors)
+
+    servers = config.get('servers') or []
+    for i, server in enumerate(servers if isinstance(servers, list) else []):
+        path = f"config.servers[{i}]"
+        if not isinstance(server, dict):
+            errors.append(f"{path}: expected a mapping")
+            continue
+        for key in ('name', 'url'):
+            if not server.get(key):
+                errors.append(f"{path}.{key}: required")
+        _check_section(server, SERVER_SCHEMA, path, errors)
+        for key in ('timeout', 'interval'):
+            value = server.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value <= 0:
+                errors.append(f"{path}.{key}: must be positive")
+
+    exporter = config.get('exporter') or {}
+    if isinstance(exporter, dict):
+        for key in ('scrape_interval', 'max_workers', 'server_timeout', 'cycle_timeout'):
+            value = exporter.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value <= 0:
+                errors.append(f"config.exporter.{key}: must be positive")
+        if exporter.get('json_backend', 'auto') not in JSON_BACKENDS:
+            errors.append(f"config.exporter.json_backend: must be one of {', '.join(JSON_BACKENDS)}")
+        if exporter.get('collection_mode', 'gauges') not in COLLECTION_MODES:
+            errors.append(f"config.exporter.collection_mode: must be one of {', '.join(COLLECTION_MODES)}")
+        adaptive = exporter.get('adaptive') or {}
+        if isinstance(adaptive, dict):
+            for key in ('min_interval', 'max_interval', 'failure_threshold', 'max_backoff', 'probe_timeout'):
+                value = adaptive.get(key)
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and value <= 0:
+                    errors.append(f"config.exporter.adaptive.{key}: must be positive")
+            low, high = adaptive.get('min_interval', 0), adaptive.get('max_interval')
+            if isinstance(low, (int, float)) and isinstance(high, (int, float)) and low > high:
+                errors.append("config.exporter.adaptive.min_interval: must not exceed max_interval")
+
+    metrics_server = config.get('metrics_server') or {}
+    if isinstance(metrics_server, dict) and metrics_server.get('mode', 'central') not in METRICS_SERVER_MODES:
+        errors.append(f"config.metrics_server.mode: must be one of {', '.join(METRICS_SERVER_MODES)}")
+    if isinstance(metrics_server, dict) and metrics_server.get('output', 'push') not in OUTPUTS:
+        errors.append(f"config.metrics_server.output: must be one of {', '.join(OUTPUTS)}")
+    remote_write = metrics_server.get('remote_write') if isinstance(metrics_server, dict) else None
+    if isinstance(remote_write, dict):
+        if 'url' in remote_write and not (isinstance(remote_write['url'], str) and remote_write['url']):
+            errors.append("config.metrics_server.remote_write.url: must be a URL")
+        for key in ('shards', 'queue_capacity', 'max_samples_per_send'):
+            value = remote_write.get(key)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+                errors.append(f"config.metrics_server.remote_write.{key}: must be a positive integer")
+    central_urls = metrics_server.get('central_urls') if isinstance(metrics_server, dict) else None
+    if isinstance(central_urls, list) and not all(isinstance(url, str) and url for url in central_urls):
+        errors.append("config.metrics_server.central_urls: must be a list of URLs")
+
+    if errors:
+        raise ConfigError('; '.join(errors))
+
+
+def merge_defaults(config, default):
+    """Fill missing top-level sections and section keys from the defaults"""
+    merged = copy.deepcopy(default)
+    for key, value in config.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        elif value is not None:
+            merged[key] = value
+    return merged
+
+
+class ConfigStore:
+    """In-memory configuration, reloaded on file change or SIGHUP"""
+
+    def __init__(self, path, default, check_interval=1.0):
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+        self._config = None
+        self._stamp = None
+        self._next_check = 0
+        self._reload_requested = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the current configuration, reloading it first if needed"""
+        now = time.monotonic()
+        if self._config is not None and not self._reload_requested and now < self._next_check:
+            return self._config
+
+        with self._lock:
+            if self._config is None or self._reload_requested or now >= self._next_check:
+                self._next_check = now + self.check_interval
+                stamp = self._file_stamp()
+                if self._config is None or self._reload_requested or stamp != self._stamp:
+                    self._reload_requested = False
+                    self._load(stamp)
+        return self._config
+
+    def request_reload(self):
+        """Force a reload on the next access"""
+        self._reload_requested = True
+
+    def install_sighup_handler(self, on_reload=None):
+        """Reload the configuration when the process receives SIGHUP"""
+        if not hasattr(signal, 'SIGHUP'):
+            return
+
+        def handle_sighup(signum, frame):
+            logger.info("SIGHUP received, configuration will be reloaded")
+            self.request_reload()
+            if on_reload is not None:
+                on_reload()
+
+        signal.signal(signal.SIGHUP, handle_sighup)
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def _load(self, stamp):
+        try:
+            with open(self.path, 'r') as file:
+                config = yaml.safe_load(file)
+            validate_config(config)
+            self._config = merge_defaults(config, self.default)
+            self._stamp = stamp
+            FISHNET_CONFIG_RELOADS.labels(result='success').inc()
+            FISHNET_CONFIG_LAST_RELOAD.set_to_current_time()
+            logger.info("Configuration loaded successfully")
+        except Exception as e:
+            FISHNET_CONFIG_RELOADS.labels(result='error').inc()
+            # Do not retry a broken file until it changes again
+            self._stamp = stamp
+            if self._config is None:
+                logger.warning(f"Error loading config: {e}. Using default configuration")
+                self._config = copy.deepcopy(self.default)
+            else:
+                logger.error(f"Error reloading config: {e}. Keeping the previous configuration")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Fishnet status payload decoding
+The 'clients' map dominates the status payload of large instances. This
+module decodes payloads with orjson when it is installed; otherwise it
+parses every section except 'clients' with the standard library and leaves
+'clients' as a LazySection, whose entries are decoded one at a time as
+they are iterated, so the dict of every decoded client is never built at
+once. This is lazy, not streaming: the whole payload text is kept until the
+section is released, and finding where 'clients' ends still builds the list
+of its keys. Plain json.loads remains available, and is used whenever the
+lazy parse fails.
+"""
+
+import re
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger('fishnet-exporter')
+
+# Values of 'exporter.json_backend'
+DEFAULT_JSON_BACKEND = 'auto'
+
+LAZY_SECTIONS = ('clients',)
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+WHITESPACE_CHARS = ' \t\n\r'
+
+# Decoders driven directly through their C scanner; the second one walks an
+# object to find where it ends, dropping each nested object once scanned
+# (the pair lists are still built, one object at a time)
+_scan = json.JSONDecoder().scan_once
+_skip = json.JSONDecoder(object_pairs_hook=lambda pairs: None).scan_once
+_orjson_warned = False
+
+
+def _skip_whitespace(text, idx):
+    if text[idx] in WHITESPACE_CHARS:
+        return WHITESPACE.match(text, idx).end()
+    return idx
+
+
+def _next_member(text, idx):
+    """Skip the separator after an object member, returns the offset of the next key or of '}'"""
+    idx = _skip_whitespace(text, idx)
+    if text[idx] == '}':
+        return idx
+    if text[idx] != ',':
+        raise ValueError(f"expected ',' or '}}' at offset {idx}")
+    idx = _skip_whitespace(text, idx + 1)
+    if text[idx] != '"':
+        raise ValueError(f"expected a key at offset {idx}")
+    return idx
+
+
+def _scan_value(scan, text, idx):
+    try:
+        return scan(text, idx)
+    except StopIteration:
+        raise ValueError(f"expected a value at offset {idx}")
+
+
+class LazySection:
+    """JSON object left undecoded in the payload, decoded entry by entry on iteration"""
+
+    def __init__(self, text, start, end):
+        self._text = text
+        self._start = start
+        self._end = end
+        # Cheap stand-in for the section in change detection
+        self.fingerprint = (end - start, hash(text[start:end]))
+
+    def items(self):
+        text = self._text
+        idx = _skip_whitespace(text, self._start + 1)
+        while text[idx] != '}':
+            key, idx = _scan_value(_scan, text, idx)
+            idx = _skip_whitespace(text, idx)
+            if text[idx] != ':':
+                raise ValueError(f"expected ':' at offset {idx}")
+            value, idx = _scan_value(_scan, text, _skip_whitespace(text, idx + 1))
+            yield key, value
+            idx = _next_member(text, idx)
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def __bool__(self):
+        return self._text[_skip_whitespace(self._text, self._start + 1)] != '}'
+
+
+def section_fingerprint(section):
+    """Value to compare between polls to detect a changed section"""
+    if isinstance(section, LazySection):
+        return section.fingerprint
+    return section
+
+
+def lazy_decode(text):
+    """Decode a status payload, leaving the lazy sections undecoded"""
+    idx = _skip_whitespace(text, 0)
+    if text[idx:idx + 1] != '{':
+        raise ValueError("payload is not a JSON object")
+    data = {}
+    idx = _skip_whitespace(text, idx + 1)
+    while text[idx] != '}':
+        key, idx = _scan_value(_scan, text, idx)
+        idx = _skip_whitespace(text, idx)
+        if text[idx] != ':':
+            raise ValueError(f"expected ':' at offset {idx}")
+        idx = _skip_whitespace(text, idx + 1)
+        if key in LAZY_SECTIONS and text[idx] == '{':
+            _, end = _scan_value(_skip, text, idx)
+            data[key] = LazySection(text, idx, end)
+            idx = end
+        else:
+            data[key], idx = _scan_value(_scan, text, idx)
+        idx = _next_member(text, idx)
+    return data
+
+
+def decode_status(body, backend=DEFAULT_JSON_BACKEND):
+    """Decode the raw bytes of a status payload with the configured backend"""
+    global _orjson_warned
+    if backend in ('auto', 'orjson'):
+        if orjson is not None:
+            return orjson.loads(body)
+        if backend == 'orjson' and not _orjson_warned:
+            _orjson_warned = True
+            logger.warning("json_backend is orjson but orjson is not installed, using the lazy decoder")
+        backend = 'lazy'
+
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    # 'stream' is the former name of the lazy decoder
+    if backend in ('lazy', 'stream'):
+        try:
+            return lazy_decode(text)
+        except (ValueError, IndexError) as e:
+            logger.debug(f"Lazy decode failed ({e}), falling back to json.loads")
+    return json.loads(text)
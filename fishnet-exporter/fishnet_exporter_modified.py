@@ -4,20 +4,30 @@ Fishnet Exporter for Prometheus
 This script queries the Fishnet API to collect metrics about your Fishnet instances
 and exposes them for Prometheus to scrape. It can run in two modes:
 - Central mode: Collects metrics from Fishnet servers and also receives metrics from client instances
-- Client mode: Collects metrics from Fishnet servers and pushes them to a central server
+- Client mode: Collects metrics from Fishnet servers and pushes them to a central server,
+  or sends them to a Prometheus remote-write endpoint (metrics_server.output: remote_write)
 """
 
-import time
-import yaml
+import gzip
 import json
+import socket
+import time
 import logging
-import requests
 import threading
-import schedule
-from flask import Flask, request, jsonify, Response
-from prometheus_client import start_http_server, Gauge, Counter, generate_latest, REGISTRY
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
-from prometheus_client.exposition import make_wsgi_app
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from fishnet_collector import collect_servers, WARM_START, DEFAULT_CYCLE_TIMEOUT
+from fishnet_config import ConfigStore, CONFIG_PATH
+from fishnet_scheduler import CollectionScheduler, install_shutdown_handlers
+from fishnet_http import get_session
+from fishnet_ingest import PushStore, MergedRegistry, PushError, PushConflict, FISHNET_INGEST_PUSHES
+from fishnet_push import PushEncoder, FilteredRegistry, UnsupportedPush, PushTooLarge, decode_push, DEFAULT_PUSH_CONFIG, FISHNET_PUSH_REJECTED
+from fishnet_server import serve, DEFAULT_SERVER_CONFIG
+from fishnet_profiling import stage, observe_payload, start_metrics_server, start_debug_server
+from fishnet_snapshot import SNAPSHOT_REGISTRY
+from fishnet_shard import SHARD_ROUTER
+from fishnet_spool import SPOOL
+from fishnet_fleet import FLEET
+from fishnet_remote_write import REMOTE_WRITER
 
 # Configure logging
 logging.basicConfig(
@@ -26,16 +36,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger('fishnet-exporter')
 
-# Prometheus metrics
-FISHNET_UP = Gauge('fishnet_up', 'Status of Fishnet instance', ['instance'])
-FISHNET_NODES = Gauge('fishnet_nodes_total', 'Number of connected nodes', ['instance'])
-FISHNET_JOBS_QUEUED = Gauge('fishnet_jobs_queued', 'Number of jobs in queue', ['instance', 'job_type'])
-FISHNET_JOBS_COMPLETED = Counter('fishnet_jobs_completed_total', 'Total number of completed jobs', ['instance', 'job_type'])
-FISHNET_JOBS_REJECTED = Counter('fishnet_jobs_rejected_total', 'Total number of rejected jobs', ['instance', 'job_type'])
-FISHNET_CLIENT_VERSION = Gauge('fishnet_client_version', 'Version information for each client', ['instance', 'client_id', 'version'])
-FISHNET_ANALYSES_SECOND = Gauge('fishnet_analyses_per_second', 'Analyses per second', ['instance'])
-FISHNET_MOVE_TIME = Gauge('fishnet_move_time_ms', 'Average time per move in milliseconds', ['instance', 'depth'])
-
 # Default configuration
 DEFAULT_CONFIG = {
     'servers': [
@@ -53,134 +53,196 @@ DEFAULT_CONFIG = {
         'enabled': False,
         'mode': 'central',
         'central_url': 'http://stats-server:9101/metrics/push',
-        'auth_key': ''
+        'auth_key': '',
+        'client_id': ''
     }
 }
 
-# Flask app for handling API requests (only used in central mode)
-app = Flask(__name__)
-app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {
-    '/metrics': make_wsgi_app()
-})
+# Latest metrics pushed by each client (only used in central mode), rolled up for the whole fleet
+PUSH_STORE = PushStore(on_change=FLEET.update_snapshot)
+
+# Client side state of the push protocol (only used in client mode)
+PUSH_ENCODER = PushEncoder()
+# Requests per push: the parts of a push split after a 413, and one retry after a 409 or 415
+MAX_PUSH_ATTEMPTS = 32
+
+# Local metrics merged with the pushed ones, served on /metrics
+MERGED_REGISTRY = MergedRegistry(SNAPSHOT_REGISTRY, PUSH_STORE)
+
+# Flask app for handling API requests, only built (and Flask only imported) in central mode
+app = None
+request = jsonify = Response = None
+
+# Parsed configuration, only re-read when the file changes or on SIGHUP
+CONFIG = ConfigStore(CONFIG_PATH, DEFAULT_CONFIG)
 
 def load_config():
     """Load configuration from YAML file"""
-    try:
-        with open('/app/config/fishnet_config.yaml', 'r') as file:
-            config = yaml.safe_load(file)
-            logger.info("Configuration loaded successfully")
-            return config
-    except Exception as e:
-        logger.warning(f"Error loading config: {e}. Using default configuration")
-        return DEFAULT_CONFIG
+    return CONFIG.get()
 
 def collect_metrics():
     """Collect metrics from all configured Fishnet servers"""
-    config = load_config()
-    
-    for server in config['servers']:
-        server_name = server['name']
-        server_url = server['url']
-        api_key = server.get('key', '')
-        
-        try:
-            headers = {}
-            if api_key:
-                headers['Authorization'] = f'Bearer {api_key}'
-                
-            response = requests.get(server_url, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                FISHNET_UP.labels(instance=server_name).set(1)
-                data = response.json()
-                
-                # Parse and record metrics
-                FISHNET_NODES.labels(instance=server_name).set(data.get('nodes', 0))
-                
-                # Queue stats
-                for job_type, count in data.get('queue', {}).items():
-                    FISHNET_JOBS_QUEUED.labels(instance=server_name, job_type=job_type).set(count)
-                
-                # Job stats - these are counters so we need to calculate the delta
-                for job_type, count in data.get('jobs', {}).get('completed', {}).items():
-                    FISHNET_JOBS_COMPLETED.labels(instance=server_name, job_type=job_type).inc(count)
-                
-                for job_type, count in data.get('jobs', {}).get('rejected', {}).items():
-                    FISHNET_JOBS_REJECTED.labels(instance=server_name, job_type=job_type).inc(count)
-                
-                # Client versions
-                for client_id, info in data.get('clients', {}).items():
-                    FISHNET_CLIENT_VERSION.labels(
-                        instance=server_name,
-                        client_id=client_id,
-                        version=info.get('version', 'unknown')
-                    ).set(1)
+    collect_servers(load_config())
 
-                # Performance metrics
-                FISHNET_ANALYSES_SECOND.labels(instance=server_name).set(
-                    data.get('performance', {}).get('analyses_per_second', 0)
-                )
-                
-                # Move time at different depths
-                for depth, time_ms in data.get('performance', {}).get('move_time', {}).items():
-                    FISHNET_MOVE_TIME.labels(instance=server_name, depth=depth).set(time_ms)
-                
-                logger.info(f"Successfully collected metrics from {server_name}")
-            else:
-                FISHNET_UP.labels(instance=server_name).set(0)
-                logger.warning(f"Failed to collect metrics from {server_name}: HTTP {response.status_code}")
-                
-        except Exception as e:
-            FISHNET_UP.labels(instance=server_name).set(0)
-            logger.error(f"Error collecting metrics from {server_name}: {e}")
+def central_urls(metrics_server):
+    """Push URLs of the central shards, or of the single central server"""
+    return metrics_server.get('central_urls') or [metrics_server['central_url']]
 
-def push_to_central(metrics):
-    """Push collected metrics to the central server"""
-    config = load_config()
-    central_url = config['metrics_server']['central_url']
-    auth_key = config['metrics_server'].get('auth_key', '')
-    
-    headers = {'Content-Type': 'text/plain'}
+def post_push(session, url, source, push_config, auth_key):
+    """Push the metrics to one central server, returns its last response and the bytes pushed"""
+    max_series = None
+    retried = False
+    size = 0
+    for attempt in range(MAX_PUSH_ATTEMPTS):
+        with stage('push_encode'):
+            body, headers, state = PUSH_ENCODER.encode(SNAPSHOT_REGISTRY, push_config, source, max_series)
+        observe_payload('push_sent', len(body))
+        if auth_key:
+            headers['Authorization'] = f'Bearer {auth_key}'
+        with stage('push_send'):
+            response = session.post(url, data=body, headers=headers, timeout=10)
+        PUSH_ENCODER.acknowledge(state, response)
+        size += len(body)
+        if state is not None:
+            _, _, _, sent, remaining = state
+            if response.status_code == 413 and sent > 1:
+                # Too large for the central server, send the series in smaller parts
+                max_series = sent // 2
+                logger.info(f"Push of {sent} series too large for {url}, splitting it")
+                continue
+            if response.status_code == 200 and remaining:
+                continue
+        # A rejected delta or format is retried once, as a full snapshot or plain text
+        if response.status_code in (409, 415) and not retried:
+            retried = True
+            continue
+        break
+    return response, size
+
+def release_from_shard(session, url, source, auth_key):
+    """Ask a central shard used during a failover to forget this client"""
+    headers = {'X-Fishnet-Source': source}
     if auth_key:
         headers['Authorization'] = f'Bearer {auth_key}'
-    
     try:
-        response = requests.post(central_url, data=metrics, headers=headers, timeout=10)
-        if response.status_code == 200:
-            logger.info("Successfully pushed metrics to central server")
-        else:
-            logger.warning(f"Failed to push metrics to central server: HTTP {response.status_code}")
+        session.delete(url, headers=headers, timeout=10)
+        logger.info(f"Released metrics from central shard {url}")
     except Exception as e:
-        logger.error(f"Error pushing metrics to central server: {e}")
+        logger.warning(f"Could not release metrics from central shard {url}: {e}")
 
-def schedule_collector():
-    """Schedule the metrics collector to run at regular intervals"""
+def spool_push(metrics_server):
+    """Keep the current metrics in the spool, to be replayed once a central server answers"""
+    push_config = dict(DEFAULT_PUSH_CONFIG, **(metrics_server.get('push') or {}))
+    body = generate_latest(FilteredRegistry(SNAPSHOT_REGISTRY, push_config['include_prefixes']))
+    try:
+        SPOOL.append(time.time(), gzip.compress(body), metrics_server.get('spool'))
+    except OSError as e:
+        logger.error(f"Could not spool the undelivered metrics: {e}")
+
+def replay_spool(session, url, source, auth_key, spool_config):
+    """Deliver a batch of spooled pushes to the central server that just took a push, in the background"""
+    def send(timestamp, body):
+        headers = {
+            'Content-Type': 'text/plain',
+            'Content-Encoding': 'gzip',
+            'X-Fishnet-Source': source,
+            'X-Fishnet-Timestamp': f'{timestamp:.3f}'
+        }
+        if auth_key:
+            headers['Authorization'] = f'Bearer {auth_key}'
+        return session.post(url, data=body, headers=headers, timeout=10).status_code
+
+    def replay():
+        try:
+            SPOOL.replay(send, spool_config)
+        except Exception as e:
+            logger.warning(f"Spool replay to {url} interrupted: {e}")
+
+    # Off the collector thread, the next cycle does not wait for the replay
+    SPOOL.start_replay(replay)
+
+def push_to_central():
+    """Push collected metrics to the central server, or to the first central shard that takes them"""
     config = load_config()
-    interval = config['exporter']['scrape_interval']
-    mode = config['metrics_server'].get('mode', 'central')
-    
-    # Collect immediately on startup
-    collect_metrics()
-    
-    # If in client mode, push metrics to central server
-    if mode == 'client':
-        metrics = generate_latest(REGISTRY)
-        push_to_central(metrics)
-    
-    # Then schedule regular collection
-    def collect_and_maybe_push():
-        collect_metrics()
-        if mode == 'client':
-            metrics = generate_latest(REGISTRY)
-            push_to_central(metrics)
+    metrics_server = config['metrics_server']
+    auth_key = metrics_server.get('auth_key', '')
+    source = metrics_server.get('client_id') or socket.gethostname()
+    shard_config = metrics_server.get('shard')
     
-    schedule.every(interval).seconds.do(collect_and_maybe_push)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    session = get_session(config.get('exporter', {}).get('http'))
+    for url in SHARD_ROUTER.targets(central_urls(metrics_server), source, shard_config):
+        if url != SHARD_ROUTER.last_url:
+            # This shard holds none of our series, start with a full snapshot
+            PUSH_ENCODER.reset()
+        try:
+            response, size = post_push(session, url, source, metrics_server.get('push'), auth_key)
+        except Exception as e:
+            logger.error(f"Error pushing metrics to central server {url}: {e}")
+            SHARD_ROUTER.failed(url, shard_config)
+            continue
+        if response.status_code == 200:
+            logger.info(f"Successfully pushed metrics to central server {url} ({size} bytes)")
+            previous = SHARD_ROUTER.succeeded(url, source)
+            if previous is not None:
+                release_from_shard(session, previous, source, auth_key)
+            replay_spool(session, url, source, auth_key, metrics_server.get('spool'))
+            return
+        logger.warning(f"Failed to push metrics to central server {url}: HTTP {response.status_code}")
+        if response.status_code == 429 or (response.status_code == 503 and 'Retry-After' in response.headers):
+            # Throttled: kept for a later replay to the same shard, which is not marked failed
+            break
+        if response.status_code < 500:
+            # Rejected, another shard would answer the same; a 413 even in parts would be dropped on replay too
+            FISHNET_PUSH_REJECTED.labels(code=str(response.status_code)).inc()
+            return
+        SHARD_ROUTER.failed(url, shard_config)
+    # No central server took the push
+    spool_push(metrics_server)
+
+def remote_write(metrics_server):
+    """Queue the current series for the remote-write endpoint, sent in the background"""
+    source = metrics_server.get('client_id') or socket.gethostname()
+    queued = REMOTE_WRITER.enqueue(SNAPSHOT_REGISTRY, metrics_server.get('remote_write'), source)
+    logger.info(f"Queued {queued} samples for remote write")
+
+def push_if_client():
+    """Every scrape_interval, push metrics in client mode, or refresh the central server's share of the fleet rollups"""
+    metrics_server = load_config()['metrics_server']
+    if metrics_server.get('mode', 'central') == 'client':
+        if metrics_server.get('output', 'push') == 'remote_write':
+            remote_write(metrics_server)
+        else:
+            push_to_central()
+    elif metrics_server.get('enabled', False):
+        FLEET.update_local(SNAPSHOT_REGISTRY)
+
+# Per-server collection deadlines, and a push every scrape_interval in client mode
+SCHEDULER = CollectionScheduler(load_config, collect_servers, periodic=push_if_client)
+
+def schedule_collector():
+    """Run the metrics collector at regular intervals"""
+    SCHEDULER.run()
+
+def serve_metrics():
+    """Endpoint exposing the local metrics and the ones pushed by clients"""
+    names = request.args.getlist('name[]')
+    with stage('scrape'):
+        if names:
+            output = generate_latest(MERGED_REGISTRY.restricted_registry(names))
+        else:
+            # Pushed snapshots are rendered once per push, not once per scrape
+            output = MERGED_REGISTRY.render()
+    observe_payload('scrape', len(output))
+    return Response(output, mimetype=CONTENT_TYPE_LATEST)
+
+def serve_fleet():
+    """Endpoint exposing only the fleet rollups, cheap enough for frequent dashboard refreshes"""
+    PUSH_STORE.expire()
+    with stage('scrape_fleet'):
+        output = FLEET.rendered()
+    observe_payload('scrape_fleet', len(output))
+    return Response(output, mimetype=CONTENT_TYPE_LATEST)
 
-@app.route('/metrics/push', methods=['POST'])
 def receive_metrics():
     """Endpoint for receiving metrics from client instances"""
     config = load_config()
@@ -193,66 +255,126 @@ def receive_metrics():
             return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        # Get client IP for logging
+        # Identify the client, falling back to its IP address
         client_ip = request.remote_addr
-        client_metrics = request.data.decode('utf-8')
+        source = request.headers.get('X-Fishnet-Source') or client_ip
         
-        # Process the received metrics - parse them to extract values
-        # In a production environment, you would want to implement a more sophisticated
-        # approach to merge metrics from various sources
+        # Replayed pushes carry the time they were taken at
+        timestamp = request.headers.get('X-Fishnet-Timestamp')
+        if timestamp is not None:
+            try:
+                timestamp = float(timestamp)
+            except ValueError:
+                raise PushError(f"invalid X-Fishnet-Timestamp {timestamp}")
         
-        # Example parsing to extract and store key metrics
-        for line in client_metrics.split('\n'):
-            if line and not line.startswith('#') and '{' in line:
-                # This is a metric line with labels
-                try:
-                    # Parse the metric name and value
-                    metric_parts = line.split('{')
-                    metric_name = metric_parts[0].strip()
-                    
-                    # Extract labels and value
-                    labels_part = metric_parts[1].split('}')[0]
-                    value = float(line.split('} ')[1].strip())
-                    
-                    # Log the received metric
-                    logger.debug(f"Received metric: {metric_name}, labels: {labels_part}, value: {value}")
-                    
-                    # Here you would store this in your local registry
-                    # This is a simplified example - proper implementation would need
-                    # to carefully handle all metric types and avoid conflicts
-                except Exception as e:
-                    logger.warning(f"Could not parse metric line: {line}, error: {e}")
+        # Decode the push (compact or plain text) into this client's snapshot
+        PUSH_STORE.configure(config['metrics_server'].get('ingest'))
+        server_config = dict(DEFAULT_SERVER_CONFIG, **(config['metrics_server'].get('server') or {}))
+        body = request.get_data()
+        observe_payload('push_received', len(body))
+        with stage('push_decode'):
+            seq = decode_push(
+                body,
+                request.headers.get('Content-Type'),
+                request.headers.get('Content-Encoding'),
+                source,
+                PUSH_STORE,
+                timestamp,
+                server_config['max_body_bytes'] * server_config['max_decompression_ratio']
+            )
+        FISHNET_INGEST_PUSHES.labels(result='success').inc()
         
-        logger.info(f"Received metrics from client {client_ip}")
-        return jsonify({"status": "success"}), 200
+        logger.info(f"Received {'replayed ' if timestamp is not None else ''}metrics from client {source} ({client_ip})")
+        return jsonify({"status": "success", "seq": seq}), 200
+    except PushConflict as e:
+        FISHNET_INGEST_PUSHES.labels(result='conflict').inc()
+        logger.info(f"Requesting a full snapshot: {e}")
+        return jsonify({"error": str(e), "full_snapshot_required": True}), 409
+    except PushTooLarge as e:
+        FISHNET_INGEST_PUSHES.labels(result='too_large').inc()
+        logger.warning(f"Rejected metrics from client {request.remote_addr}: {e}")
+        return jsonify({"error": str(e)}), 413
+    except UnsupportedPush as e:
+        FISHNET_INGEST_PUSHES.labels(result='unsupported').inc()
+        logger.warning(f"Rejected metrics from client {request.remote_addr}: {e}")
+        return jsonify({"error": str(e)}), 415
+    except PushError as e:
+        FISHNET_INGEST_PUSHES.labels(result='invalid').inc()
+        logger.warning(f"Rejected metrics from client {request.remote_addr}: {e}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
+        if getattr(e, 'code', None) == 413:
+            # Past MAX_CONTENT_LENGTH, for the bodies PushLimiter could not size up front
+            FISHNET_INGEST_PUSHES.labels(result='too_large').inc()
+            return jsonify({"error": "push body too large"}), 413
+        FISHNET_INGEST_PUSHES.labels(result='error').inc()
         logger.error(f"Error processing received metrics: {e}")
         return jsonify({"error": str(e)}), 500
 
+def release_metrics():
+    """Endpoint for a client to withdraw its metrics, e.g. when it moves back to its own shard"""
+    auth_key = load_config()['metrics_server'].get('auth_key', '')
+    if auth_key and request.headers.get('Authorization', '') != f'Bearer {auth_key}':
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    source = request.headers.get('X-Fishnet-Source') or request.remote_addr
+    forgotten = PUSH_STORE.forget(source)
+    if forgotten:
+        logger.info(f"Client {source} withdrew its metrics")
+    return jsonify({"status": "success", "forgotten": forgotten}), 200
+
+def get_app():
+    """Build the Flask app of the central mode on first use"""
+    global app, request, jsonify, Response
+    if app is None:
+        from flask import Flask, request, jsonify, Response
+        app = Flask(__name__)
+        app.add_url_rule('/metrics', view_func=serve_metrics)
+        app.add_url_rule('/metrics/fleet', view_func=serve_fleet)
+        app.add_url_rule('/metrics/push', view_func=receive_metrics, methods=['POST'])
+        app.add_url_rule('/metrics/push', view_func=release_metrics, methods=['DELETE'])
+    return app
+
 def main():
     """Main function to start the exporter"""
+    CONFIG.install_sighup_handler(SCHEDULER.wake)
+    install_shutdown_handlers(SCHEDULER)
     config = load_config()
     port = config['exporter']['port']
     metrics_server_enabled = config['metrics_server'].get('enabled', False)
     mode = config['metrics_server'].get('mode', 'central')
     
-    if mode == 'central' and metrics_server_enabled:
-        # In central mode, start Flask to handle incoming metrics
-        logger.info(f"Starting central server mode on port {port}")
-        app.run(host='0.0.0.0', port=port)
-    else:
-        # In client or standalone mode, just expose metrics
-        start_http_server(port)
-        logger.info(f"Fishnet exporter started on port {port} in {'client' if mode == 'client' else 'standalone'} mode")
-    
     # Start the collector in a separate thread
     collector_thread = threading.Thread(target=schedule_collector)
     collector_thread.daemon = True
     collector_thread.start()
+    start_debug_server(config['exporter'].get('profiling'))
     
-    # Keep the main thread running
-    while True:
-        time.sleep(1)
+    try:
+        if mode == 'central' and metrics_server_enabled:
+            REGISTRY.register(FLEET)
+            # In central mode, serve the Flask app on a multi-threaded WSGI server
+            server_config = dict(DEFAULT_SERVER_CONFIG, **(config['metrics_server'].get('server') or {}))
+            app = get_app()
+            app.config['MAX_CONTENT_LENGTH'] = server_config['max_body_bytes']
+            logger.info(f"Starting central server mode on port {port}")
+            serve(app, '0.0.0.0', port, server_config)
+        else:
+            # In client or standalone mode, just expose metrics
+            start_metrics_server(port, registry=SNAPSHOT_REGISTRY)
+            logger.info(f"Fishnet exporter started on port {port} in {'client' if mode == 'client' else 'standalone'} mode")
+            
+            # Keep the main thread running until SIGTERM
+            collector_thread.join()
+    finally:
+        # Let the current cycle finish before exiting
+        SCHEDULER.stop()
+        collector_thread.join(timeout=1)
+        SCHEDULER.wait_idle(load_config()['exporter'].get('cycle_timeout', DEFAULT_CYCLE_TIMEOUT))
+        # Samples already queued for remote write are still sent
+        REMOTE_WRITER.stop(timeout=5)
+        # The next start resumes from the state of the last cycle
+        WARM_START.save(force=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Fishnet fleet rollups
+Fleet-wide sums maintained by the central server as pushes arrive, so that
+dashboards read a handful of fishnet_fleet_* series instead of having
+Prometheus aggregate every pushed series on each refresh. Each client (and
+the central server's own collection) contributes a few partial sums; when it
+pushes, expires or withdraws, only the difference with its previous
+contribution is applied to the fleet totals, which are summed again from
+every contribution now and then so that floating-point rounding does not
+accumulate on a long-running central server. The rollups are exposed on
+/metrics with everything else and alone on /metrics/fleet, whose rendering
+is cached until the next change.
+"""
+
+import logging
+import threading
+from prometheus_client import generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger('fishnet-exporter')
+
+# Contribution of the metrics collected by the central server itself
+LOCAL_SOURCE = ''
+
+# Incremental updates between two full sums of the contributions
+RESUM_EVERY = 1000
+
+# Families read by the rollups, as pushed by the clients
+ROLLUP_FAMILIES = frozenset((
+    'fishnet_up', 'fishnet_nodes_total', 'fishnet_analyses_per_second', 'fishnet_jobs_queued',
+    'fishnet_jobs_completed_rate', 'fishnet_jobs_rejected_rate'
+))
+
+
+def contribution(samples):
+    """Partial fleet sums of one client, from its (sample name, labels, value) series"""
+    sums = {}
+
+    def add(key, value):
+        sums[key] = sums.get(key, 0) + value
+
+    for sample_name, labels, value in samples:
+        if sample_name == 'fishnet_up':
+            add(('instances', ()), 1)
+            if value == 1:
+                add(('instances_up', ()), 1)
+        elif sample_name == 'fishnet_nodes_total':
+            add(('nodes', ()), value)
+        elif sample_name == 'fishnet_analyses_per_second':
+            add(('analyses', ()), value)
+        elif sample_name == 'fishnet_jobs_queued':
+            add(('queued', (labels.get('job_type', ''),)), value)
+        elif sample_name in ('fishnet_jobs_completed_rate', 'fishnet_jobs_rejected_rate'):
+            kind = 'completed' if sample_name == 'fishnet_jobs_completed_rate' else 'rejected'
+            add((kind, (labels.get('job_type', ''), labels.get('window', ''))), value)
+    return sums
+
+
+class FleetRollup:
+    """Fleet totals, updated incrementally from the contribution of each client"""
+
+    def __init__(self):
+        # source -> {key: partial sum}
+        self._contributions = {}
+        # key -> [total, number of contributing sources]
+        self._totals = {}
+        self._version = 0
+        self._updates = 0
+        self._rendered = (None, b'')
+        self._lock = threading.Lock()
+
+    def update(self, source, samples):
+        """Replace the contribution of a client, None when it is gone"""
+        new = contribution(samples) if samples is not None else {}
+        with self._lock:
+            old = self._contributions.pop(source, {})
+            if new:
+                self._contributions[source] = new
+            if old == new:
+                return
+            for key, value in old.items():
+                total = self._totals[key]
+                total[0] -= value
+                total[1] -= 1
+                if total[1] == 0:
+                    del self._totals[key]
+            for key, value in new.items():
+                total = self._totals.setdefault(key, [0, 0])
+                total[0] += value
+                total[1] += 1
+            self._updates += 1
+            if self._updates >= RESUM_EVERY:
+                self._resum()
+            self._version += 1
+
+    def _resum(self):
+        # Drops the rounding error the differences accumulated, under the lock
+        totals = {}
+        for sums in self._contributions.values():
+            for key, value in sums.items():
+                total = totals.setdefault(key, [0, 0])
+                total[0] += value
+                total[1] += 1
+        self._totals = totals
+        self._updates = 0
+
+    def update_snapshot(self, source, snapshot):
+        """Listener of the ingestion store: a client's snapshot changed, or was dropped if None"""
+        if snapshot is None:
+            self.update(source, None)
+            return
+        self.update(source, [
+            (sample_name, labels, value)
+            for family, sample_name, labels, value in snapshot.series.values()
+            if family in ROLLUP_FAMILIES
+        ])
+
+    def update_local(self, registry):
+        """Take the metrics collected by the central server itself into account"""
+        self.update(LOCAL_SOURCE, [
+            (sample.name, sample.labels, sample.value)
+            for metric in registry.collect() if metric.name in ROLLUP_FAMILIES
+            for sample in metric.samples
+        ])
+
+    def describe(self):
+        return self._families({}, 0)
+
+    def collect(self):
+        with self._lock:
+            totals = {key: total[0] for key, total in self._totals.items()}
+            sources = sum(1 for source in self._contributions if source != LOCAL_SOURCE)
+        return self._families(totals, sources)
+
+    @staticmethod
+    def _families(totals, sources):
+        families = {
+            'sources': GaugeMetricFamily('fishnet_fleet_sources', 'Clients currently pushing to this central server'),
+            'instances': GaugeMetricFamily('fishnet_fleet_instances', 'Fishnet instances monitored across the fleet'),
+            'instances_up': GaugeMetricFamily('fishnet_fleet_instances_up', 'Fishnet instances answering across the fleet'),
+            'nodes': GaugeMetricFamily('fishnet_fleet_nodes', 'Connected nodes across the fleet'),
+            'analyses': GaugeMetricFamily('fishnet_fleet_analyses_per_second', 'Analyses per second across the fleet'),
+            'queued': GaugeMetricFamily('fishnet_fleet_jobs_queued', 'Jobs in queue across the fleet', labels=['job_type']),
+            'completed': GaugeMetricFamily('fishnet_fleet_jobs_completed_rate', 'Jobs completed per second across the fleet', labels=['job_type', 'window']),
+            'rejected': GaugeMetricFamily('fishnet_fleet_jobs_rejected_rate', 'Jobs rejected per second across the fleet', labels=['job_type', 'window'])
+        }
+        families['sources'].add_metric([], sources)
+        for name in ('instances', 'instances_up', 'nodes', 'analyses'):
+            families[name].add_metric([], totals.get((name, ()), 0))
+        for (name, labels), total in sorted(totals.items()):
+            if labels:
+                families[name].add_metric(list(labels), total)
+        return list(families.values())
+
+    def rendered(self):
+        """Exposition text of the rollups, rendered once per change"""
+        version, output = self._rendered
+        if version == self._version:
+            return output
+        version = self._version
+        output = generate_latest(self)
+        self._rendered = (version, output)
+        return output
+
+
+FLEET = FleetRollup()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Fishnet HTTP session layer
+A shared, long-lived requests session used for status polling, metric pushes
+and the CLI. Connections are kept alive in per-host pools. GET requests
+answered with a transient 5xx are retried with exponential backoff (honouring
+Retry-After), but only while the retry fits in the timeout of the request, so
+that a poll never outlives its deadline; connection errors and timeouts are
+not retried, and neither are pushes, which the spool and the backpressure of
+the central server handle. New connections and connection reuse are reported
+as Prometheus metrics.
+"""
+
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+from prometheus_client import Counter
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_HTTP_REQUESTS = Counter('fishnet_http_requests_total', 'HTTP requests sent by the exporter', ['host'])
+FISHNET_HTTP_CONNECTIONS = Counter('fishnet_http_connections_opened_total', 'New TCP/TLS connections (handshakes) opened by the exporter', ['host'])
+FISHNET_HTTP_REUSED = Counter('fishnet_http_connections_reused_total', 'HTTP requests served over an already open connection', ['host'])
+FISHNET_HTTP_RETRIES = Counter('fishnet_http_retries_total', 'HTTP requests retried after a 5xx', ['host'])
+
+# Defaults for the 'exporter.http' section of the configuration
+DEFAULT_HTTP_CONFIG = {
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'retries': 3,
+    # Hung or refused servers fail at once instead of stacking timeouts
+    'connect_retries': 0,
+    'read_retries': 0,
+    'backoff_factor': 0.5,
+    # 429 and 503 are backpressure, retrying them would defeat it
+    'status_forcelist': [500, 502, 504],
+    'hosts': {}
+}
+
+# Set by the connection pools when a request needs a new connection,
+# and by the adapter with the time by which the request must be over
+_conn_state = threading.local()
+
+_session = None
+_session_config = None
+_session_lock = threading.Lock()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        FISHNET_HTTP_CONNECTIONS.labels(host=self.host).inc()
+        _conn_state.opened = True
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        FISHNET_HTTP_CONNECTIONS.labels(host=self.host).inc()
+        _conn_state.opened = True
+        return super()._new_conn()
+
+
+def timeout_seconds(timeout):
+    """Total seconds of a requests timeout, None when it has none"""
+    if isinstance(timeout, tuple):
+        if None in timeout:
+            return None
+        return sum(timeout)
+    return timeout
+
+
+class CountingRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        deadline = getattr(_conn_state, 'deadline', None)
+        if deadline is not None:
+            wait = retry.get_backoff_time()
+            if response is not None and retry.respect_retry_after_header:
+                wait = max(wait, retry.get_retry_after(response) or 0)
+            # Give up rather than let the retry outlive the timeout of the request
+            if time.monotonic() + wait >= deadline:
+                raise MaxRetryError(_pool, url, error or ResponseError(f'no time left to retry HTTP {response.status}'))
+        host = _pool.host if _pool is not None else 'unknown'
+        FISHNET_HTTP_RETRIES.labels(host=host).inc()
+        return retry
+
+
+class FishnetHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter counting new connections and connection reuse per host"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+    def send(self, request, **kwargs):
+        _conn_state.opened = False
+        timeout = timeout_seconds(kwargs.get('timeout'))
+        _conn_state.deadline = time.monotonic() + timeout if timeout is not None else None
+        host = urlparse(request.url).hostname
+        FISHNET_HTTP_REQUESTS.labels(host=host).inc()
+        response = super().send(request, **kwargs)
+        if not _conn_state.opened:
+            FISHNET_HTTP_REUSED.labels(host=host).inc()
+        return response
+
+
+def make_adapter(http_config):
+    """Build an adapter from an 'exporter.http' style configuration"""
+    retry = CountingRetry(
+        total=http_config['retries'],
+        connect=http_config['connect_retries'],
+        read=http_config['read_retries'],
+        backoff_factor=http_config['backoff_factor'],
+        status_forcelist=http_config['status_forcelist'],
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    return FishnetHTTPAdapter(
+        pool_connections=http_config['pool_connections'],
+        pool_maxsize=http_config['pool_maxsize'],
+        max_retries=retry
+    )
+
+
+def build_session(http_config=None):
+    """Create a session with pooled, retrying adapters"""
+    http_config = dict(DEFAULT_HTTP_CONFIG, **(http_config or {}))
+
+    session = requests.Session()
+    session.headers['Connection'] = 'keep-alive'
+    default_adapter = make_adapter(http_config)
+    session.mount('http://', default_adapter)
+    session.mount('https://', default_adapter)
+
+    # Per-host overrides, e.g. a larger pool for https://lichess.org
+    for prefix, overrides in (http_config.get('hosts') or {}).items():
+        host_config = dict(http_config, **(overrides or {}))
+        if '://' not in prefix:
+            prefix = f'https://{prefix}'
+        session.mount(prefix, make_adapter(host_config))
+
+    return session
+
+
+def get_session(http_config=None):
+    """Return the shared session, rebuilding it when its configuration changes"""
+    global _session, _session_config
+    with _session_lock:
+        if _session is None or (http_config is not None and http_config != _session_config):
+            if _session is not None:
+                logger.info("HTTP session configuration changed, rebuilding connection pools")
+                _session.close()
+            _session = build_session(http_config)
+            _session_config = http_config
+        return _session
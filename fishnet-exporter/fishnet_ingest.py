@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Fishnet push ingestion
+Parses the exposition text pushed by client exporters and keeps the latest
+snapshot of every client in memory, keyed by (source, metric, label set).
+The store is merged into the central registry at scrape time, every pushed
+series carrying a 'source' label. The exposition text of a client's
+snapshot is rendered once and reused by every scrape until the client pushes
+again, so that a scrape only renders the local metrics and joins the cached
+parts. Clients that stop pushing are expired and the number of clients and
+series per client is bounded. Pushes replayed by clients after an outage are
+exposed for a while as samples carrying the time they were taken at, so that
+Prometheus can fill the gap.
+"""
+
+import time
+import logging
+import threading
+from prometheus_client import Counter, Gauge, generate_latest
+from prometheus_client.core import Metric
+from prometheus_client.parser import text_string_to_metric_families
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_INGEST_PUSHES = Counter('fishnet_ingest_pushes_total', 'Metric pushes received from clients', ['result'])
+FISHNET_INGEST_DROPPED = Counter('fishnet_ingest_dropped_series_total', 'Pushed series dropped by the ingestion store', ['reason'])
+FISHNET_INGEST_EXPIRED = Counter('fishnet_ingest_expired_sources_total', 'Clients expired after not pushing for too long')
+FISHNET_INGEST_SOURCES = Gauge('fishnet_ingest_sources', 'Clients currently held in the ingestion store')
+FISHNET_INGEST_SERIES = Gauge('fishnet_ingest_series', 'Series currently held in the ingestion store')
+FISHNET_INGEST_BACKFILL = Gauge('fishnet_ingest_backfill_samples', 'Timestamped samples replayed by clients and still exposed')
+FISHNET_INGEST_RENDERS = Counter('fishnet_ingest_renders_total', 'Client snapshots joined into a scrape, from their cached rendering or not', ['result'])
+
+# Defaults for the 'metrics_server.ingest' section of the configuration
+DEFAULT_INGEST_CONFIG = {
+    'staleness': 300,
+    'max_sources': 1000,
+    'max_series_per_source': 5000,
+    'include_prefixes': ['fishnet_'],
+    'backfill_retention': 300,
+    'max_backfill_per_source': 50000
+}
+
+SOURCE_LABEL = 'source'
+
+
+class PushError(ValueError):
+    """Raised when a pushed payload cannot be parsed"""
+
+
+class PushConflict(PushError):
+    """Raised when a delta push does not apply to the snapshot held for its client"""
+
+
+def parse_exposition(text, include_prefixes=None):
+    """Parse Prometheus text exposition into {family: (type, help, [(sample, labels, value)])}"""
+    families = {}
+    try:
+        for family in text_string_to_metric_families(text):
+            if include_prefixes and not family.name.startswith(tuple(include_prefixes)):
+                continue
+            samples = [
+                (sample.name, sample.labels, sample.value)
+                for sample in family.samples
+                # Creation timestamps are meaningless once merged across clients
+                if not sample.name.endswith('_created')
+            ]
+            if samples:
+                families[family.name] = (family.type, family.documentation, samples)
+    except Exception as e:
+        raise PushError(f"invalid exposition format: {e}")
+    return families
+
+
+class _Families:
+    """Registry-like holder of already built metric families"""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+
+def exposition_header(name, typ, documentation):
+    """HELP and TYPE lines of a family, as rendered by generate_latest"""
+    return generate_latest(_Families([Metric(name, documentation, typ)]))
+
+
+def render_samples(name, typ, documentation, samples):
+    """Sample lines of a family without its header, from [(sample, labels, value, timestamp)]"""
+    metric = Metric(name, documentation, typ)
+    # OpenMetrics-only samples would be rendered as families of their own, and repeated per client
+    extra = (name + '_created', name + '_gsum', name + '_gcount')
+    for sample_name, labels, value, timestamp in samples:
+        if sample_name not in extra:
+            metric.add_sample(sample_name, labels, value, timestamp)
+    output = generate_latest(_Families([metric]))
+    return output[output.index(b'\n', output.index(b'\n') + 1) + 1:]
+
+
+def series_key(sample_name, labels):
+    """Hashable identity of a series within one client"""
+    return (sample_name, tuple(sorted(labels.items())))
+
+
+class SourceSnapshot:
+    """Everything currently known about one client"""
+
+    __slots__ = ('timestamp', 'seq', 'families', 'series', '_rendered')
+
+    def __init__(self, timestamp, seq=None):
+        self.timestamp = timestamp
+        self.seq = seq
+        # family -> (type, help)
+        self.families = {}
+        # series key -> (family, sample name, labels including source, value)
+        self.series = {}
+        self._rendered = None
+
+    def rendered(self):
+        """Sample lines of every family, rendered once: a snapshot is never modified once stored"""
+        rendered = self._rendered
+        if rendered is not None:
+            FISHNET_INGEST_RENDERS.labels(result='hit').inc()
+            return rendered
+        FISHNET_INGEST_RENDERS.labels(result='miss').inc()
+        samples = {}
+        for name, sample_name, labels, value in self.series.values():
+            samples.setdefault(name, []).append((sample_name, labels, value, None))
+        rendered = {
+            name: (len(family_samples), render_samples(name, *self.families[name], family_samples))
+            for name, family_samples in samples.items()
+        }
+        self._rendered = rendered
+        return rendered
+
+
+class PushStore:
+    """Latest pushed snapshot of every client, bounded and expiring"""
+
+    def __init__(self, config=None, on_change=None):
+        self._sources = {}
+        # Called with (source, snapshot) when a client's snapshot is replaced, (source, None) when it is dropped
+        self.on_change = on_change
+        # source -> [(received at, timestamp, [(family, type, help, sample, labels, value)])]
+        self._backfill = {}
+        self._lock = threading.Lock()
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply a 'metrics_server.ingest' style configuration"""
+        config = dict(DEFAULT_INGEST_CONFIG, **(config or {}))
+        self.staleness = config['staleness']
+        self.max_sources = config['max_sources']
+        self.max_series_per_source = config['max_series_per_source']
+        self.include_prefixes = config['include_prefixes']
+        self.backfill_retention = config['backfill_retention']
+        self.max_backfill_per_source = config['max_backfill_per_source']
+
+    def ingest(self, source, families, timestamp=None, seq=None):
+        """Replace the snapshot of a client with freshly pushed families"""
+        snapshot = SourceSnapshot(timestamp or time.time(), seq)
+        self._apply(snapshot, source, families, [])
+        with self._lock:
+            self._make_room(source)
+            self._sources[source] = snapshot
+            self._update_gauges()
+            self._changed(source, snapshot)
+
+    def apply_delta(self, source, families, removed, base, seq, timestamp=None):
+        """Apply the changes a client pushed relative to the snapshot numbered 'base'"""
+        with self._lock:
+            current = self._sources.get(source)
+            if current is None or current.seq is None or current.seq != base:
+                raise PushConflict(f"client {source} sent a delta on {base}, store has {current.seq if current else None}")
+            # Work on a copy so that concurrent scrapes never see half a delta
+            snapshot = SourceSnapshot(timestamp or time.time(), seq)
+            snapshot.families = dict(current.families)
+            snapshot.series = dict(current.series)
+
+        self._apply(snapshot, source, families, removed)
+        with self._lock:
+            if self._sources.get(source) is not current:
+                raise PushConflict(f"client {source} pushed concurrently")
+            self._sources[source] = snapshot
+            self._update_gauges()
+            self._changed(source, snapshot)
+
+    def _changed(self, source, snapshot):
+        # Under the store lock, so that listeners see the changes of a client in order
+        if self.on_change is not None:
+            self.on_change(source, snapshot)
+
+    def _apply(self, snapshot, source, families, removed):
+        for sample_name, labels in removed:
+            snapshot.series.pop(series_key(sample_name, labels), None)
+
+        for name, (typ, documentation, samples) in families.items():
+            snapshot.families[name] = (typ, documentation)
+            for sample_name, labels, value in samples:
+                key = series_key(sample_name, labels)
+                if key not in snapshot.series and len(snapshot.series) >= self.max_series_per_source:
+                    FISHNET_INGEST_DROPPED.labels(reason='series_limit').inc()
+                    continue
+                snapshot.series[key] = (name, sample_name, dict(labels, **{SOURCE_LABEL: source}), value)
+
+    def _make_room(self, source):
+        if source not in self._sources and len(self._sources) >= self.max_sources:
+            # Make room by evicting the client that pushed least recently
+            oldest = min(self._sources, key=lambda s: self._sources[s].timestamp)
+            dropped = self._sources.pop(oldest)
+            FISHNET_INGEST_DROPPED.labels(reason='source_limit').inc(len(dropped.series))
+            logger.warning(f"Ingestion store full, evicted client {oldest}")
+            self._changed(oldest, None)
+
+    def backfill(self, source, families, timestamp, received=None):
+        """Keep the families of a replayed push as samples taken at 'timestamp'"""
+        samples = [
+            (name, typ, documentation, sample_name, dict(labels, **{SOURCE_LABEL: source}), value)
+            for name, (typ, documentation, family_samples) in families.items()
+            for sample_name, labels, value in family_samples
+        ]
+        with self._lock:
+            batches = self._backfill.setdefault(source, [])
+            batches.append((received or time.time(), timestamp, samples))
+            # Past the cap, the oldest replayed pushes of the client go first
+            while sum(len(batch[2]) for batch in batches) > self.max_backfill_per_source:
+                FISHNET_INGEST_DROPPED.labels(reason='backfill_limit').inc(len(batches.pop(0)[2]))
+            self._update_gauges()
+
+    def forget(self, source):
+        """Drop the snapshot of a client, returns whether it was held"""
+        with self._lock:
+            dropped = self._sources.pop(source, None)
+            if dropped is not None:
+                self._update_gauges()
+                self._changed(source, None)
+        return dropped is not None
+
+    def expire(self, now=None):
+        """Drop clients that have not pushed within the staleness window"""
+        now = now or time.time()
+        with self._lock:
+            stale = [s for s, snapshot in self._sources.items() if now - snapshot.timestamp > self.staleness]
+            for source in stale:
+                del self._sources[source]
+                self._changed(source, None)
+                FISHNET_INGEST_EXPIRED.inc()
+                logger.info(f"Expired metrics from client {source}")
+            # Replayed samples are exposed long enough for a few scrapes
+            expired = False
+            for source, batches in list(self._backfill.items()):
+                kept = [batch for batch in batches if now - batch[0] <= self.backfill_retention]
+                expired = expired or len(kept) != len(batches)
+                if kept:
+                    self._backfill[source] = kept
+                else:
+                    del self._backfill[source]
+            if stale or expired:
+                self._update_gauges()
+
+    def _update_gauges(self):
+        FISHNET_INGEST_SOURCES.set(len(self._sources))
+        FISHNET_INGEST_SERIES.set(sum(len(snapshot.series) for snapshot in self._sources.values()))
+        FISHNET_INGEST_BACKFILL.set(sum(len(batch[2]) for batches in self._backfill.values() for batch in batches))
+
+    def families(self):
+        """Return {family: (type, help, [(sample, labels, value, timestamp)])} merged across all clients"""
+        self.expire()
+        with self._lock:
+            snapshots = list(self._sources.values())
+            batches = [batch for source_batches in self._backfill.values() for batch in source_batches]
+
+        merged = {}
+
+        def add(name, typ, documentation, sample):
+            if name not in merged:
+                merged[name] = (typ, documentation, [])
+            elif merged[name][0] != typ:
+                FISHNET_INGEST_DROPPED.labels(reason='type_conflict').inc()
+                return
+            merged[name][2].append(sample)
+
+        for snapshot in snapshots:
+            for name, sample_name, labels, value in snapshot.series.values():
+                typ, documentation = snapshot.families[name]
+                add(name, typ, documentation, (sample_name, labels, value, None))
+        for _, timestamp, samples in batches:
+            for name, typ, documentation, sample_name, labels, value in samples:
+                add(name, typ, documentation, (sample_name, labels, value, timestamp))
+        return merged
+
+    def rendered_families(self):
+        """Return {family: (type, help, [sample lines], series)} merged across all clients, from their cached renderings"""
+        self.expire()
+        with self._lock:
+            snapshots = list(self._sources.values())
+            batches = [batch for source_batches in self._backfill.values() for batch in source_batches]
+
+        merged = {}
+
+        def add(name, typ, documentation, count, lines):
+            if name not in merged:
+                merged[name] = (typ, documentation, [], [0])
+            elif merged[name][0] != typ:
+                FISHNET_INGEST_DROPPED.labels(reason='type_conflict').inc(count)
+                return
+            merged[name][2].append(lines)
+            merged[name][3][0] += count
+
+        for snapshot in snapshots:
+            for name, (count, lines) in snapshot.rendered().items():
+                typ, documentation = snapshot.families[name]
+                add(name, typ, documentation, count, lines)
+        # Replayed samples are few and short-lived, they are rendered on every scrape
+        replayed = {}
+        for _, timestamp, samples in batches:
+            for name, typ, documentation, sample_name, labels, value in samples:
+                replayed.setdefault((name, typ, documentation), []).append((sample_name, labels, value, timestamp))
+        for (name, typ, documentation), samples in replayed.items():
+            add(name, typ, documentation, len(samples), render_samples(name, typ, documentation, samples))
+        return {name: (typ, documentation, lines, count[0]) for name, (typ, documentation, lines, count) in merged.items()}
+
+
+class MergedRegistry:
+    """Registry view serving the local metrics together with the pushed ones"""
+
+    def __init__(self, registry, store, names=None):
+        self.registry = registry
+        self.store = store
+        self.names = names
+
+    def collect(self):
+        pushed = self.store.families()
+        for metric in self.registry.collect():
+            extra = pushed.pop(metric.name, None)
+            if extra is not None:
+                if extra[0] == metric.type:
+                    for sample_name, labels, value, timestamp in extra[2]:
+                        metric.add_sample(sample_name, labels, value, timestamp)
+                else:
+                    FISHNET_INGEST_DROPPED.labels(reason='type_conflict').inc(len(extra[2]))
+            if self._wanted(metric):
+                yield metric
+
+        for name, (typ, documentation, samples) in pushed.items():
+            metric = Metric(name, documentation, typ)
+            for sample_name, labels, value, timestamp in samples:
+                metric.add_sample(sample_name, labels, value, timestamp)
+            if self._wanted(metric):
+                yield metric
+
+    def _wanted(self, metric):
+        if self.names is None:
+            return True
+        return any(sample.name in self.names for sample in metric.samples)
+
+    def restricted_registry(self, names):
+        return MergedRegistry(self.registry, self.store, set(names))
+
+    def render(self):
+        """Exposition text of the local metrics and of the cached renderings of the pushed ones"""
+        render = getattr(self.registry, 'render', None)
+        local = (render() if render is not None else None) or generate_latest(self.registry)
+        pushed = self.store.rendered_families()
+
+        # The pushed samples of a family the central server also exposes go at the end of its block
+        insertions = []
+        headers = {}
+        for name, (typ, documentation, lines, count) in list(pushed.items()):
+            header = exposition_header(name, typ, documentation)
+            headers[name] = header
+            type_line = header[header.index(b'\n') + 1:]
+            exposed_name = type_line.split(b' ')[2]
+            found = local.find(b'\n# TYPE ' + exposed_name + b' ')
+            if found < 0:
+                continue
+            del pushed[name]
+            if not local.startswith(type_line, found + 1):
+                FISHNET_INGEST_DROPPED.labels(reason='type_conflict').inc(count)
+                continue
+            end = local.find(b'\n# HELP ', found + len(type_line))
+            insertions.append((len(local) if end < 0 else end + 1, lines))
+
+        parts = []
+        start = 0
+        for position, lines in sorted(insertions, key=lambda insertion: insertion[0]):
+            parts.append(local[start:position])
+            parts.extend(lines)
+            start = position
+        parts.append(local[start:])
+        for name, (typ, documentation, lines, count) in pushed.items():
+            parts.append(headers[name])
+            parts.extend(lines)
+        return b''.join(parts)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Fishnet push load test
+Simulates N client exporters pushing to the central server's /metrics/push
+endpoint and reports request latency percentiles, throughput and errors.
+"""
+
+import argparse
+import random
+import threading
+import time
+import requests
+from prometheus_client import CollectorRegistry, Gauge, Counter
+from fishnet_push import PushEncoder
+
+
+def build_client_registry(client_index, series):
+    """Registry with roughly the shape of a real client exporter"""
+    registry = CollectorRegistry()
+    up = Gauge('fishnet_up', 'Status of Fishnet instance', ['instance'], registry=registry)
+    queued = Gauge('fishnet_jobs_queued', 'Number of jobs in queue', ['instance', 'job_type'], registry=registry)
+    completed = Counter('fishnet_jobs_completed_total', 'Total number of completed jobs', ['instance', 'job_type'], registry=registry)
+    versions = Gauge('fishnet_client_version', 'Version information for each client', ['instance', 'client_id', 'version'], registry=registry)
+
+    instance = f'loadtest-{client_index}'
+    up.labels(instance=instance).set(1)
+    for i in range(series):
+        versions.labels(instance=instance, client_id=f'client-{i}', version='2.6.0').set(1)
+
+    def mutate():
+        for job_type in ('analysis', 'move'):
+            queued.labels(instance=instance, job_type=job_type).set(random.randint(0, 500))
+            completed.labels(instance=instance, job_type=job_type).inc(random.randint(0, 20))
+
+    return registry, mutate
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_client(args, client_index, stop, latencies, statuses, lock):
+    registry, mutate = build_client_registry(client_index, args.series)
+    encoder = PushEncoder()
+    session = requests.Session()
+    push_config = {'format': args.format, 'compression': args.compression}
+    source = f'loadtest-{client_index}'
+
+    # Spread the clients over the interval like a real fleet
+    stop.wait(random.uniform(0, args.interval))
+    while not stop.is_set():
+        mutate()
+        body, headers, state = encoder.encode(registry, push_config, source)
+        if args.auth_key:
+            headers['Authorization'] = f'Bearer {args.auth_key}'
+
+        start = time.monotonic()
+        try:
+            response = session.post(args.url, data=body, headers=headers, timeout=args.timeout)
+            status = response.status_code
+            encoder.acknowledge(state, response)
+        except requests.RequestException:
+            status = 'error'
+        elapsed = time.monotonic() - start
+
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+        stop.wait(max(0, args.interval - elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the central /metrics/push endpoint')
+    parser.add_argument('--url', default='http://localhost:9101/metrics/push', help='Push endpoint of the central server')
+    parser.add_argument('-n', '--clients', type=int, default=100, help='Number of simulated clients')
+    parser.add_argument('-i', '--interval', type=float, default=10.0, help='Push interval of each client, in seconds')
+    parser.add_argument('-d', '--duration', type=float, default=60.0, help='Duration of the test, in seconds')
+    parser.add_argument('-s', '--series', type=int, default=50, help='Client version series per simulated client')
+    parser.add_argument('--format', choices=['compact', 'text'], default='compact', help='Push format')
+    parser.add_argument('--compression', choices=['gzip', 'zstd', 'none'], default='gzip', help='Push compression')
+    parser.add_argument('--auth-key', default='', help='Authentication key of the central server')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Request timeout, in seconds')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    threads = [
+        threading.Thread(target=run_client, args=(args, i, stop, latencies, statuses, lock), daemon=True)
+        for i in range(args.clients)
+    ]
+
+    print(f"Simulating {args.clients} clients pushing every {args.interval}s to {args.url} for {args.duration}s")
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    stop.wait(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(args.timeout)
+    elapsed = time.monotonic() - started
+
+    with lock:
+        total = len(latencies)
+        print(f"Requests: {total} ({total / elapsed:.1f}/s)")
+        print(f"Statuses: {', '.join(f'{k}={v}' for k, v in sorted(statuses.items(), key=str))}")
+        for q in (50, 90, 99):
+            print(f"p{q}: {percentile(latencies, q) * 1000:.1f} ms")
+        if latencies:
+            print(f"max: {max(latencies) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
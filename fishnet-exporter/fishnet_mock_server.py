@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Fishnet mock status server
+Local stand-in for the Fishnet status API, serving synthetic payloads with
+the sections parsed by the exporter (nodes, queue, jobs, clients,
+performance.move_time). The number of clients, the latency, the error rate
+and the fraction of polls that see a changed payload are configurable on the
+command line and can be overridden per request with query parameters, e.g.
+/status?clients=5000&latency=200&error_rate=0.1&change_rate=0.5
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_VERSIONS = ['2.6.0', '2.5.4', '2.5.3', '2.4.2']
+JOB_TYPES = ['analysis', 'move']
+DEPTHS = ['10', '15', '20', '25']
+
+
+class MockFleet:
+    """Synthetic Fishnet fleet, advanced on every status() call"""
+
+    def __init__(self, clients, versions=None, churn=0.01, seed=None):
+        self.versions = versions or DEFAULT_VERSIONS
+        self.churn = churn
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.clients = {}
+        self.completed = {job_type: 0 for job_type in JOB_TYPES}
+        self.rejected = {job_type: 0 for job_type in JOB_TYPES}
+        self._version = 0
+        self._response = None
+        self.resize(clients)
+
+    def _new_client(self):
+        self._next_id += 1
+        return f'client-{self._next_id:07d}', self._random.choice(self.versions)
+
+    def resize(self, clients):
+        with self._lock:
+            while len(self.clients) < clients:
+                client_id, version = self._new_client()
+                self.clients[client_id] = version
+            for client_id in list(self.clients)[clients:]:
+                del self.clients[client_id]
+
+    def status(self):
+        """Advance the fleet by one tick and return its status payload"""
+        with self._lock:
+            # A fraction of the clients disconnect and are replaced by new ones
+            replaced = int(len(self.clients) * self.churn)
+            for client_id in self._random.sample(list(self.clients), replaced):
+                del self.clients[client_id]
+                new_id, version = self._new_client()
+                self.clients[new_id] = version
+
+            for job_type in JOB_TYPES:
+                self.completed[job_type] += self._random.randint(0, max(1, len(self.clients)))
+                self.rejected[job_type] += self._random.randint(0, 2)
+
+            return {
+                'nodes': len(self.clients),
+                'queue': {job_type: self._random.randint(0, 500) for job_type in JOB_TYPES},
+                'jobs': {
+                    'completed': dict(self.completed),
+                    'rejected': dict(self.rejected)
+                },
+                'clients': {client_id: {'version': version} for client_id, version in self.clients.items()},
+                'performance': {
+                    'analyses_per_second': round(self._random.uniform(0.5, 2.0) * len(self.clients), 2),
+                    'move_time': {depth: self._random.randint(50, 2000) for depth in DEPTHS}
+                }
+            }
+
+    def response(self, advance=True):
+        """Encoded payload with its ETag and Last-Modified, only advanced when asked to"""
+        if advance or self._response is None:
+            body = json.dumps(self.status()).encode('utf-8')
+            with self._lock:
+                self._version += 1
+                self._response = (body, f'"{self._version:x}"', formatdate(usegmt=True))
+        return self._response
+
+
+class MockStatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        super().__init__(address, MockStatusHandler)
+        self.args = args
+        self._fleets = {}
+        self._fleets_lock = threading.Lock()
+
+    def fleet(self, path, clients):
+        """One fleet per path and size, so that several mocked servers can share this process"""
+        key = (path, clients)
+        with self._fleets_lock:
+            if key not in self._fleets:
+                self._fleets[key] = MockFleet(clients, self.args.versions, self.args.churn, self.args.seed)
+            return self._fleets[key]
+
+
+class MockStatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        args = self.server.args
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            clients = int(query.get('clients', [args.clients])[0])
+            latency = float(query.get('latency', [args.latency])[0])
+            jitter = float(query.get('jitter', [args.jitter])[0])
+            error_rate = float(query.get('error_rate', [args.error_rate])[0])
+            change_rate = float(query.get('change_rate', [args.change_rate])[0])
+        except ValueError:
+            return self._send(400, {'error': 'invalid query parameter'})
+
+        if args.key and self.headers.get('Authorization') != f'Bearer {args.key}':
+            return self._send(401, {'error': 'Unauthorized'})
+
+        delay = max(0.0, latency + random.uniform(-jitter, jitter)) / 1000.0
+        if delay:
+            time.sleep(delay)
+        if random.random() < error_rate:
+            return self._send(503, {'error': 'Service Unavailable'})
+        fleet = self.server.fleet(url.path, clients)
+        body, etag, last_modified = fleet.response(advance=random.random() < change_rate)
+        if args.validators and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        headers = [('ETag', etag), ('Last-Modified', last_modified)] if args.validators else []
+        self._send(200, body, headers)
+
+    def _send(self, code, payload, headers=()):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Mock Fishnet status server')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=18080, help='Port to listen on')
+    parser.add_argument('-c', '--clients', type=int, default=1000, help='Number of connected clients')
+    parser.add_argument('--versions', type=lambda value: value.split(','), default=DEFAULT_VERSIONS, help='Comma separated client versions')
+    parser.add_argument('--churn', type=float, default=0.01, help='Fraction of the clients replaced on every request')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency, in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random variation of the latency, in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the requests answered with HTTP 503')
+    parser.add_argument('--change-rate', type=float, default=1.0, help='Fraction of the requests that see an updated fleet')
+    parser.add_argument('--no-validators', dest='validators', action='store_false', help='Send neither ETag nor Last-Modified, never answer 304')
+    parser.add_argument('--key', default='', help='Require this API key')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the synthetic fleet')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    server = MockStatusServer((args.host, args.port), args)
+    print(f"Mock Fishnet status server on http://{args.host}:{args.port}/ ({args.clients} clients)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Fishnet exporter self-instrumentation
+Times the exporter's own hot paths (status fetch, JSON decoding, metric
+updates, /metrics rendering, pushes and their ingestion) in the
+fishnet_exporter_stage_seconds histogram, records payload sizes, and offers
+an opt-in debug server for profiling a live exporter on demand:
+- /debug/profile?seconds=N profiles the instrumented stages with cProfile
+- /debug/tracemalloc?seconds=N reports the allocations made during N seconds
+"""
+
+import io
+import logging
+import math
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from prometheus_client import Histogram, REGISTRY, CONTENT_TYPE_LATEST, make_wsgi_app
+
+logger = logging.getLogger('fishnet-exporter')
+
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+PAYLOAD_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+FISHNET_STAGE_SECONDS = Histogram('fishnet_exporter_stage_seconds', 'Time spent in each stage of the exporter', ['stage'], buckets=STAGE_BUCKETS)
+FISHNET_PAYLOAD_BYTES = Histogram('fishnet_exporter_payload_bytes', 'Size of the payloads fetched, served and pushed by the exporter', ['kind'], buckets=PAYLOAD_BUCKETS)
+
+# Defaults for the 'exporter.profiling' section of the configuration
+DEFAULT_PROFILING_CONFIG = {
+    'enabled': False,
+    'host': '127.0.0.1',
+    'port': 9111,
+    'max_seconds': 60
+}
+
+
+class StageProfiler:
+    """cProfile session covering the stages run during a time window"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._until = 0.0
+        self._stats = None
+        self._local = threading.local()
+
+    @property
+    def active(self):
+        return time.monotonic() < self._until
+
+    def start(self, seconds):
+        """Open a profiling window, returns False if one is already open"""
+        with self._lock:
+            if self.active:
+                return False
+            self._stats = None
+            self._until = time.monotonic() + seconds
+            return True
+
+    def results(self, sort='cumulative', limit=40):
+        """Text report of the profiled stages"""
+        with self._lock:
+            if self._stats is None:
+                return "No instrumented stage ran during the profiling window\n"
+            output = io.StringIO()
+            self._stats.stream = output
+            self._stats.sort_stats(sort).print_stats(limit)
+            return output.getvalue()
+
+    @contextmanager
+    def profile(self):
+        # Nested stages are already covered by the profiler of the outer one
+        if not self.active or getattr(self._local, 'profiling', False):
+            yield
+            return
+        # Only imported once a profiling window is opened
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ only allows one profiler at a time across threads
+            yield
+            return
+        self._local.profiling = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profiling = False
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+
+PROFILER = StageProfiler()
+
+@contextmanager
+def stage(name):
+    """Time a block in fishnet_exporter_stage_seconds, and profile it when a window is open"""
+    start = time.perf_counter()
+    try:
+        with PROFILER.profile():
+            yield
+    finally:
+        FISHNET_STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - start)
+
+
+def observe_payload(kind, size):
+    """Record the size in bytes of a payload"""
+    FISHNET_PAYLOAD_BYTES.labels(kind=kind).observe(size)
+
+
+def tracemalloc_report(seconds, limit=25, key='lineno'):
+    """Allocations made during 'seconds' seconds, or the current ones if 0"""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        if seconds <= 0:
+            stats = tracemalloc.take_snapshot().statistics(key)
+        else:
+            before = tracemalloc.take_snapshot()
+            time.sleep(seconds)
+            stats = tracemalloc.take_snapshot().compare_to(before, key)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    lines = [f"Traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB"]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return '\n'.join(lines) + '\n'
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def _serve_in_thread(app, host, port, name):
+    httpd = make_server(host, port, app, server_class=ThreadingWSGIServer, handler_class=QuietRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name=name, daemon=True)
+    thread.start()
+    return httpd
+
+
+def start_metrics_server(port, addr='', registry=REGISTRY):
+    """Drop-in for prometheus_client.start_http_server that times the rendering of /metrics"""
+    metrics_app = make_wsgi_app(registry)
+    # Registries with a cached rendering (snapshot mode) serve it as is, uncompressed
+    render = getattr(registry, 'render', None)
+
+    def app(environ, start_response):
+        with stage('scrape'):
+            output = render() if render is not None and not environ.get('QUERY_STRING') else None
+            if output is not None:
+                start_response('200 OK', [('Content-Type', CONTENT_TYPE_LATEST), ('Content-Length', str(len(output)))])
+                body = [output]
+            else:
+                body = metrics_app(environ, start_response)
+        observe_payload('scrape', sum(len(chunk) for chunk in body))
+        return body
+
+    return _serve_in_thread(app, addr, port, 'fishnet-metrics')
+
+
+def make_debug_app(max_seconds):
+    """WSGI app of the on-demand profiling endpoints"""
+
+    def respond(start_response, status, text):
+        body = text.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def app(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            seconds = float(query.get('seconds', ['10'])[0])
+            limit = int(query.get('limit', ['40'])[0])
+        except ValueError:
+            return respond(start_response, '400 Bad Request', "seconds and limit must be numbers\n")
+        if not math.isfinite(seconds) or seconds < 0 or limit < 0:
+            return respond(start_response, '400 Bad Request', "seconds must be finite and neither seconds nor limit negative\n")
+        seconds = min(seconds, max_seconds)
+
+        if path == '/debug/profile':
+            if not PROFILER.start(seconds):
+                return respond(start_response, '409 Conflict', "A profiling window is already open\n")
+            time.sleep(seconds)
+            sort = query.get('sort', ['cumulative'])[0]
+            try:
+                return respond(start_response, '200 OK', PROFILER.results(sort, limit))
+            except KeyError:
+                return respond(start_response, '400 Bad Request', f"unknown sort key {sort}\n")
+        if path == '/debug/tracemalloc':
+            key = query.get('key', ['lineno'])[0]
+            if key not in ('lineno', 'filename', 'traceback'):
+                return respond(start_response, '400 Bad Request', f"unknown key {key}\n")
+            return respond(start_response, '200 OK', tracemalloc_report(seconds, limit, key))
+        return respond(
+            start_response, '404 Not Found',
+            "Endpoints: /debug/profile?seconds=N&sort=cumulative&limit=40, /debug/tracemalloc?seconds=N&key=lineno&limit=25\n"
+        )
+
+    return app
+
+
+def start_debug_server(profiling_config):
+    """Start the profiling endpoints if enabled in 'exporter.profiling'"""
+    profiling_config = dict(DEFAULT_PROFILING_CONFIG, **(profiling_config or {}))
+    if not profiling_config['enabled']:
+        return None
+    host, port = profiling_config['host'], profiling_config['port']
+    logger.info(f"Profiling endpoints available on {host}:{port}/debug/")
+    return _serve_in_thread(make_debug_app(profiling_config['max_seconds']), host, port, 'fishnet-debug')
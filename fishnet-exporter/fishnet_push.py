@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Fishnet push protocol
+Compact format used by client exporters to push their metrics to the central
+server. A push is a JSON document, compressed with gzip or zstd, holding
+either a full snapshot of the fishnet_* series or only the series that
+changed since the last push acknowledged by the central server. Deltas carry
+a sequence number and the sequence they apply to; a full snapshot is sent
+periodically and whenever the central server cannot apply a delta. The plain
+text exposition format remains accepted by the central server. Received
+bodies are decompressed in bounded chunks, so that a small push cannot
+inflate past the size the central server accepts.
+"""
+
+import io
+import re
+import json
+import time
+import zlib
+import gzip
+import logging
+import threading
+from prometheus_client import Counter, generate_latest
+from prometheus_client.metrics_core import METRIC_TYPES
+from fishnet_ingest import PushError, parse_exposition
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('fishnet-exporter')
+
+PUSH_CONTENT_TYPE = 'application/vnd.fishnet.push+json'
+PUSH_VERSION = 1
+
+FISHNET_PUSH_BYTES = Counter('fishnet_push_bytes_total', 'Bytes pushed to the central server', ['format', 'encoding'])
+FISHNET_PUSH_SERIES = Counter('fishnet_push_series_total', 'Series pushed to the central server', ['kind'])
+FISHNET_PUSH_REJECTED = Counter('fishnet_push_rejected_total', 'Pushes rejected by the central server with a client error, and dropped', ['code'])
+
+# Defaults for the 'metrics_server.push' section of the configuration
+DEFAULT_PUSH_CONFIG = {
+    'format': 'compact',
+    'compression': 'gzip',
+    'include_prefixes': ['fishnet_'],
+    'incremental': True,
+    'full_snapshot_every': 10,
+    # Seconds before a client that fell back to plain text tries compact pushes again
+    'compact_retry_interval': 3600
+}
+
+DECOMPRESS_CHUNK = 64 * 1024
+
+# Names allowed by the text exposition format
+METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+LABEL_NAME_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+class UnsupportedPush(PushError):
+    """Raised when a push uses a content type or encoding this server cannot read"""
+
+
+class PushTooLarge(PushError):
+    """Raised when a push inflates past the size this server accepts"""
+
+
+class FilteredRegistry:
+    """Registry view restricted to metric families with the given prefixes"""
+
+    def __init__(self, registry, include_prefixes):
+        self.registry = registry
+        self.include_prefixes = tuple(include_prefixes or ())
+
+    def collect(self):
+        for metric in self.registry.collect():
+            if not self.include_prefixes or metric.name.startswith(self.include_prefixes):
+                yield metric
+
+
+def compress(body, compression):
+    """Compress a payload, returns (body, Content-Encoding or None)"""
+    if compression == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdCompressor().compress(body), 'zstd'
+        logger.warning("zstd compression requested but the zstandard package is not installed, using gzip")
+        compression = 'gzip'
+    if compression == 'gzip':
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
+
+
+def gunzip(body, max_bytes):
+    """Decompress gzip members, stopping past max_bytes of output"""
+    output = []
+    size = 0
+    while body:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = body
+        while data and not decompressor.eof:
+            chunk = decompressor.decompress(data, DECOMPRESS_CHUNK)
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise PushTooLarge(f"push inflates past {max_bytes} bytes")
+            output.append(chunk)
+            data = decompressor.unconsumed_tail
+        if not decompressor.eof:
+            raise PushError("invalid gzip body: truncated stream")
+        # Concatenated members, as gzip.decompress() accepts them
+        body = decompressor.unused_data
+    return b''.join(output)
+
+
+def unzstd(body, max_bytes):
+    """Decompress zstd frames, stopping past max_bytes of output"""
+    output = []
+    size = 0
+    with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body), read_across_frames=True) as reader:
+        while True:
+            chunk = reader.read(DECOMPRESS_CHUNK)
+            if not chunk:
+                return b''.join(output)
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise PushTooLarge(f"push inflates past {max_bytes} bytes")
+            output.append(chunk)
+
+
+def decompress(body, encoding, max_bytes=None):
+    """Undo the Content-Encoding of a received push, at most max_bytes of it"""
+    encoding = (encoding or 'identity').lower()
+    try:
+        if encoding == 'identity':
+            return body
+        if encoding == 'gzip':
+            return gunzip(body, max_bytes)
+        if encoding == 'zstd' and zstandard is not None:
+            return unzstd(body, max_bytes)
+    except PushError:
+        raise
+    except Exception as e:
+        raise PushError(f"invalid {encoding} body: {e}")
+    raise UnsupportedPush(f"unsupported content encoding {encoding}")
+
+
+class PushEncoder:
+    """Client side state of the push protocol"""
+
+    def __init__(self):
+        self.seq = 0
+        # Series as last acknowledged by the central server, and its sequence
+        self.acked = None
+        self.acked_seq = None
+        self.pushes_since_full = 0
+        # True while the parts of a push split after a 413 are being sent
+        self.splitting = False
+        # When the central server last answered 415, None while it takes compact pushes
+        self.text_fallback_since = None
+        self._lock = threading.Lock()
+
+    def text_fallback(self, push_config):
+        """Whether pushes are sent as plain text after a 415, until compact ones are tried again"""
+        if self.text_fallback_since is None:
+            return False
+        if time.monotonic() - self.text_fallback_since < push_config['compact_retry_interval']:
+            return True
+        logger.info("Trying compact pushes to the central server again")
+        self.text_fallback_since = None
+        return False
+
+    def snapshot(self, registry, include_prefixes):
+        """Read the current series, returns ({family: [type, help]}, {key: [family, sample, labels, value]})"""
+        families = {}
+        series = {}
+        for metric in FilteredRegistry(registry, include_prefixes).collect():
+            families[metric.name] = [metric.type, metric.documentation]
+            for sample in metric.samples:
+                if sample.name.endswith('_created'):
+                    continue
+                key = (sample.name, tuple(sorted(sample.labels.items())))
+                series[key] = [metric.name, sample.name, sample.labels, sample.value]
+        return families, series
+
+    def encode(self, registry, push_config, source, max_series=None):
+        """Build the next push of at most max_series series, returns (body, headers, state to acknowledge)"""
+        push_config = dict(DEFAULT_PUSH_CONFIG, **(push_config or {}))
+        include_prefixes = push_config['include_prefixes']
+
+        text_fallback = self.text_fallback(push_config)
+        if push_config['format'] == 'text' or text_fallback:
+            body = generate_latest(FilteredRegistry(registry, include_prefixes))
+            body, encoding = compress(body, push_config['compression'] if not text_fallback else 'none')
+            headers = {'Content-Type': 'text/plain', 'X-Fishnet-Source': source}
+            if encoding:
+                headers['Content-Encoding'] = encoding
+            FISHNET_PUSH_BYTES.labels(format='text', encoding=encoding or 'identity').inc(len(body))
+            return body, headers, None
+
+        with self._lock:
+            families, series = self.snapshot(registry, include_prefixes)
+            self.seq += 1
+            # The parts of a split push that follow the first one are deltas
+            full = self.acked is None or (not self.splitting and (
+                not push_config['incremental']
+                or self.pushes_since_full + 1 >= push_config['full_snapshot_every']
+            ))
+            document = {'v': PUSH_VERSION, 'source': source, 'seq': self.seq, 'full': full}
+            if full:
+                changed = list(series.items())
+                acked = {}
+                document['removed'] = []
+            else:
+                changed = [(key, entry) for key, entry in series.items() if self.acked.get(key, [None] * 4)[3] != entry[3]]
+                acked = {key: entry for key, entry in self.acked.items() if key in series}
+                document['base'] = self.acked_seq
+                document['removed'] = [[key[0], dict(key[1])] for key in self.acked if key not in series]
+            remaining = 0
+            if max_series is not None and len(changed) > max_series:
+                # Too large for the central server, the rest goes in the next parts
+                remaining = len(changed) - max_series
+                changed = changed[:max_series]
+            acked.update(changed)
+            document['families'] = {name: families[name] for name in {entry[0] for _, entry in changed}}
+            document['series'] = [entry for _, entry in changed]
+            state = (self.seq, acked, full, len(changed), remaining)
+
+        FISHNET_PUSH_SERIES.labels(kind='full' if full else 'delta').inc(len(changed))
+        body = json.dumps(document, separators=(',', ':')).encode('utf-8')
+        body, encoding = compress(body, push_config['compression'])
+        headers = {'Content-Type': PUSH_CONTENT_TYPE, 'X-Fishnet-Source': source}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        FISHNET_PUSH_BYTES.labels(format='compact', encoding=encoding or 'identity').inc(len(body))
+        return body, headers, state
+
+    def reset(self):
+        """Forget the acknowledged series, the next push is a full snapshot"""
+        with self._lock:
+            self.acked = None
+            self.acked_seq = None
+            self.splitting = False
+            # Another central server may take compact pushes
+            self.text_fallback_since = None
+
+    def acknowledge(self, state, response):
+        """Update the protocol state from the central server's answer"""
+        if response.status_code == 415 and self.text_fallback_since is None:
+            logger.warning("Central server does not understand compact pushes, falling back to plain text")
+            self.text_fallback_since = time.monotonic()
+            return
+        if state is None:
+            return
+
+        seq, acked, full, _, remaining = state
+        with self._lock:
+            if response.status_code == 200:
+                self.acked = acked
+                self.acked_seq = seq
+                self.splitting = remaining > 0
+                self.pushes_since_full = 0 if full else self.pushes_since_full + 1
+            elif response.status_code == 409:
+                # The central server lost our snapshot, start over with a full one
+                logger.info("Central server requested a full snapshot")
+                self.acked = None
+                self.acked_seq = None
+                self.splitting = False
+
+
+def decode_families(document):
+    """Group the series of a compact push by family, returns {family: (type, help, [(sample, labels, value)])}"""
+    declared = document.get('families')
+    series = document.get('series', [])
+    if not isinstance(declared, dict) or not isinstance(series, list):
+        raise PushError("invalid push document: families must be an object and series a list")
+    families = {}
+    for entry in series:
+        try:
+            family, sample_name, labels, value = entry
+            typ, documentation = declared[family]
+            sample = (str(sample_name), {str(name): str(label) for name, label in labels.items()}, float(value))
+        except KeyError:
+            raise PushError(f"invalid push document: series of undeclared family {family}")
+        except (TypeError, ValueError, AttributeError) as e:
+            raise PushError(f"invalid push document: malformed series {entry!r}: {e}")
+        if family not in families:
+            # Anything stored here is rendered on every scrape of the central server
+            if not isinstance(family, str) or not METRIC_NAME_RE.match(family):
+                raise PushError(f"invalid push document: invalid family name {family!r}")
+            if typ not in METRIC_TYPES:
+                raise PushError(f"invalid push document: invalid type {typ!r} for family {family}")
+            if not isinstance(documentation, str):
+                raise PushError(f"invalid push document: invalid help for family {family}")
+            families[family] = (typ, documentation, [])
+        if not METRIC_NAME_RE.match(sample[0]):
+            raise PushError(f"invalid push document: invalid sample name {sample[0]!r}")
+        for name in sample[1]:
+            if not LABEL_NAME_RE.match(name):
+                raise PushError(f"invalid push document: invalid label name {name!r}")
+        families[family][2].append(sample)
+    return families
+
+
+def decode_push(body, content_type, content_encoding, source, store, timestamp=None, max_bytes=None):
+    """Decode a push of any supported format into the ingestion store, returns the acknowledged sequence"""
+    body = decompress(body, content_encoding, max_bytes)
+    content_type = (content_type or 'text/plain').split(';')[0].strip().lower()
+
+    if content_type == PUSH_CONTENT_TYPE:
+        try:
+            document = json.loads(body)
+        except ValueError as e:
+            raise PushError(f"invalid push document: {e}")
+        if not isinstance(document, dict):
+            raise PushError("invalid push document: not an object")
+        if document.get('v') != PUSH_VERSION:
+            raise UnsupportedPush(f"unsupported push version {document.get('v')}")
+
+        families = decode_families(document)
+        removed = document.get('removed', [])
+        if not isinstance(removed, list) or not all(isinstance(entry, list) and len(entry) == 2 and isinstance(entry[1], dict) for entry in removed):
+            raise PushError("invalid push document: malformed removed series")
+        if store.include_prefixes:
+            prefixes = tuple(store.include_prefixes)
+            families = {name: entry for name, entry in families.items() if name.startswith(prefixes)}
+
+        seq = document.get('seq')
+        # Pushes replayed from a client's spool are kept apart, they do not replace its snapshot
+        if timestamp is not None:
+            if not document.get('full', True):
+                raise PushError("a replayed push must be a full snapshot")
+            store.backfill(source, families, timestamp)
+        elif document.get('full', True):
+            store.ingest(source, families, seq=seq)
+        else:
+            store.apply_delta(source, families, removed, document.get('base'), seq)
+        return seq
+
+    if content_type == 'text/plain':
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise PushError(f"invalid exposition format: {e}")
+        families = parse_exposition(text, store.include_prefixes)
+        if timestamp is not None:
+            store.backfill(source, families, timestamp)
+        else:
+            store.ingest(source, families)
+        return None
+
+    raise UnsupportedPush(f"unsupported content type {content_type}")
+
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Fishnet remote-write output
+Output of the client exporters selected with metrics_server.output:
+remote_write. After each collection cycle, the fishnet_* series that would
+be pushed to the central server are sent instead to a Prometheus
+remote-write endpoint (Prometheus started with
+--web.enable-remote-write-receiver, Mimir, VictoriaMetrics...) as a
+snappy-compressed protobuf WriteRequest, without the central server and its
+scrape interval in between. Samples are spread over a few shards by a hash
+of their series, so that the samples of a series stay in order; each shard
+has a bounded queue and a sender thread that batches up to
+max_samples_per_send samples per request and retries recoverable errors
+with an exponential backoff. Series gone since the previous cycle get a
+staleness marker. The protobuf messages are encoded by hand, and
+python-snappy is used when it is installed, a pure-Python block compressor
+otherwise.
+"""
+
+import zlib
+import time
+import queue
+import struct
+import logging
+import threading
+from prometheus_client import Counter, Gauge
+from fishnet_http import build_session
+from fishnet_push import FilteredRegistry
+from fishnet_profiling import stage, observe_payload
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_REMOTE_WRITE_SAMPLES = Counter('fishnet_remote_write_samples_total', 'Samples handed to the remote-write output', ['result'])
+FISHNET_REMOTE_WRITE_REQUESTS = Counter('fishnet_remote_write_requests_total', 'Remote-write requests, by HTTP status code', ['code'])
+FISHNET_REMOTE_WRITE_BYTES = Counter('fishnet_remote_write_bytes_total', 'Compressed bytes sent to the remote-write endpoint')
+FISHNET_REMOTE_WRITE_PENDING = Gauge('fishnet_remote_write_pending_samples', 'Samples waiting in the remote-write queues')
+FISHNET_REMOTE_WRITE_LAST_SUCCESS = Gauge('fishnet_remote_write_last_success_timestamp_seconds', 'Time of the last request accepted by the remote-write endpoint')
+
+# Defaults for the 'metrics_server.remote_write' section of the configuration
+DEFAULT_REMOTE_WRITE_CONFIG = {
+    'url': 'http://prometheus:9090/api/v1/write',
+    'bearer_token': None,
+    'include_prefixes': ['fishnet_'],
+    'external_labels': {},
+    'shards': 2,
+    'queue_capacity': 10000,
+    'max_samples_per_send': 2000,
+    'batch_send_deadline': 1.0,
+    'timeout': 10,
+    'max_retries': 10,
+    'min_backoff': 0.1,
+    'max_backoff': 5.0
+}
+
+REMOTE_WRITE_HEADERS = {
+    'Content-Type': 'application/x-protobuf',
+    'Content-Encoding': 'snappy',
+    'X-Prometheus-Remote-Write-Version': '0.1.0',
+    'User-Agent': 'fishnet-exporter'
+}
+
+SOURCE_LABEL = 'source'
+DOUBLE = struct.Struct('<d')
+# Value Prometheus uses to mark a series as gone
+STALE_NAN = struct.pack('<Q', 0x7ff0000000000002)
+
+
+# Protobuf wire format of the remote-write messages:
+#   WriteRequest { repeated TimeSeries timeseries = 1; }
+#   TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+#   Label { string name = 1; string value = 2; }
+#   Sample { double value = 1; int64 timestamp = 2; }
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, pos):
+    """Read a varint at 'pos', returns (value, position after it)"""
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _field(number, payload):
+    # Length-delimited field (wire type 2)
+    return encode_varint(number << 3 | 2) + encode_varint(len(payload)) + payload
+
+
+def encode_labels(labels):
+    """Encoded Label fields of a series, from its (name, value) pairs sorted by name"""
+    return b''.join(_field(1, _field(1, name.encode('utf-8')) + _field(2, value.encode('utf-8'))) for name, value in labels)
+
+
+def encode_sample(value, timestamp_ms):
+    """Encoded Sample message, from the 8 little-endian bytes of its double value"""
+    # value: fixed64 field 1, timestamp: varint field 2
+    return b'\x09' + value + b'\x10' + encode_varint(timestamp_ms)
+
+
+def encode_write_request(series):
+    """WriteRequest from [(encoded labels, [(value bytes, timestamp ms)])]"""
+    return b''.join(
+        _field(1, labels + b''.join(_field(2, encode_sample(value, timestamp)) for value, timestamp in samples))
+        for labels, samples in series
+    )
+
+
+def _fields(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = decode_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = decode_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type}")
+        if pos > len(data):
+            raise ValueError("truncated message")
+        yield number, value
+
+
+def decode_write_request(data):
+    """Decode a WriteRequest, returns [({label: value}, [(value, timestamp ms, staleness marker)])]"""
+    series = []
+    for number, message in _fields(data):
+        if number != 1:
+            continue
+        labels = {}
+        samples = []
+        for field, value in _fields(message):
+            if field == 1:
+                label = dict(_fields(value))
+                labels[label.get(1, b'').decode('utf-8')] = label.get(2, b'').decode('utf-8')
+            elif field == 2:
+                sample = dict(_fields(value))
+                raw = sample.get(1, bytes(8))
+                # Only this exact NaN marks a series as gone, any other NaN is a value
+                samples.append((DOUBLE.unpack(raw)[0], sample.get(2, 0), raw == STALE_NAN))
+        series.append((labels, samples))
+    return series
+
+
+# Snappy block format: the uncompressed length as a varint, then literals and back-references
+
+def _emit_literal(out, data, start, end):
+    while start < end:
+        size = min(end - start, 65536)
+        if size <= 60:
+            out.append((size - 1) << 2)
+        elif size <= 256:
+            out.append(60 << 2)
+            out.append(size - 1)
+        else:
+            out.append(61 << 2)
+            out += (size - 1).to_bytes(2, 'little')
+        out += data[start:start + size]
+        start += size
+
+
+def _emit_copy(out, offset, length):
+    # Copies hold at most 64 bytes, the last one at least 4
+    while length >= 68:
+        out.append((63 << 2) | 2)
+        out += offset.to_bytes(2, 'little')
+        length -= 64
+    if length > 64:
+        out.append((59 << 2) | 2)
+        out += offset.to_bytes(2, 'little')
+        length -= 60
+    if length < 12 and offset < 2048:
+        out.append(((offset >> 8) << 5) | ((length - 4) << 2) | 1)
+        out.append(offset & 0xff)
+    else:
+        out.append(((length - 1) << 2) | 2)
+        out += offset.to_bytes(2, 'little')
+
+
+def snappy_compress(data):
+    """Snappy block compression, with python-snappy when it is installed"""
+    if snappy is not None:
+        return snappy.compress(data)
+    out = bytearray(encode_varint(len(data)))
+    table = {}
+    size = len(data)
+    literal = i = 0
+    while i + 4 <= size:
+        key = data[i:i + 4]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None or i - candidate > 0xffff:
+            i += 1
+            continue
+        length = 4
+        while i + length < size and data[candidate + length] == data[i + length]:
+            length += 1
+        _emit_literal(out, data, literal, i)
+        _emit_copy(out, i - candidate, length)
+        i += length
+        literal = i
+    _emit_literal(out, data, literal, size)
+    return bytes(out)
+
+
+def snappy_decompress(data):
+    """Snappy block decompression, with python-snappy when it is installed"""
+    if snappy is not None:
+        try:
+            return snappy.uncompress(data)
+        except Exception as e:
+            raise ValueError(f"invalid snappy block: {e}")
+    length, pos = decode_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos:pos + extra], 'little')
+                pos += extra
+            size += 1
+            out += data[pos:pos + size]
+            pos += size
+            continue
+        if kind == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        else:
+            width = 2 if kind == 2 else 4
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + width], 'little')
+            pos += width
+        if offset == 0 or offset > len(out):
+            raise ValueError(f"invalid snappy copy offset {offset}")
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            # Overlapping copy, repeats the last 'offset' bytes
+            for k in range(size):
+                out.append(out[start + k])
+    if len(out) != length:
+        raise ValueError(f"snappy length mismatch, expected {length} bytes, got {len(out)}")
+    return bytes(out)
+
+
+class RemoteWriter:
+    """Sharded queues of samples sent to a remote-write endpoint"""
+
+    def __init__(self):
+        self._config = None
+        self._shards = []
+        self._threads = []
+        self._session = None
+        # Encoded labels of the series of the previous cycle, to mark the vanished ones as stale
+        self._last_series = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        FISHNET_REMOTE_WRITE_PENDING.set_function(lambda: sum(shard.qsize() for shard in self._shards))
+
+    def configure(self, remote_write_config):
+        """Apply a 'metrics_server.remote_write' configuration, restarting the shards when their layout changes"""
+        config = dict(DEFAULT_REMOTE_WRITE_CONFIG, **(remote_write_config or {}))
+        with self._lock:
+            previous, self._config = self._config, config
+            if self._shards and (previous['shards'], previous['queue_capacity']) == (config['shards'], config['queue_capacity']):
+                return config
+            if self._shards:
+                logger.info(f"Restarting the remote-write output with {config['shards']} shards")
+            # The running senders send what they hold and exit
+            for shard in self._shards:
+                shard.put(None)
+            self._session = build_session({'retries': 0, 'pool_connections': 1, 'pool_maxsize': config['shards']})
+            self._shards = [queue.Queue(config['queue_capacity']) for _ in range(config['shards'])]
+            self._threads = [
+                threading.Thread(target=self._run, args=(index, shard), name=f'fishnet-remote-write-{index}', daemon=True)
+                for index, shard in enumerate(self._shards)
+            ]
+            for thread in self._threads:
+                thread.start()
+        return config
+
+    def enqueue(self, registry, remote_write_config, source):
+        """Queue the current series of a registry, returns the number of samples queued"""
+        config = self.configure(remote_write_config)
+        timestamp = int(time.time() * 1000)
+        extra = dict(config['external_labels'] or {})
+        extra[SOURCE_LABEL] = source
+
+        with stage('remote_write_collect'):
+            series = {}
+            for metric in FilteredRegistry(registry, config['include_prefixes']).collect():
+                for sample in metric.samples:
+                    if sample.name.endswith('_created'):
+                        continue
+                    labels = dict(extra, **sample.labels)
+                    labels['__name__'] = sample.name
+                    series[encode_labels(sorted(labels.items()))] = DOUBLE.pack(sample.value)
+            stale = self._last_series.difference(series)
+            self._last_series = set(series)
+            for labels in stale:
+                series[labels] = STALE_NAN
+
+        shards = self._shards
+        queued = dropped = 0
+        for labels, value in series.items():
+            try:
+                shards[zlib.crc32(labels) % len(shards)].put_nowait((labels, value, timestamp))
+                queued += 1
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            FISHNET_REMOTE_WRITE_SAMPLES.labels(result='dropped').inc(dropped)
+            logger.warning(f"Remote-write queues full, dropped {dropped} samples")
+        return queued
+
+    def _run(self, index, shard):
+        while True:
+            item = shard.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self._config['batch_send_deadline']
+            while len(batch) < self._config['max_samples_per_send']:
+                try:
+                    item = shard.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._send(index, batch)
+            if stopping:
+                return
+
+    def _send(self, index, batch):
+        config = self._config
+        # Samples of a series are grouped under one TimeSeries, in order
+        grouped = {}
+        for labels, value, timestamp in batch:
+            grouped.setdefault(labels, []).append((value, timestamp))
+        with stage('remote_write_encode'):
+            body = snappy_compress(encode_write_request(grouped.items()))
+        observe_payload('remote_write', len(body))
+        headers = dict(REMOTE_WRITE_HEADERS)
+        if config['bearer_token']:
+            headers['Authorization'] = f"Bearer {config['bearer_token']}"
+
+        backoff = config['min_backoff']
+        for attempt in range(config['max_retries'] + 1):
+            try:
+                with stage('remote_write_send'):
+                    response = self._session.post(config['url'], data=body, headers=headers, timeout=config['timeout'])
+                code = response.status_code
+                FISHNET_REMOTE_WRITE_REQUESTS.labels(code=str(code)).inc()
+            except Exception as e:
+                code = None
+                FISHNET_REMOTE_WRITE_REQUESTS.labels(code='error').inc()
+                logger.warning(f"Remote-write request of shard {index} failed: {e}")
+            if code is not None and code < 300:
+                FISHNET_REMOTE_WRITE_SAMPLES.labels(result='sent').inc(len(batch))
+                FISHNET_REMOTE_WRITE_BYTES.inc(len(body))
+                FISHNET_REMOTE_WRITE_LAST_SUCCESS.set(time.time())
+                return
+            if code is not None and 400 <= code < 500 and code != 429:
+                # Retrying would be rejected the same way
+                FISHNET_REMOTE_WRITE_SAMPLES.labels(result='rejected').inc(len(batch))
+                logger.warning(f"Remote-write endpoint rejected {len(batch)} samples: HTTP {code} {response.text[:200]}")
+                return
+            if self._stop.wait(backoff):
+                break
+            backoff = min(backoff * 2, config['max_backoff'])
+        FISHNET_REMOTE_WRITE_SAMPLES.labels(result='failed').inc(len(batch))
+        logger.error(f"Giving up on {len(batch)} remote-write samples of shard {index}")
+
+    def stop(self, timeout):
+        """Send what is queued, waiting at most 'timeout' seconds"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            shards, self._shards = self._shards, []
+            threads, self._threads = self._threads, []
+        for shard in shards:
+            shard.put(None)
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        # Retries still waiting give up
+        self._stop.set()
+
+
+REMOTE_WRITER = RemoteWriter()
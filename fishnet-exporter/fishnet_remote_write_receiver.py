@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Fishnet remote-write receiver
+Local stand-in for a Prometheus remote-write endpoint, to try the
+remote_write output of the client exporters without a Prometheus server.
+It decodes the snappy-compressed WriteRequests posted to /api/v1/write,
+keeps the latest sample of every series and serves them back in the text
+exposition format on /metrics. Latency and an error rate can be added to
+exercise the retries and the queues of the exporter, e.g.
+python fishnet_remote_write_receiver.py --port 19201 --error-rate 0.2
+"""
+
+import argparse
+import random
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from fishnet_remote_write import snappy_decompress, decode_write_request
+
+
+class RemoteWriteReceiver(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        super().__init__(address, RemoteWriteHandler)
+        self.args = args
+        # (sorted label pairs) -> (value, timestamp ms)
+        self.series = {}
+        self.requests = 0
+        self.samples = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def store(self, series, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            for labels, samples in series:
+                key = tuple(sorted(labels.items()))
+                for value, timestamp, stale in samples:
+                    self.samples += 1
+                    # A staleness marker removes the series
+                    if stale:
+                        self.series.pop(key, None)
+                    else:
+                        self.series[key] = (value, timestamp)
+
+    def exposition(self):
+        lines = [
+            f'# remote-write receiver: {self.requests} requests, {self.samples} samples, {self.bytes} bytes',
+        ]
+        with self._lock:
+            for key, (value, timestamp) in sorted(self.series.items()):
+                labels = dict(key)
+                name = labels.pop('__name__', '')
+                rendered = ','.join(f'{label}="{labels[label]}"' for label in sorted(labels))
+                lines.append(f'{name}{{{rendered}}} {value} {timestamp}')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class RemoteWriteHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        args = self.server.args
+        if self.path != '/api/v1/write':
+            return self._send(404, b'not found\n')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if args.latency:
+            time.sleep(args.latency / 1000.0)
+        if random.random() < args.error_rate:
+            return self._send(503, b'unavailable\n')
+        if self.headers.get('Content-Encoding') != 'snappy':
+            return self._send(400, b'expected snappy encoding\n')
+        try:
+            series = decode_write_request(snappy_decompress(body))
+        except (ValueError, IndexError, TypeError, AttributeError, struct.error) as e:
+            # A malformed body, truncated or with unexpected wire types
+            return self._send(400, f'invalid write request: {e}\n'.encode('utf-8'))
+        self.server.store(series, len(body))
+        if args.verbose:
+            print(f"{len(series)} series, {sum(len(samples) for _, samples in series)} samples, {len(body)} bytes")
+        self._send(204, b'')
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._send(404, b'not found\n')
+        self._send(200, self.server.exposition())
+
+    def _send(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Stand-in Prometheus remote-write receiver')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=19201, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency, in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the requests answered with HTTP 503')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every received request')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    server = RemoteWriteReceiver((args.host, args.port), args)
+    print(f"Remote-write receiver on http://{args.host}:{args.port}/api/v1/write, samples on /metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
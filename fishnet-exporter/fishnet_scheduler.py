@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Fishnet collection scheduler
+Replaces the schedule library and its 1-second polling loop. Every server
+gets a deadline on the monotonic clock (exporter.scrape_interval, or its own
+'interval' in servers[]); the scheduler sleeps until the earliest deadline,
+starts a cycle with every server due at that moment, and computes the next
+deadlines from the previous ones so that cycles do not drift. A server is
+released as soon as its own poll ends, so a slow server does not hold back
+the others; ticks it missed while overrunning are skipped rather than stacked.
+The next deadline of a server is set by the adaptive policy of
+fishnet_adaptive.py, which backs off unreachable servers and follows the
+activity of the others. The periodic task (the push of a client, or the
+fleet rollups of a central server) has a deadline of its own, every
+scrape_interval from the end of the first cycle, or from the start of the
+scheduler if no cycle ends before, so that it keeps its cadence however the
+polls of the servers are spread out, and runs even without any server.
+"""
+
+import signal
+import logging
+import threading
+import time
+from prometheus_client import Counter, Gauge
+from fishnet_adaptive import ADAPTIVE_POLICY
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_SCHEDULER_LAG = Gauge('fishnet_scheduler_lag_seconds', 'Delay between the scheduled and actual start of the last poll', ['instance'])
+FISHNET_SCHEDULER_OVERRUNS = Counter('fishnet_scheduler_overruns_total', 'Cycles that ended after the next deadline of a server', ['instance'])
+FISHNET_SCHEDULER_SKIPPED = Counter('fishnet_scheduler_skipped_ticks_total', 'Ticks skipped because a previous cycle overran', ['instance'])
+
+# Servers due within this window are collected in the same cycle
+COALESCE_WINDOW = 0.25
+# Upper bound on a sleep, so that configuration changes are noticed
+CONFIG_CHECK_INTERVAL = 5.0
+
+
+class CollectionScheduler:
+    """Monotonic, per-server deadline scheduler for collection cycles"""
+
+    def __init__(self, load_config, collect, periodic=None):
+        self.load_config = load_config
+        self.collect = collect
+        self.periodic = periodic
+        self._deadlines = {}
+        self._intervals = {}
+        self._in_flight = {}
+        # None until run() starts, brought forward to the end of the first cycle
+        self._periodic_deadline = None
+        self._periodic_started = False
+        self._lock = threading.Lock()
+        self._periodic_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def stop(self):
+        """Ask the scheduler to exit once the running cycles are done"""
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Re-read the configuration and deadlines now"""
+        self._wake.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def run_once(self):
+        """Start a cycle with every server that is due, returns the seconds until the next one"""
+        config = self.load_config()
+        default = config['exporter']['scrape_interval']
+        servers = {server['name']: server for server in config.get('servers', [])}
+        now = time.monotonic()
+        ADAPTIVE_POLICY.configure(config['exporter'].get('adaptive'))
+
+        with self._lock:
+            # New servers are due immediately, removed ones are forgotten
+            self._intervals = {name: server.get('interval', default) for name, server in servers.items()}
+            for name in servers:
+                self._deadlines.setdefault(name, now)
+            for name in list(self._deadlines):
+                if name not in servers:
+                    del self._deadlines[name]
+                    ADAPTIVE_POLICY.forget(name)
+
+            # A server still being polled is not started again, its overrun is handled when it ends
+            due = [
+                name for name, deadline in self._deadlines.items()
+                if deadline <= now + COALESCE_WINDOW and name not in self._in_flight
+            ]
+            for name in due:
+                FISHNET_SCHEDULER_LAG.labels(instance=name).set(max(0.0, now - self._deadlines[name]))
+                self._in_flight[name] = self._deadlines[name]
+
+        if due:
+            cycle = threading.Thread(
+                target=self._run_cycle,
+                args=(dict(config, servers=[servers[name] for name in due]), due),
+                name='fishnet-cycle',
+                daemon=True
+            )
+            cycle.start()
+
+        self._start_periodic(default)
+
+        with self._lock:
+            waiting = [deadline for name, deadline in self._deadlines.items() if name not in self._in_flight]
+            if self._periodic_deadline is not None:
+                waiting.append(self._periodic_deadline)
+        if not waiting:
+            return CONFIG_CHECK_INTERVAL
+        return max(0.0, min(waiting) - time.monotonic())
+
+    def _run_cycle(self, config, due):
+        try:
+            # Each server is released as soon as its own poll ends, not with the slowest one
+            self.collect(config, on_done=lambda name: self._finish_servers([name]))
+        except Exception as e:
+            logger.error(f"Error during collection cycle: {e}")
+        finally:
+            with self._lock:
+                if self.periodic is not None and not self._periodic_started:
+                    # The first run follows the first cycle, the next ones every scrape_interval
+                    self._periodic_deadline = time.monotonic()
+            self._finish_servers(due)
+
+    def _start_periodic(self, interval):
+        """Start the periodic task on its own thread once its deadline has come"""
+        now = time.monotonic()
+        with self._lock:
+            deadline = self._periodic_deadline
+            if deadline is None or deadline > now + COALESCE_WINDOW:
+                return
+            deadline += interval
+            if deadline <= now:
+                # Skip the runs missed while the previous one ran long
+                deadline += ((now - deadline) // interval + 1) * interval
+            self._periodic_deadline = deadline
+            self._periodic_started = True
+        threading.Thread(target=self._run_periodic, name='fishnet-periodic', daemon=True).start()
+
+    def _run_periodic(self):
+        # Runs must not overlap, a run still going skips this one
+        if not self._periodic_lock.acquire(blocking=False):
+            logger.warning("Previous push still running, skipping this one")
+            return
+        try:
+            self.periodic()
+        except Exception as e:
+            logger.error(f"Error during periodic push: {e}")
+        finally:
+            self._periodic_lock.release()
+
+    def _finish_servers(self, names):
+        end = time.monotonic()
+        with self._lock:
+            for name in names:
+                if name not in self._in_flight:
+                    continue
+                started = self._in_flight.pop(name)
+                if name not in self._deadlines:
+                    continue
+                interval = self._intervals.get(name, 0)
+                if interval > 0:
+                    interval = ADAPTIVE_POLICY.interval(name, interval)
+                deadline = started + interval
+                if deadline <= end and interval > 0:
+                    # Skip the ticks missed during the overrun instead of stacking them
+                    missed = int((end - deadline) // interval) + 1
+                    deadline += missed * interval
+                    FISHNET_SCHEDULER_OVERRUNS.labels(instance=name).inc()
+                    FISHNET_SCHEDULER_SKIPPED.labels(instance=name).inc(missed)
+                    logger.warning(f"Collection of {name} overran its {interval}s interval, skipped {missed} tick(s)")
+                self._deadlines[name] = deadline
+        self._wake.set()
+
+    def run(self):
+        """Run collection cycles until stop() is called"""
+        if self.periodic is not None:
+            # Without any server, or with only slow ones, the periodic task still runs
+            interval = self.load_config()['exporter']['scrape_interval']
+            with self._lock:
+                if self._periodic_deadline is None:
+                    self._periodic_deadline = time.monotonic() + interval
+        while not self._stop.is_set():
+            delay = self.run_once()
+            self._wake.wait(min(delay, CONFIG_CHECK_INTERVAL))
+            self._wake.clear()
+        logger.info("Collection scheduler stopped")
+
+    def wait_idle(self, timeout):
+        """Wait for the running cycles to finish, at most 'timeout' seconds"""
+        deadline = time.monotonic() + timeout
+        while self._in_flight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self._in_flight
+
+
+def install_shutdown_handlers(scheduler):
+    """Stop the scheduler and leave the main thread on SIGTERM or SIGINT"""
+
+    def handle_shutdown(signum, frame):
+        if scheduler.stopped:
+            # A repeated signal would cut the final warm-start save short
+            logger.info(f"Received signal {signum} again, already shutting down")
+            return
+        logger.info(f"Received signal {signum}, shutting down")
+        scheduler.stop()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Fishnet series lifecycle
+Tracks when each label set of a metric was last seen, removes series that
+have been absent for a number of collection cycles of their instance, and
+enforces a cardinality cap per metric so that churning clients cannot grow
+the exporter's memory and /metrics payload without limit.
+"""
+
+import logging
+import threading
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_SERIES_ACTIVE = Gauge('fishnet_series_active', 'Series currently exported per metric', ['metric'])
+FISHNET_SERIES_EVICTED = Counter('fishnet_series_evicted_total', 'Series removed after being absent for too many cycles', ['metric'])
+FISHNET_SERIES_REJECTED = Counter('fishnet_series_rejected_total', 'New series refused because the metric reached its cardinality cap', ['metric'])
+
+# Defaults for the 'exporter.series' section of the configuration
+DEFAULT_SERIES_CONFIG = {
+    'evict_after_cycles': 3,
+    'max_series': {},
+    'rollup_client_versions': True
+}
+
+
+class SeriesTracker:
+    """Lifecycle of the labelled children of one metric"""
+
+    def __init__(self, metric, name, evict_after=3, max_series=None):
+        self.metric = metric
+        self.name = name
+        self.evict_after = evict_after
+        self.max_series = max_series
+        # instance -> {label values: cycle in which they were last seen}
+        self._series = {}
+        self._cycles = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def configure(self, evict_after, max_series):
+        self.evict_after = evict_after
+        self.max_series = max_series
+
+    def touch(self, labels):
+        """Mark a label set (instance first) as seen, returns False if over the cap"""
+        instance = labels[0]
+        with self._lock:
+            series = self._series.setdefault(instance, {})
+            if labels not in series:
+                if self.max_series is not None and self._count >= self.max_series:
+                    FISHNET_SERIES_REJECTED.labels(metric=self.name).inc()
+                    return False
+                self._count += 1
+                FISHNET_SERIES_ACTIVE.labels(metric=self.name).set(self._count)
+            series[labels] = self._cycles.get(instance, 0)
+            return True
+
+    def end_cycle(self, instance):
+        """Close a cycle of an instance and evict its absent series, returns the number evicted"""
+        with self._lock:
+            cycle = self._cycles.get(instance, 0)
+            self._cycles[instance] = cycle + 1
+            series = self._series.get(instance, {})
+            stale = [labels for labels, seen in series.items() if cycle - seen >= self.evict_after]
+            for labels in stale:
+                del series[labels]
+                try:
+                    self.metric.remove(*labels)
+                except KeyError:
+                    pass
+            if stale:
+                self._count -= len(stale)
+                FISHNET_SERIES_EVICTED.labels(metric=self.name).inc(len(stale))
+                FISHNET_SERIES_ACTIVE.labels(metric=self.name).set(self._count)
+                logger.debug(f"Evicted {len(stale)} series of {self.name} for {instance}")
+            return len(stale)
+
+    def forget(self, instance):
+        """Remove every series of an instance"""
+        with self._lock:
+            series = self._series.pop(instance, {})
+            self._cycles.pop(instance, None)
+            for labels in series:
+                try:
+                    self.metric.remove(*labels)
+                except KeyError:
+                    pass
+            self._count -= len(series)
+            FISHNET_SERIES_ACTIVE.labels(metric=self.name).set(self._count)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Fishnet central server
+Serves the central mode's Flask app on a multi-threaded WSGI server (waitress
+when installed, a bounded thread pool on top of wsgiref otherwise), with a
+request body size limit and backpressure on /metrics/push: when too many
+pushes are being processed, new ones are answered 503 with a Retry-After
+header instead of queueing up behind them.
+"""
+
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from prometheus_client import Gauge
+from fishnet_ingest import FISHNET_INGEST_PUSHES
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_INGEST_INFLIGHT = Gauge('fishnet_ingest_inflight_pushes', 'Pushes currently being processed by the central server')
+
+# Defaults for the 'metrics_server.server' section of the configuration
+DEFAULT_SERVER_CONFIG = {
+    'workers': 8,
+    'max_body_bytes': 10 * 1024 * 1024,
+    # A compressed push may inflate to at most max_body_bytes times this ratio
+    'max_decompression_ratio': 20,
+    'max_inflight_pushes': 32,
+    'retry_after': 5,
+    'connection_limit': 1000,
+    'backlog': 1024
+}
+
+PUSH_PATH = '/metrics/push'
+
+
+class PushLimiter:
+    """WSGI middleware bounding the size and concurrency of pushes"""
+
+    def __init__(self, app, max_body_bytes, max_inflight, retry_after):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_inflight)
+
+    def _reject(self, start_response, status, reason, message, headers=()):
+        FISHNET_INGEST_PUSHES.labels(result=reason).inc()
+        body = json.dumps({'error': message}).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))] + list(headers))
+        return [body]
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != PUSH_PATH or environ.get('REQUEST_METHOD') != 'POST':
+            return self.app(environ, start_response)
+
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > self.max_body_bytes:
+            return self._reject(start_response, '413 Payload Too Large', 'too_large', 'push body too large')
+
+        if not self._slots.acquire(blocking=False):
+            return self._reject(
+                start_response, '503 Service Unavailable', 'throttled', 'too many pushes in flight',
+                [('Retry-After', str(self.retry_after))]
+            )
+        FISHNET_INGEST_INFLIGHT.inc()
+        try:
+            # The push is fully read and ingested before the response is returned
+            return list(self.app(environ, start_response))
+        finally:
+            FISHNET_INGEST_INFLIGHT.dec()
+            self._slots.release()
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """wsgiref server handing requests to a fixed pool of worker threads"""
+
+    daemon_threads = True
+    workers = DEFAULT_SERVER_CONFIG['workers']
+    request_queue_size = DEFAULT_SERVER_CONFIG['backlog']
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, '_pool'):
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fishnet-http')
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(app, host, port, server_config=None):
+    """Serve a WSGI app until the process exits"""
+    server_config = dict(DEFAULT_SERVER_CONFIG, **(server_config or {}))
+    wrapped = PushLimiter(
+        app,
+        server_config['max_body_bytes'],
+        server_config['max_inflight_pushes'],
+        server_config['retry_after']
+    )
+
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+
+    if waitress is not None:
+        logger.info(f"Serving on {host}:{port} with waitress ({server_config['workers']} workers)")
+        waitress.serve(
+            wrapped,
+            host=host,
+            port=port,
+            threads=server_config['workers'],
+            connection_limit=server_config['connection_limit'],
+            backlog=server_config['backlog'],
+            max_request_body_size=server_config['max_body_bytes'],
+            ident='fishnet-exporter'
+        )
+        return
+
+    logger.warning(f"waitress is not installed, serving on {host}:{port} with the wsgiref thread pool ({server_config['workers']} workers)")
+    PooledWSGIServer.workers = server_config['workers']
+    PooledWSGIServer.request_queue_size = server_config['backlog']
+    httpd = make_server(host, port, wrapped, server_class=PooledWSGIServer, handler_class=QuietRequestHandler)
+    httpd.serve_forever()
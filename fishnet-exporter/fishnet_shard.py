@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Fishnet central server sharding
+Spreads the client exporters over several central servers. Each client is
+assigned to a shard by consistent hashing of its client_id over the
+'metrics_server.central_urls' list, so adding or removing a shard only moves
+the clients of that shard. When its shard does not answer, a client pushes to
+the next shard on the ring, skips the failed one for a while, and goes back
+to it once it answers again, asking the shard used in between to forget it.
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_SHARD_FAILOVERS = Counter('fishnet_shard_failovers_total', 'Pushes sent to another central shard than the owner one', ['url'])
+FISHNET_SHARD_ERRORS = Counter('fishnet_shard_push_errors_total', 'Pushes a central shard failed to take', ['url'])
+FISHNET_SHARD_TARGET = Gauge('fishnet_shard_target', 'Central shard that took the last push (1) among the configured ones', ['url'])
+
+# Defaults for the 'metrics_server.shard' section of the configuration
+DEFAULT_SHARD_CONFIG = {
+    'replicas': 64,
+    'retry_after': 30
+}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring of the central URLs, with virtual nodes"""
+
+    def __init__(self, nodes, replicas=DEFAULT_SHARD_CONFIG['replicas']):
+        self.nodes = list(dict.fromkeys(nodes))
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owners(self, key):
+        """Every node, starting with the owner of key and then in failover order"""
+        if not self.nodes:
+            return []
+        start = bisect.bisect(self._hashes, _hash(key))
+        owners = []
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == len(self.nodes):
+                    break
+        return owners
+
+
+class ShardRouter:
+    """Client side choice of the central shard to push to"""
+
+    def __init__(self):
+        self._ring = None
+        self._ring_key = None
+        # url -> time before which it is not tried first again
+        self._failed_until = {}
+        self.last_url = None
+        self._lock = threading.Lock()
+
+    def targets(self, central_urls, source, shard_config=None):
+        """Shards to try for this push, in order: the owner first unless it failed recently"""
+        shard_config = dict(DEFAULT_SHARD_CONFIG, **(shard_config or {}))
+        with self._lock:
+            ring_key = (tuple(central_urls), shard_config['replicas'])
+            if ring_key != self._ring_key:
+                self._ring = HashRing(central_urls, shard_config['replicas'])
+                self._ring_key = ring_key
+                if len(self._ring.nodes) > 1:
+                    logger.info(f"Client {source} is assigned to central shard {self._ring.owners(source)[0]}")
+            owners = self._ring.owners(source)
+            now = time.monotonic()
+            # Shards that failed recently are only tried last
+            healthy = [url for url in owners if self._failed_until.get(url, 0) <= now]
+            return healthy + [url for url in owners if url not in healthy]
+
+    def failed(self, url, shard_config=None):
+        """A shard did not take the push, skip it for retry_after seconds"""
+        shard_config = dict(DEFAULT_SHARD_CONFIG, **(shard_config or {}))
+        FISHNET_SHARD_ERRORS.labels(url=url).inc()
+        with self._lock:
+            self._failed_until[url] = time.monotonic() + shard_config['retry_after']
+
+    def succeeded(self, url, source):
+        """A shard took the push, returns the previously used shard if it changed and still answers"""
+        with self._lock:
+            self._failed_until.pop(url, None)
+            previous, self.last_url = self.last_url, url
+            nodes = self._ring.nodes
+            owner = self._ring.owners(source)[0]
+            if previous == url or self._failed_until.get(previous, 0) > time.monotonic():
+                previous = None
+        if url != owner:
+            FISHNET_SHARD_FAILOVERS.labels(url=url).inc()
+        for node in nodes:
+            FISHNET_SHARD_TARGET.labels(url=node).set(1 if node == url else 0)
+        return previous
+
+
+SHARD_ROUTER = ShardRouter()
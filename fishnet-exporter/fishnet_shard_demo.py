@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Fishnet sharding demo
+Runs, on this machine, a mock Fishnet status server, several central shards
+and client exporters pushing to them through 'metrics_server.central_urls'.
+Shows which clients each shard exposes on /metrics, then stops one shard to
+show its clients failing over to the others, and restarts it to show them
+coming back and being withdrawn from the shards used in between.
+"""
+
+import argparse
+import atexit
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+import yaml
+from tabulate import tabulate
+from fishnet_bench import HERE, free_port, start_mock_server
+from fishnet_shard import HashRing
+
+AUTH_KEY = 'demo'
+SPOOL_DIR = tempfile.mkdtemp(prefix='fishnet-shard-demo-')
+atexit.register(shutil.rmtree, SPOOL_DIR, ignore_errors=True)
+SOURCE_PATTERN = re.compile(r'^fishnet_up\{.*source="([^"]+)"', re.MULTILINE)
+
+
+def start_exporter(config, log):
+    """Run fishnet_exporter_modified.py with the given configuration"""
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as file:
+        yaml.safe_dump(config, file)
+    atexit.register(os.unlink, file.name)
+    env = dict(os.environ, FISHNET_CONFIG=file.name)
+    return subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'fishnet_exporter_modified.py')],
+        cwd=HERE, env=env, stdout=log, stderr=log
+    )
+
+
+def shard_config(port):
+    return {
+        'servers': [],
+        'exporter': {'port': port, 'scrape_interval': 60},
+        'metrics_server': {'enabled': True, 'mode': 'central', 'auth_key': AUTH_KEY, 'ingest': {'staleness': 60}}
+    }
+
+
+def client_config(index, args, urls):
+    return {
+        'servers': [{'name': f'demo-{index:02d}', 'url': f'{args.mock_url}/demo{index}?clients={args.fleet}'}],
+        'exporter': {'port': free_port(), 'scrape_interval': args.interval, 'http': {'retries': 1}},
+        'metrics_server': {
+            'enabled': True,
+            'mode': 'client',
+            'central_urls': urls,
+            'client_id': f'client-{index:02d}',
+            'auth_key': AUTH_KEY,
+            'shard': {'retry_after': args.retry_after},
+            'spool': {'path': os.path.join(SPOOL_DIR, f'client-{index:02d}')}
+        }
+    }
+
+
+def wait_until_up(url, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+def shard_sources(metrics_url):
+    """Clients exposed by a shard, or None if it does not answer"""
+    try:
+        text = requests.get(metrics_url, params={'name[]': 'fishnet_up'}, timeout=5).text
+    except requests.RequestException:
+        return None
+    return sorted(set(SOURCE_PATTERN.findall(text)))
+
+
+def report(title, shards, ring, clients):
+    print(f"\n== {title}")
+    rows = []
+    seen = {}
+    for push_url, metrics_url in shards:
+        sources = shard_sources(metrics_url)
+        owned = [client for client in clients if ring.owners(client)[0] == push_url]
+        if sources is None:
+            rows.append([metrics_url, 'down', len(owned), ''])
+            continue
+        for source in sources:
+            seen.setdefault(source, []).append(metrics_url)
+        rows.append([metrics_url, len(sources), len(owned), ' '.join(sources)])
+    print(tabulate(rows, headers=['shard', 'exposed', 'owned', 'clients'], tablefmt='simple'))
+    duplicated = sorted(source for source, urls in seen.items() if len(urls) > 1)
+    missing = sorted(set(clients) - set(seen))
+    print(f"missing: {', '.join(missing) or 'none'}; exposed by several shards: {', '.join(duplicated) or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Demonstrate Fishnet central sharding with local processes')
+    parser.add_argument('-s', '--shards', type=int, default=3, help='Number of central shards')
+    parser.add_argument('-n', '--clients', type=int, default=12, help='Number of client exporters')
+    parser.add_argument('--fleet', type=int, default=20, help='Fishnet clients behind each mocked server')
+    parser.add_argument('-i', '--interval', type=float, default=2, help='Collection and push interval of the clients, in seconds')
+    parser.add_argument('--retry-after', type=float, default=10, help='Seconds before a client tries a failed shard again')
+    parser.add_argument('--verbose', action='store_true', help='Show the logs of the exporters')
+    args = parser.parse_args()
+
+    log = None if args.verbose else subprocess.DEVNULL
+    processes = []
+    try:
+        mock, args.mock_url = start_mock_server(argparse.Namespace(latency=0, churn=0.01))
+        processes.append(mock)
+
+        ports = [free_port() for _ in range(args.shards)]
+        shards = [(f'http://127.0.0.1:{port}/metrics/push', f'http://127.0.0.1:{port}/metrics') for port in ports]
+        push_urls = [push_url for push_url, _ in shards]
+        shard_processes = [start_exporter(shard_config(port), log) for port in ports]
+        processes.extend(shard_processes)
+        for _, metrics_url in shards:
+            wait_until_up(metrics_url)
+
+        clients = [f'client-{i:02d}' for i in range(args.clients)]
+        processes.extend(start_exporter(client_config(i, args, push_urls), log) for i in range(args.clients))
+        ring = HashRing(push_urls)
+
+        time.sleep(3 * args.interval + 2)
+        report("All shards up", shards, ring, clients)
+
+        shard_processes[0].terminate()
+        shard_processes[0].wait()
+        time.sleep(3 * args.interval + 5)
+        report(f"Shard {shards[0][1]} stopped, its clients failed over", shards, ring, clients)
+
+        processes.append(start_exporter(shard_config(ports[0]), log))
+        wait_until_up(shards[0][1])
+        time.sleep(args.retry_after + 3 * args.interval + 2)
+        report(f"Shard {shards[0][1]} restarted, its clients came back", shards, ring, clients)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
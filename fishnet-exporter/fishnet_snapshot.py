@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Fishnet snapshot collection mode
+Alternative to the module-level gauges of fishnet_collector.py, selected with
+exporter.collection_mode: snapshot. Every poll builds an immutable snapshot
+of its instance's metrics, which replaces the previous one in a single
+reference swap; scrapes read the current snapshot without taking any of the
+metric locks the collector holds, and the exposition text of a snapshot is
+rendered once and reused by every scrape until the next swap.
+"""
+
+import logging
+import threading
+from collections import namedtuple
+from prometheus_client import Counter, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from fishnet_state import UPSTREAM_STATE
+from fishnet_series import DEFAULT_SERIES_CONFIG, FISHNET_SERIES_ACTIVE, FISHNET_SERIES_EVICTED, FISHNET_SERIES_REJECTED
+from fishnet_decode import section_fingerprint
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_SNAPSHOT_RENDERS = Counter('fishnet_snapshot_renders_total', 'Scrapes of the snapshot, served from the cached rendering or not', ['result'])
+
+# Label values are stored as sorted tuples so that a snapshot is never mutated once published
+InstanceSnapshot = namedtuple('InstanceSnapshot', [
+    'up', 'nodes', 'queued', 'completed', 'rejected', 'clients', 'versions', 'analyses', 'move_time', 'failures'
+])
+EMPTY_INSTANCE = InstanceSnapshot(0, None, (), (), (), (), (), None, (), 0)
+
+
+class _Families:
+    """Registry-like holder of already built metric families"""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+
+class SnapshotCollector:
+    """Collector yielding the Fishnet metrics from the current snapshot"""
+
+    def __init__(self):
+        self.enabled = False
+        # instance -> InstanceSnapshot; the dict itself is replaced, never modified
+        self._snapshot = {}
+        self._rendered = (None, b'')
+        self._series_config = dict(DEFAULT_SERIES_CONFIG)
+        # Serializes the writers only, readers just take the current reference
+        self._lock = threading.Lock()
+
+    def configure(self, series_config):
+        self._series_config = dict(DEFAULT_SERIES_CONFIG, **(series_config or {}))
+
+    def _max_series(self, name):
+        return (self._series_config['max_series'] or {}).get(name)
+
+    def _publish(self, instance, entry):
+        snapshot = dict(self._snapshot)
+        snapshot[instance] = entry
+        self._snapshot = snapshot
+        FISHNET_SERIES_ACTIVE.labels(metric='fishnet_client_version').set(sum(len(e.clients) for e in snapshot.values()))
+        FISHNET_SERIES_ACTIVE.labels(metric='fishnet_client_versions').set(sum(len(e.versions) for e in snapshot.values()))
+        FISHNET_SERIES_ACTIVE.labels(metric='fishnet_move_time_ms').set(sum(len(e.move_time) for e in snapshot.values()))
+
+    def _budget(self, name, instance, field):
+        """Series of a capped metric still available to an instance"""
+        cap = self._max_series(name)
+        if cap is None:
+            return None
+        used = sum(len(getattr(entry, field)) for other, entry in self._snapshot.items() if other != instance)
+        return max(0, cap - used)
+
+    @staticmethod
+    def _accumulate(instance, kind, previous, counts):
+        # The API returns cumulative totals, the exported counters only get the delta
+        totals = dict(previous)
+        for job_type, count in counts.items():
+            totals[job_type] = totals.get(job_type, 0) + UPSTREAM_STATE.counter_delta(instance, kind, job_type, count)
+        return tuple(sorted(totals.items()))
+
+    def record(self, instance, data):
+        """Build and publish the snapshot of a successfully polled server"""
+        with self._lock:
+            UPSTREAM_STATE.update_payload(instance, data)
+            previous = self._snapshot.get(instance, EMPTY_INSTANCE)
+
+            queued = previous.queued
+            queue = data.get('queue', {})
+            if UPSTREAM_STATE.section_changed(instance, 'queue', queue):
+                queued = tuple(sorted(queue.items()))
+
+            completed, rejected = previous.completed, previous.rejected
+            jobs = data.get('jobs', {})
+            if UPSTREAM_STATE.section_changed(instance, 'jobs', jobs):
+                completed = self._accumulate(instance, 'completed', completed, jobs.get('completed', {}))
+                rejected = self._accumulate(instance, 'rejected', rejected, jobs.get('rejected', {}))
+
+            clients, versions = previous.clients, previous.versions
+            section = data.get('clients', {})
+            if UPSTREAM_STATE.section_changed(instance, 'clients', section_fingerprint(section)):
+                budget = self._budget('fishnet_client_version', instance, 'clients')
+                kept = []
+                counts = {}
+                for client_id, info in section.items():
+                    version = info.get('version', 'unknown')
+                    counts[version] = counts.get(version, 0) + 1
+                    kept.append((client_id, version))
+                if budget is not None and len(kept) > budget:
+                    FISHNET_SERIES_REJECTED.labels(metric='fishnet_client_version').inc(len(kept) - budget)
+                    del kept[budget:]
+                clients = tuple(kept)
+                # Aggregate counts per version, complete even past the per-client cap
+                versions = tuple(sorted(counts.items())) if self._series_config['rollup_client_versions'] else ()
+
+            performance = data.get('performance', {})
+            move_time = previous.move_time
+            section = performance.get('move_time', {})
+            if UPSTREAM_STATE.section_changed(instance, 'move_time', section):
+                budget = self._budget('fishnet_move_time_ms', instance, 'move_time')
+                move_time = tuple(sorted(section.items()))
+                if budget is not None and len(move_time) > budget:
+                    FISHNET_SERIES_REJECTED.labels(metric='fishnet_move_time_ms').inc(len(move_time) - budget)
+                    move_time = move_time[:budget]
+
+            self._publish(instance, InstanceSnapshot(
+                up=1,
+                nodes=data.get('nodes', 0),
+                queued=queued,
+                completed=completed,
+                rejected=rejected,
+                clients=clients,
+                versions=versions,
+                analyses=performance.get('analyses_per_second', 0),
+                move_time=move_time,
+                failures=0
+            ))
+
+    def record_down(self, instance):
+        """Publish a failed poll; the per-client series of a server down for too long are dropped"""
+        with self._lock:
+            UPSTREAM_STATE.invalidate_validators(instance)
+            previous = self._snapshot.get(instance, EMPTY_INSTANCE)
+            entry = previous._replace(up=0, failures=previous.failures + 1)
+            if entry.failures >= self._series_config['evict_after_cycles'] and (entry.clients or entry.move_time):
+                FISHNET_SERIES_EVICTED.labels(metric='fishnet_client_version').inc(len(entry.clients))
+                FISHNET_SERIES_EVICTED.labels(metric='fishnet_move_time_ms').inc(len(entry.move_time))
+                entry = entry._replace(clients=(), versions=(), move_time=())
+                # Re-apply the dropped sections on recovery, even if they did not change
+                UPSTREAM_STATE.invalidate_section(instance, 'clients')
+                UPSTREAM_STATE.invalidate_section(instance, 'move_time')
+            self._publish(instance, entry)
+
+    def record_unchanged(self, instance):
+        """A poll returned the same payload as the last one, only mark the server up"""
+        with self._lock:
+            previous = self._snapshot.get(instance, EMPTY_INSTANCE)
+            if previous.up != 1 or previous.failures:
+                self._publish(instance, previous._replace(up=1, failures=0))
+
+    def entries(self):
+        """Current snapshot as plain tuples, for the warm-start file"""
+        return {instance: tuple(entry) for instance, entry in self._snapshot.items()}
+
+    def restore(self, entries):
+        """Publish entries saved by a previous run, returns the restored instances"""
+        restored = []
+        with self._lock:
+            for instance, values in entries.items():
+                # Entries saved by a version with other fields are left out
+                if instance in self._snapshot or len(values) != len(InstanceSnapshot._fields):
+                    continue
+                # Pairs come back from JSON as lists, snapshots hold tuples
+                values = [tuple(tuple(pair) for pair in value) if isinstance(value, list) else value for value in values]
+                self._publish(instance, InstanceSnapshot(*values))
+                restored.append(instance)
+        return restored
+
+    def _families(self, snapshot):
+        up = GaugeMetricFamily('fishnet_up', 'Status of Fishnet instance', labels=['instance'])
+        nodes = GaugeMetricFamily('fishnet_nodes_total', 'Number of connected nodes', labels=['instance'])
+        queued = GaugeMetricFamily('fishnet_jobs_queued', 'Number of jobs in queue', labels=['instance', 'job_type'])
+        completed = CounterMetricFamily('fishnet_jobs_completed_total', 'Total number of completed jobs', labels=['instance', 'job_type'])
+        rejected = CounterMetricFamily('fishnet_jobs_rejected_total', 'Total number of rejected jobs', labels=['instance', 'job_type'])
+        client_version = GaugeMetricFamily('fishnet_client_version', 'Version information for each client', labels=['instance', 'client_id', 'version'])
+        analyses = GaugeMetricFamily('fishnet_analyses_per_second', 'Analyses per second', labels=['instance'])
+        move_time = GaugeMetricFamily('fishnet_move_time_ms', 'Average time per move in milliseconds', labels=['instance', 'depth'])
+        client_versions = GaugeMetricFamily('fishnet_client_versions', 'Number of connected clients per version', labels=['instance', 'version'])
+
+        for instance, entry in sorted(snapshot.items()):
+            up.add_metric([instance], entry.up)
+            if entry.nodes is not None:
+                nodes.add_metric([instance], entry.nodes)
+            for job_type, count in entry.queued:
+                queued.add_metric([instance, job_type], count)
+            for job_type, total in entry.completed:
+                completed.add_metric([instance, job_type], total)
+            for job_type, total in entry.rejected:
+                rejected.add_metric([instance, job_type], total)
+            for client_id, version in entry.clients:
+                client_version.add_metric([instance, client_id, version], 1)
+            if entry.analyses is not None:
+                analyses.add_metric([instance], entry.analyses)
+            for depth, time_ms in entry.move_time:
+                move_time.add_metric([instance, depth], time_ms)
+            for version, count in entry.versions:
+                client_versions.add_metric([instance, version], count)
+
+        return [up, nodes, queued, completed, rejected, client_version, analyses, move_time, client_versions]
+
+    def collect(self):
+        if not self.enabled:
+            return iter(())
+        return iter(self._families(self._snapshot))
+
+    def rendered(self):
+        """Exposition text of the current snapshot, rendered once per snapshot"""
+        snapshot = self._snapshot
+        cached_snapshot, output = self._rendered
+        if cached_snapshot is snapshot:
+            FISHNET_SNAPSHOT_RENDERS.labels(result='hit').inc()
+            return output
+        FISHNET_SNAPSHOT_RENDERS.labels(result='miss').inc()
+        output = generate_latest(_Families(self._families(snapshot)))
+        self._rendered = (snapshot, output)
+        return output
+
+
+class SnapshotRegistry:
+    """Registry view adding the snapshot collector to a registry, with a cached rendering"""
+
+    def __init__(self, registry, snapshot, names=None):
+        self.registry = registry
+        self.snapshot = snapshot
+        self.names = names
+
+    def collect(self):
+        for metric in self.registry.collect():
+            if self._wanted(metric):
+                yield metric
+        for metric in self.snapshot.collect():
+            if self._wanted(metric):
+                yield metric
+
+    def _wanted(self, metric):
+        if self.names is None:
+            return True
+        return any(sample.name in self.names for sample in metric.samples)
+
+    def restricted_registry(self, names):
+        return SnapshotRegistry(self.registry, self.snapshot, set(names))
+
+    def render(self):
+        """Exposition text with the snapshot part cached, or None outside snapshot mode"""
+        if not self.snapshot.enabled or self.names is not None:
+            return None
+        return generate_latest(self.registry) + self.snapshot.rendered()
+
+
+SNAPSHOT = SnapshotCollector()
+
+# Default registry together with the snapshot, what the exporters serve and push
+SNAPSHOT_REGISTRY = SnapshotRegistry(REGISTRY, SNAPSHOT)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Fishnet push spool
+Bounded on-disk queue of the pushes a client could not deliver. While no
+central server takes its pushes, a client appends a timestamped snapshot of
+its metrics to the current segment file of its spool directory; old segments
+are dropped past the size and age caps. Once a central server answers again,
+the spooled snapshots are replayed oldest first, a batch per push cycle, at a
+limited rate and after a random delay, so that a whole fleet reconnecting at
+once does not flood the central server. Replays run on their own thread and
+only hold the spool lock to read a record or move the cursor, so that they
+never hold up the collection cycles. A cursor file records how far the
+replay went across restarts.
+"""
+
+import os
+import random
+import struct
+import logging
+import threading
+import time
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_SPOOL_RECORDS = Gauge('fishnet_spool_records', 'Pushes waiting in the spool')
+FISHNET_SPOOL_BYTES = Gauge('fishnet_spool_bytes', 'Size of the spool segments on disk')
+FISHNET_SPOOL_OLDEST = Gauge('fishnet_spool_oldest_timestamp_seconds', 'Time of the oldest push waiting in the spool, 0 if empty')
+FISHNET_SPOOL_APPENDED = Counter('fishnet_spool_appended_total', 'Pushes written to the spool')
+FISHNET_SPOOL_REPLAYED = Counter('fishnet_spool_replayed_total', 'Spooled pushes delivered to a central server')
+FISHNET_SPOOL_DROPPED = Counter('fishnet_spool_dropped_total', 'Spooled pushes dropped before delivery', ['reason'])
+
+# Defaults for the 'metrics_server.spool' section of the configuration
+DEFAULT_SPOOL_CONFIG = {
+    'enabled': True,
+    'path': 'spool',
+    'segment_bytes': 1024 * 1024,
+    'max_bytes': 64 * 1024 * 1024,
+    'max_age': 86400,
+    'batch_size': 20,
+    'replay_rate': 5,
+    'replay_jitter': 30
+}
+
+# Timestamp and length of each record, followed by its body
+RECORD_HEADER = struct.Struct('>dI')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+
+class Spool:
+    """Segment files of undelivered pushes, with a replay cursor"""
+
+    def __init__(self):
+        self.path = None
+        # (segment name, offset) of the next record to replay
+        self._cursor = (None, 0)
+        # segment name -> (records, first record timestamp)
+        self._segments = {}
+        self._resume_at = None
+        self._replayer = None
+        self._lock = threading.Lock()
+
+    def configure(self, spool_config):
+        """Apply a 'metrics_server.spool' style configuration, returns it merged with the defaults"""
+        spool_config = dict(DEFAULT_SPOOL_CONFIG, **(spool_config or {}))
+        if spool_config['enabled'] and spool_config['path'] != self.path:
+            with self._lock:
+                self._open(spool_config['path'])
+        return spool_config
+
+    def _open(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._segments = {}
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self._segments[name] = self._scan(name)
+        self._cursor = (None, 0)
+        try:
+            with open(os.path.join(path, CURSOR_FILE)) as file:
+                name, offset = file.read().split()
+            if name in self._segments:
+                self._cursor = (name, int(offset))
+        except (OSError, ValueError):
+            pass
+        if self._segments:
+            logger.info(f"Spool {path} holds {self._pending_records()} undelivered pushes")
+        self._update_gauges()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _scan(self, name, start=0):
+        """Count the complete records of a segment from an offset, returns (records, first timestamp)"""
+        records, first = 0, None
+        with open(self._file(name), 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            file.seek(start)
+            while True:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                timestamp, length = RECORD_HEADER.unpack(header)
+                if file.tell() + length > size:
+                    break
+                file.seek(length, os.SEEK_CUR)
+                records += 1
+                if first is None:
+                    first = timestamp
+        return records, first
+
+    def _pending_records(self):
+        name, offset = self._cursor
+        total = sum(records for records, _ in self._segments.values())
+        if name in self._segments and offset:
+            total -= self._segments[name][0] - self._scan(name, offset)[0]
+        return total
+
+    def _update_gauges(self):
+        FISHNET_SPOOL_RECORDS.set(self._pending_records())
+        FISHNET_SPOOL_BYTES.set(sum(os.path.getsize(self._file(name)) for name in self._segments))
+        first = [timestamp for _, timestamp in self._segments.values() if timestamp is not None]
+        FISHNET_SPOOL_OLDEST.set(min(first) if first else 0)
+
+    def append(self, timestamp, body, spool_config):
+        """Queue an undelivered push"""
+        spool_config = self.configure(spool_config)
+        if not spool_config['enabled']:
+            return
+        with self._lock:
+            names = sorted(self._segments)
+            if not names or os.path.getsize(self._file(names[-1])) >= spool_config['segment_bytes']:
+                names.append(f'{time.time_ns():020d}{SEGMENT_SUFFIX}')
+                self._segments[names[-1]] = (0, None)
+            name = names[-1]
+            with open(self._file(name), 'ab') as file:
+                file.write(RECORD_HEADER.pack(timestamp, len(body)) + body)
+                file.flush()
+                os.fsync(file.fileno())
+            records, first = self._segments[name]
+            self._segments[name] = (records + 1, timestamp if first is None else first)
+            FISHNET_SPOOL_APPENDED.inc()
+            self._enforce_caps(spool_config)
+            self._update_gauges()
+        # Replay only starts once the next push goes through
+        self._resume_at = None
+
+    def _drop_segment(self, name, reason):
+        records, _ = self._segments.pop(name)
+        if self._cursor[0] == name:
+            records = self._scan(name, self._cursor[1])[0]
+            self._cursor = (None, 0)
+        os.unlink(self._file(name))
+        if records:
+            FISHNET_SPOOL_DROPPED.labels(reason=reason).inc(records)
+
+    def _enforce_caps(self, spool_config):
+        names = sorted(self._segments)
+        oldest_kept = time.time() - spool_config['max_age']
+        # A segment only holds pushes older than the one after it started
+        for name, following in zip(names, names[1:]):
+            if (self._segments[following][1] or 0) < oldest_kept:
+                self._drop_segment(name, 'age')
+        names = sorted(self._segments)
+        total = sum(os.path.getsize(self._file(name)) for name in names)
+        while len(names) > 1 and total > spool_config['max_bytes']:
+            total -= os.path.getsize(self._file(names[0]))
+            self._drop_segment(names.pop(0), 'size')
+
+    def _save_cursor(self):
+        name, offset = self._cursor
+        path = self._file(CURSOR_FILE)
+        with open(path + '.tmp', 'w') as file:
+            file.write(f'{name or "-"} {offset}\n')
+        os.replace(path + '.tmp', path)
+
+    def _next_record(self):
+        """Oldest undelivered record, returns (segment, offset after it, timestamp, body) or None"""
+        for name in sorted(self._segments):
+            offset = self._cursor[1] if self._cursor[0] == name else 0
+            with open(self._file(name), 'rb') as file:
+                file.seek(offset)
+                header = file.read(RECORD_HEADER.size)
+                if len(header) == RECORD_HEADER.size:
+                    timestamp, length = RECORD_HEADER.unpack(header)
+                    body = file.read(length)
+                    if len(body) == length:
+                        return name, offset + RECORD_HEADER.size + length, timestamp, body
+            if header:
+                # A record cut short by a crash while it was written
+                FISHNET_SPOOL_DROPPED.labels(reason='truncated').inc()
+            self._drop_segment(name, 'truncated')
+        return None
+
+    def start_replay(self, replay):
+        """Run replay() on its own thread, unless there is nothing to replay or a replay is still running"""
+        with self._lock:
+            if not self._segments or (self._replayer is not None and self._replayer.is_alive()):
+                return False
+            self._replayer = threading.Thread(target=replay, name='fishnet-spool-replay', daemon=True)
+            self._replayer.start()
+        return True
+
+    def replay(self, send, spool_config):
+        """Deliver a batch of spooled pushes with send(timestamp, body), which returns the HTTP status"""
+        spool_config = self.configure(spool_config)
+        if not spool_config['enabled'] or not self.path:
+            return 0
+        now = time.monotonic()
+        if self._resume_at is None:
+            # Spread the replays of a fleet that reconnects all at once
+            self._resume_at = now + random.uniform(0, spool_config['replay_jitter'])
+        if now < self._resume_at:
+            return 0
+
+        replayed = 0
+        interval = 1.0 / spool_config['replay_rate'] if spool_config['replay_rate'] else 0
+        while replayed < spool_config['batch_size']:
+            with self._lock:
+                record = self._next_record()
+                if record is None:
+                    self._save_cursor()
+                    self._update_gauges()
+                    break
+            name, offset, timestamp, body = record
+            sent = False
+            if timestamp < time.time() - spool_config['max_age']:
+                FISHNET_SPOOL_DROPPED.labels(reason='age').inc()
+            else:
+                # Without the lock, pushes keep being spooled meanwhile
+                status = send(timestamp, body)
+                sent = True
+                if status == 200:
+                    FISHNET_SPOOL_REPLAYED.inc()
+                    replayed += 1
+                elif status == 413:
+                    # A spooled snapshot cannot be split, it would be refused again
+                    FISHNET_SPOOL_DROPPED.labels(reason='too_large').inc()
+                elif 400 <= status < 500 and status != 429:
+                    FISHNET_SPOOL_DROPPED.labels(reason='rejected').inc()
+                else:
+                    # Try again after a new random delay
+                    self._resume_at = time.monotonic() + random.uniform(0, spool_config['replay_jitter'])
+                    break
+            with self._lock:
+                # Unless the caps dropped the segment in the meantime
+                if name in self._segments:
+                    self._cursor = (name, offset)
+                    self._save_cursor()
+                self._update_gauges()
+            if sent and interval:
+                time.sleep(interval)
+        if replayed:
+            logger.info(f"Replayed {replayed} spooled pushes, {self._pending_records()} left")
+        return replayed
+
+
+SPOOL = Spool()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Fishnet startup benchmark
+Starts fishnet.py in each mode against fishnet_mock_server.py, several times,
+and reports the time from process start to the first Fishnet metric served
+on /metrics (or, for the CLI, to its exit) and the peak RSS of the process.
+Every run starts a fresh interpreter in an empty working directory, with the
+warm start disabled, so that it measures a cold start. Use --json to keep the
+results for regression comparisons.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+import yaml
+from tabulate import tabulate
+from fishnet_bench import HERE, free_port, start_mock_server
+
+MODES = ('standalone', 'client', 'central', 'cli')
+FIRST_METRIC = b'fishnet_up{instance="startup-0"} 1.0'
+
+
+def mode_config(mode, args, port, workdir):
+    config = {
+        'servers': [{'name': f'startup-{i}', 'url': f'{args.mock_url}/startup{i}?clients={args.clients}'} for i in range(args.servers)],
+        'exporter': {
+            'port': port,
+            'scrape_interval': 60,
+            'cycle_timeout': 5,
+            'http': {'retries': 0},
+            'warm_start': {'enabled': False}
+        },
+        'metrics_server': {'enabled': False}
+    }
+    if mode == 'client':
+        # Nothing listens there, pushes fail and go to the spool of the run
+        config['metrics_server'] = {
+            'enabled': True,
+            'mode': 'client',
+            'client_id': 'startup',
+            'central_url': f'http://127.0.0.1:{free_port()}/metrics/push',
+            'spool': {'path': os.path.join(workdir, 'spool')}
+        }
+    elif mode == 'central':
+        config['metrics_server'] = {'enabled': True, 'mode': 'central'}
+    return config
+
+
+def wait_reaped(process, timeout):
+    """Wait for a process, returns its peak RSS in bytes"""
+    killer = threading.Timer(timeout, process.kill)
+    killer.start()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        killer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def run_once(mode, args):
+    """Start fishnet.py in a mode once, returns (seconds to the first metric, peak RSS bytes)"""
+    workdir = tempfile.mkdtemp(prefix='fishnet-startup-')
+    try:
+        port = free_port()
+        config_path = os.path.join(workdir, 'config.yaml')
+        with open(config_path, 'w') as file:
+            yaml.safe_dump(mode_config(mode, args, port, workdir), file)
+        command = [sys.executable, os.path.join(HERE, 'fishnet.py'), '--config', config_path]
+        if mode == 'cli':
+            command += ['cli', '--json']
+        elif mode == 'standalone':
+            command += ['standalone']
+
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if mode == 'cli':
+            rss = wait_reaped(process, args.timeout)
+            elapsed = time.perf_counter() - started
+            if process.returncode != 0:
+                raise RuntimeError(f"the CLI exited with code {process.returncode}")
+            return elapsed, rss
+
+        elapsed = None
+        deadline = started + args.timeout
+        while time.perf_counter() < deadline:
+            try:
+                response = requests.get(f'http://127.0.0.1:{port}/metrics', timeout=1)
+                if FIRST_METRIC in response.content:
+                    elapsed = time.perf_counter() - started
+                    break
+            except requests.RequestException:
+                pass
+            if process.poll() is not None:
+                raise RuntimeError(f"{mode} mode exited with code {process.returncode}")
+            time.sleep(0.005)
+        process.send_signal(signal.SIGTERM)
+        rss = wait_reaped(process, 10)
+        if elapsed is None:
+            raise RuntimeError(f"{mode} mode served no Fishnet metric within {args.timeout}s")
+        return elapsed, rss
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(all_results):
+    rows = []
+    for r in all_results:
+        rows.append([
+            r['mode'],
+            r['runs'],
+            f"{r['first_metric_s'] * 1000:.0f}",
+            f"{r['first_metric_min_s'] * 1000:.0f}",
+            f"{r['first_metric_max_s'] * 1000:.0f}",
+            f"{r['peak_rss_bytes'] / 1024 / 1024:.1f}"
+        ])
+    headers = ['mode', 'runs', 'first metric ms', 'min ms', 'max ms', 'peak RSS MB']
+    print(tabulate(rows, headers=headers, tablefmt='simple'))
+    print("\nFor the CLI, 'first metric' is the time to print the status of every server and exit.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start of fishnet.py in each mode')
+    parser.add_argument('--modes', type=lambda value: value.split(','), default=list(MODES), help=f"Comma separated modes among {', '.join(MODES)}")
+    parser.add_argument('--runs', type=int, default=5, help='Starts measured per mode')
+    parser.add_argument('--servers', type=int, default=1, help='Number of mocked Fishnet servers')
+    parser.add_argument('--clients', type=int, default=1000, help='Clients per mocked server')
+    parser.add_argument('--timeout', type=float, default=30, help='Maximum seconds to wait for a start')
+    parser.add_argument('--mock-url', default=None, help='Use an already running mock server')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    mock = None
+    if args.mock_url is None:
+        mock, args.mock_url = start_mock_server(argparse.Namespace(latency=0.0, churn=0.01))
+    try:
+        all_results = []
+        for mode in args.modes:
+            runs = [run_once(mode, args) for _ in range(args.runs)]
+            times = [elapsed for elapsed, _ in runs]
+            all_results.append({
+                'mode': mode,
+                'runs': args.runs,
+                'first_metric_s': statistics.median(times),
+                'first_metric_min_s': min(times),
+                'first_metric_max_s': max(times),
+                'peak_rss_bytes': statistics.median(rss for _, rss in runs)
+            })
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        print_report(all_results)
+
+
+if __name__ == '__main__':
+    main()
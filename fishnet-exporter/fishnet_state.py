@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Fishnet upstream state
+Remembers the last status payload and the last cumulative job counters
+observed for every Fishnet instance. The collector uses it to turn the
+cumulative totals returned by the status API into counter increments, to
+detect upstream resets, to skip sections that did not change since the
+previous poll, and to make conditional requests (ETag, Last-Modified and a
+hash of the last processed body). Anything else reading the status payload should use the
+shared UPSTREAM_STATE rather than keeping its own copy.
+"""
+
+import time
+import threading
+from prometheus_client import Counter
+
+FISHNET_UPSTREAM_RESETS = Counter('fishnet_upstream_counter_resets_total', 'Upstream job counters that went backwards (server restart)', ['instance', 'kind', 'job_type'])
+
+
+class UpstreamState:
+    """Last observed upstream values, per instance"""
+
+    def __init__(self):
+        self._payloads = {}
+        self._sections = {}
+        self._counters = {}
+        self._validators = {}
+        self._lock = threading.Lock()
+
+    def update_payload(self, instance, data):
+        """Remember the latest status payload of an instance"""
+        with self._lock:
+            self._payloads[instance] = (time.time(), data)
+
+    def last_payload(self, instance):
+        """Return (timestamp, payload) of the latest poll, or (None, None)"""
+        with self._lock:
+            return self._payloads.get(instance, (None, None))
+
+    def instances(self):
+        with self._lock:
+            return list(self._payloads)
+
+    def section_changed(self, instance, section, value):
+        """Record a payload section, returns False if it equals the previous one"""
+        key = (instance, section)
+        with self._lock:
+            if key in self._sections and self._sections[key] == value:
+                return False
+            self._sections[key] = value
+            return True
+
+    def invalidate_section(self, instance, section):
+        """Forget a recorded section so that the next poll applies it again"""
+        with self._lock:
+            self._sections.pop((instance, section), None)
+
+    def validators(self, instance):
+        """Return the validators of the last processed response: etag, last_modified, body_hash"""
+        with self._lock:
+            return dict(self._validators.get(instance, {}))
+
+    def update_validators(self, instance, validators):
+        """Remember the validators of a response once it has been processed"""
+        with self._lock:
+            self._validators[instance] = validators
+
+    def invalidate_validators(self, instance):
+        """Make the next poll download and process the payload again"""
+        with self._lock:
+            self._validators.pop(instance, None)
+
+    def counter_delta(self, instance, kind, job_type, value):
+        """Record a cumulative upstream counter and return the increment since the last poll"""
+        key = (instance, kind, job_type)
+        with self._lock:
+            last = self._counters.get(key)
+            self._counters[key] = value
+        if last is None:
+            # First observation: export the upstream total as is
+            return value
+        if value < last:
+            # The upstream counter was reset, everything it holds is new
+            FISHNET_UPSTREAM_RESETS.labels(instance=instance, kind=kind, job_type=job_type).inc()
+            return value
+        return value - last
+
+    def counters(self):
+        """Return a copy of the last cumulative counters, keyed by (instance, kind, job_type)"""
+        with self._lock:
+            return dict(self._counters)
+
+    def restore_counters(self, counters):
+        """Take over cumulative counters saved by a previous run, for the keys not observed yet"""
+        with self._lock:
+            for key, value in counters.items():
+                self._counters.setdefault(key, value)
+
+    def forget(self, instance):
+        """Drop everything known about an instance"""
+        with self._lock:
+            self._payloads.pop(instance, None)
+            self._validators.pop(instance, None)
+            for key in [k for k in self._sections if k[0] == instance]:
+                del self._sections[key]
+            for key in [k for k in self._counters if k[0] == instance]:
+                del self._counters[key]
+
+
+UPSTREAM_STATE = UpstreamState()
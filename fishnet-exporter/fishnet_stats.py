@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Fishnet windowed statistics
+Keeps a small ring buffer of the recent polls of every instance (cumulative
+job totals and move time per depth) and derives from it, after each poll,
+the job throughput and the average move time over sliding windows (1m, 5m
+and 15m by default) and the quantiles of the move time over the longest
+window. Dashboards read these gauges directly instead of running range
+queries such as rate(fishnet_jobs_completed_total[5m]) over every instance.
+"""
+
+import math
+import time
+import logging
+import threading
+from collections import deque
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger('fishnet-exporter')
+
+# Defaults for the 'exporter.stats' section of the configuration
+DEFAULT_STATS_CONFIG = {
+    'enabled': True,
+    'windows': [60, 300, 900],
+    'quantiles': [0.5, 0.9, 0.99],
+    'max_samples': 512
+}
+
+JOB_KINDS = ('completed', 'rejected')
+
+
+def window_label(seconds):
+    """'1m' for 60 seconds, '90s' for 90"""
+    return f'{seconds // 60}m' if seconds % 60 == 0 else f'{seconds}s'
+
+
+def quantile(ordered, q):
+    """Quantile of sorted values, interpolated between the closest ranks"""
+    position = q * (len(ordered) - 1)
+    low = math.floor(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+class WindowStats:
+    """Recent polls of every instance and the statistics derived from them"""
+
+    def __init__(self):
+        self._config = dict(DEFAULT_STATS_CONFIG)
+        # instance -> deque of (time, {kind: {job_type: total}}, {depth: move time})
+        self._samples = {}
+        # instance -> {metric name: [(label values, value)]}, replaced after each poll
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def configure(self, stats_config):
+        config = dict(DEFAULT_STATS_CONFIG, **(stats_config or {}))
+        if config != self._config:
+            with self._lock:
+                if config['max_samples'] != self._config['max_samples']:
+                    self._samples = {
+                        instance: deque(samples, maxlen=config['max_samples'])
+                        for instance, samples in self._samples.items()
+                    }
+                self._config = config
+                if not config['enabled']:
+                    self._samples = {}
+                    self._derived = {}
+
+    def observe(self, instance, data, now=None):
+        """Add a successful poll of an instance"""
+        if not self._config['enabled']:
+            return
+        jobs = data.get('jobs', {})
+        totals = {kind: dict(jobs.get(kind, {})) for kind in JOB_KINDS}
+        move_time = dict(data.get('performance', {}).get('move_time', {}))
+        self._add(instance, totals, move_time, now)
+
+    def observe_unchanged(self, instance, now=None):
+        """Add a poll that returned the same payload as the previous one"""
+        with self._lock:
+            samples = self._samples.get(instance)
+            if not samples:
+                return
+            _, totals, move_time = samples[-1]
+        self._add(instance, totals, move_time, now)
+
+    def observe_down(self, instance):
+        """A failed poll hides the derived statistics of the instance until it recovers"""
+        with self._lock:
+            self._derived.pop(instance, None)
+
+    def _add(self, instance, totals, move_time, now):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            config = self._config
+            samples = self._samples.get(instance)
+            if samples is None:
+                samples = self._samples[instance] = deque(maxlen=config['max_samples'])
+            samples.append((now, totals, move_time))
+            # Keep a single sample older than the longest window, as the baseline of its rate
+            start = now - max(config['windows'])
+            while len(samples) > 1 and samples[1][0] <= start:
+                samples.popleft()
+            self._derived[instance] = self._derive(list(samples), config)
+
+    @staticmethod
+    def _derive(samples, config):
+        now, latest_totals, _ = samples[-1]
+        derived = {}
+
+        rates = derived.setdefault('rates', [])
+        for window in config['windows']:
+            start = now - window
+            # Latest sample at or before the window start, or the oldest one available
+            first = 0
+            for i, (timestamp, _, _) in enumerate(samples):
+                if timestamp <= start:
+                    first = i
+            span = now - max(start, samples[first][0])
+            if span <= 0:
+                continue
+            for kind in JOB_KINDS:
+                for job_type, total in latest_totals[kind].items():
+                    increase = 0
+                    previous = None
+                    for timestamp, totals, _ in samples[first:]:
+                        value = totals[kind].get(job_type)
+                        if value is None:
+                            continue
+                        if previous is not None:
+                            # A total that went backwards restarted from zero
+                            step = value - previous if value >= previous else value
+                            if previous_time < start:
+                                # Interpolated at the window start, only the part inside the window counts
+                                step *= (timestamp - start) / (timestamp - previous_time)
+                            increase += step
+                        previous, previous_time = value, timestamp
+                    rates.append((kind, (job_type, window_label(window)), increase / span))
+
+        averages = derived.setdefault('averages', [])
+        quantiles = derived.setdefault('quantiles', [])
+        longest = max(config['windows'])
+        depths = samples[-1][2]
+        for depth in depths:
+            for window in config['windows']:
+                values = [move_time[depth] for timestamp, _, move_time in samples if timestamp > now - window and depth in move_time]
+                if values:
+                    averages.append(((depth, window_label(window)), sum(values) / len(values)))
+                if window == longest and values:
+                    ordered = sorted(values)
+                    for q in config['quantiles']:
+                        quantiles.append(((depth, str(q)), quantile(ordered, q)))
+        return derived
+
+    def describe(self):
+        return self._families({})
+
+    def collect(self):
+        with self._lock:
+            derived = dict(self._derived)
+        return self._families(derived)
+
+    @staticmethod
+    def _families(derived):
+        completed = GaugeMetricFamily('fishnet_jobs_completed_rate', 'Jobs completed per second over a sliding window', labels=['instance', 'job_type', 'window'])
+        rejected = GaugeMetricFamily('fishnet_jobs_rejected_rate', 'Jobs rejected per second over a sliding window', labels=['instance', 'job_type', 'window'])
+        averages = GaugeMetricFamily('fishnet_move_time_ms_avg', 'Average of the polled move time over a sliding window', labels=['instance', 'depth', 'window'])
+        quantiles = GaugeMetricFamily('fishnet_move_time_ms_quantile', 'Quantiles of the polled move time over the longest window', labels=['instance', 'depth', 'quantile'])
+        families = {'completed': completed, 'rejected': rejected}
+        for instance, stats in sorted(derived.items()):
+            for kind, labels, value in stats['rates']:
+                families[kind].add_metric([instance, *labels], value)
+            for labels, value in stats['averages']:
+                averages.add_metric([instance, *labels], value)
+            for labels, value in stats['quantiles']:
+                quantiles.add_metric([instance, *labels], value)
+        return [completed, rejected, averages, quantiles]
+
+
+WINDOW_STATS = WindowStats()
+REGISTRY.register(WINDOW_STATS)
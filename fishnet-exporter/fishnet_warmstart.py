@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Fishnet warm start
+Saves the metric state of the collector (the exported series and the last
+cumulative upstream counters) to a local file every few cycles and on
+shutdown, as zlib-compressed JSON behind a small header, written to a
+temporary file, fsynced and renamed into place; JSON rather than pickle, so
+that whoever can write to the state volume cannot run code in the exporter.
+A restarted exporter loads it at the start of its first cycle, before
+polling, and serves the restored series of the servers still configured
+right away, flagged by fishnet_warmstart_stale{instance} until that
+instance has been polled again. Since the upstream counters are restored
+too, the first poll only adds the jobs done in between and the
+fishnet_jobs_*_total counters carry on instead of starting from zero.
+"""
+
+import os
+import json
+import zlib
+import time
+import struct
+import logging
+import threading
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger('fishnet-exporter')
+
+FISHNET_WARMSTART_STALE = Gauge('fishnet_warmstart_stale', 'Instances served from the warm-start file and not polled since', ['instance'])
+FISHNET_WARMSTART_AGE = Gauge('fishnet_warmstart_loaded_age_seconds', 'Age of the warm-start state restored at startup')
+FISHNET_WARMSTART_SAVES = Counter('fishnet_warmstart_saves_total', 'Saves of the warm-start state', ['result'])
+FISHNET_WARMSTART_BYTES = Gauge('fishnet_warmstart_bytes', 'Size of the last saved warm-start state')
+
+# Defaults for the 'exporter.warm_start' section of the configuration
+DEFAULT_WARM_START_CONFIG = {
+    'enabled': True,
+    'path': 'state/warm_start.bin',
+    'save_interval': 60,
+    'max_age': 3600
+}
+
+MAGIC = b'FNWS'
+# Version 1 was a pickle, it is ignored rather than loaded
+FORMAT_VERSION = 2
+# Magic, format version, time the state was saved at
+HEADER = struct.Struct('>4sBd')
+
+
+def encode_state(state, saved_at):
+    """Serialize a state into the warm-start file format"""
+    body = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(MAGIC, FORMAT_VERSION, saved_at) + zlib.compress(body, 6)
+
+
+def decode_state(blob):
+    """Parse the warm-start file format, returns (saved at, state)"""
+    if len(blob) < HEADER.size:
+        raise ValueError("file too short")
+    magic, version, saved_at = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"unsupported format {magic!r} version {version}")
+    state = json.loads(zlib.decompress(blob[HEADER.size:]))
+    if not isinstance(state, dict):
+        raise ValueError("state is not an object")
+    return saved_at, state
+
+
+def write_atomic(path, data):
+    """Replace a file with new contents, never leaving a partial file behind"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+    # The rename itself only survives a crash once the directory is synced
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class WarmStart:
+    """Periodic save of the collector state, restored once at startup"""
+
+    def __init__(self, capture, restore):
+        # capture() returns the state to save, as JSON types; restore(state, instances) applies the
+        # part of it about the given instances and returns the restored ones
+        self.capture = capture
+        self.restore = restore
+        self._config = dict(DEFAULT_WARM_START_CONFIG)
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._next_save = 0
+        self._stale = set()
+
+    def configure(self, warm_start_config):
+        self._config = dict(DEFAULT_WARM_START_CONFIG, **(warm_start_config or {}))
+
+    def load(self, instances):
+        """Restore the saved state of the configured instances the first time it is called, later calls return at once"""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            try:
+                if self._config['enabled']:
+                    self._load(self._config, set(instances))
+            finally:
+                self._next_save = time.monotonic() + self._config['save_interval']
+                self._loaded = True
+
+    def _load(self, config, configured):
+        try:
+            with open(config['path'], 'rb') as file:
+                blob = file.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Cannot read the warm-start file {config['path']}: {e}")
+            return
+        try:
+            saved_at, state = decode_state(blob)
+        except Exception as e:
+            logger.warning(f"Ignoring the unreadable warm-start file {config['path']}: {e}")
+            return
+
+        age = time.time() - saved_at
+        if age > config['max_age']:
+            logger.info(f"Ignoring the warm-start file {config['path']}, saved {age:.0f}s ago")
+            return
+        try:
+            # Servers removed from the configuration since are left out, nothing would evict them
+            instances = self.restore(state, configured)
+        except Exception as e:
+            logger.warning(f"Ignoring the invalid warm-start file {config['path']}: {e}")
+            return
+        FISHNET_WARMSTART_AGE.set(age)
+        for instance in instances:
+            self._stale.add(instance)
+            FISHNET_WARMSTART_STALE.labels(instance=instance).set(1)
+        logger.info(f"Restored the state of {len(instances)} instance(s) saved {age:.0f}s ago, stale until polled")
+
+    def polled(self, instance):
+        """The restored series of an instance have been replaced by a poll"""
+        if instance in self._stale:
+            self._stale.discard(instance)
+            FISHNET_WARMSTART_STALE.labels(instance=instance).set(0)
+
+    def save(self, force=False):
+        """Save the state if the save interval has elapsed, or now if forced"""
+        config = self._config
+        # The file is never overwritten before it has been read
+        if not config['enabled'] or not self._loaded:
+            return
+        if not force and time.monotonic() < self._next_save:
+            return
+        if not self._save_lock.acquire(blocking=force):
+            return
+        try:
+            self._next_save = time.monotonic() + config['save_interval']
+            data = encode_state(self.capture(), time.time())
+            write_atomic(config['path'], data)
+            FISHNET_WARMSTART_SAVES.labels(result='success').inc()
+            FISHNET_WARMSTART_BYTES.set(len(data))
+        except Exception as e:
+            FISHNET_WARMSTART_SAVES.labels(result='error').inc()
+            logger.error(f"Error saving the warm-start state to {config['path']}: {e}")
+        finally:
+            self._save_lock.release()